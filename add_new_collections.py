@@ -14,7 +14,7 @@ Steps:
 6. Commits the changes to the database and closes the connection.
 
 Dependencies:
-- sqlite3 (built into Python)
+- sqlite3 (built into Python), opened through database.py in WAL mode
 - pandas (for handling the CSV file)
 
 Notes:
@@ -23,25 +23,78 @@ Notes:
 - New records are added without affecting existing ones
 - Leading and trailing whitespace is removed from column headings
 - Only columns required by report_active_policies.py are used
+- CSV columns are matched to the table columns with the shared resolver in column_resolver.py
 - Empty Transaction_Date values are kept as NULL in the database
+- (Policy_No, Transaction_Date) is the unique key of the Collections table; older databases without
+  the key are migrated in place when the script starts
+- With streaming_mode = True (the default) the CSV is read, mapped and sign-normalized chunk_size
+  rows at a time (see collections_ingest.py). The chunks are bulk-loaded into a temporary staging
+  table which is then merged into Collections with set-based SQL (insert new rows, update changed
+  rows) and committed in a single transaction. The staging table is written to a temporary file
+  rather than kept in memory (see temp_store in database.py), so memory use stays flat however
+  big the file is. Rows whose
+  Transaction_type is not 'accepted' or 'default' are written to 'quarantine_<csv file name>'
+  instead of the Collections table. Set streaming_mode = False to load the whole file at once.
+- Transaction_Date is stored as ISO text plus an integer Transaction_Date_EpochDay column
+  (see date_columns.py). Databases created before that are migrated the first time this runs.
+- After the ingest, the months of the Parquet copy of the table (see parquet_mirror.py) that
+  received new or changed rows are rewritten. Set parquet_mirror = False to skip that.
+- The policies of new or changed rows are written to the change log (see change_log.py), so the
+  next report only works out the status of their main policies again.
 """
 
-import sqlite3
+import sys
 import pandas as pd
+from database import connect
+from change_log import record_changes
+from column_resolver import print_column_plan, resolve_column_plan
+from collections_ingest import (
+    COLLECTIONS_COLUMN_MAPPING, COLLECTIONS_KEY_COLUMNS, DEFAULT_CHUNK_SIZE, MANDATORY_COLLECTION_COLUMNS,
+    COLLECTIONS_STAGING_TABLE, collections_table_columns, create_collections_staging, ensure_collections_key, merge_collections_staging,
+    print_premium_audit, stage_collections_chunk, stream_collections_csv
+)
+from date_columns import normalize_date_value
+from parquet_mirror import staged_months, update_mirror
+from ingest_manifest import file_content_hash, forget_rows, is_file_ingested, record_file
+
+csv_file = 'April to 3 May CPS.csv'
+
+# Read and write the CSV in chunks instead of loading the whole file at once
+streaming_mode = True
+chunk_size = DEFAULT_CHUNK_SIZE
+
+# Refresh the Parquet copy of the Collections table after the ingest (needs pyarrow)
+parquet_mirror = True
 
 # Connect to SQLite database
-conn = sqlite3.connect('policies.db')
+conn = connect('policies.db')
+
+# Databases created before the Collections table had a unique key are migrated in place
+duplicates_removed = ensure_collections_key(conn)
+if duplicates_removed:
+    print(f"Added unique key on (Policy_No, Transaction_Date), removed {duplicates_removed} duplicate rows")
+
+# Nothing to do if exactly this file has already been ingested
+file_hash = file_content_hash(csv_file)
+if is_file_ingested(conn, file_hash, "Collections"):
+    print(f"'{csv_file}' has already been ingested into the Collections table - nothing to do.")
+    conn.close()
+    sys.exit(0)
 
-# Load the new collections data from CSV
-print("\nLoading CSV file: 'April to 3 May CPS.csv'")
-new_collections_df = pd.read_csv('April to 3 May CPS.csv')
+if streaming_mode:
+    # Only read the header here; the rows are read chunk by chunk below
+    new_collections_df = pd.read_csv(csv_file, nrows=0)
+else:
+    # Load the new collections data from CSV
+    print(f"\nLoading CSV file: '{csv_file}'")
+    new_collections_df = pd.read_csv(csv_file)
 
-# Print shape of DataFrame to check how many rows/columns were loaded
-print(f"CSV loaded: {new_collections_df.shape[0]} rows, {new_collections_df.shape[1]} columns")
+    # Print shape of DataFrame to check how many rows/columns were loaded
+    print(f"CSV loaded: {new_collections_df.shape[0]} rows, {new_collections_df.shape[1]} columns")
 
-# Show first 5 rows of raw data to see what we're working with
-print("\nFirst 5 rows of raw data:")
-print(new_collections_df.head(5))
+    # Show first 5 rows of raw data to see what we're working with
+    print("\nFirst 5 rows of raw data:")
+    print(new_collections_df.head(5))
 
 # Clean column names by removing leading/trailing whitespace
 original_columns = new_collections_df.columns.tolist()
@@ -72,53 +125,23 @@ print("\nRequired columns for report_active_policies.py:")
 for col in required_columns:
     print(f"  '{col}'")
 
-# Function to map CSV columns to required columns (case-insensitive and ignoring whitespace)
-def get_matching_column(df, target_col):
-    # First check for exact match after whitespace stripping
-    if target_col in df.columns:
-        return target_col
-    
-    # Check for match with underscores replaced by spaces
-    space_version = target_col.replace("_", " ")
-    if space_version in df.columns:
-        return space_version
-    
-    # Try case-insensitive match
-    for col in df.columns:
-        if col.lower() == target_col.lower() or col.lower() == space_version.lower():
-            return col
-    
-    # If no match, return None
-    return None
-
 # Manual mapping for specific columns we know need special handling
-column_mapping = {
-    "Transaction_Date": "Transaction Date",
-    "Premium": "Premium",
-    "Transaction_type": "Transaction Type",
-    "Payment_Method": "Payment Method",
-    "Policy_No": "Policy No"
-}
-
-# Display mapping from CSV columns to required columns
-print("\nColumn mapping from CSV to required columns:")
-for target_col in required_columns:
-    # Try the manual mapping first
-    if target_col in column_mapping and column_mapping[target_col] in new_collections_df.columns:
-        matching_col = column_mapping[target_col]
-        print(f"  '{target_col}' → mapped to → '{matching_col}'")
-    else:
-        # Fall back to automatic mapping
-        matching_col = get_matching_column(new_collections_df, target_col)
-        if matching_col:
-            print(f"  '{target_col}' → mapped to → '{matching_col}'")
-        else:
-            print(f"  '{target_col}' → NO MATCH FOUND")
+column_mapping = COLLECTIONS_COLUMN_MAPPING
+
+# Work out which CSV column supplies each required column, once for the whole file
+column_map = resolve_column_plan(
+    new_collections_df.columns,
+    required_columns,
+    overrides=column_mapping,
+    mandatory_columns=MANDATORY_COLLECTION_COLUMNS
+)
+print_column_plan(column_map)
 
-# Specifically check for Policy_No column and its values
-policy_col = "Policy No"  # We know this is the correct column name from the mapping
-if policy_col in new_collections_df.columns:
-    print(f"\nPolicy column found: '{policy_col}'")
+# Specifically check for Policy_No column and its values (it is mandatory, so it has been found)
+policy_col = column_map["Policy_No"]
+print(f"\nPolicy column found: '{policy_col}'")
+# The values are only available here when the whole file has been loaded
+if not streaming_mode:
     # Check for empty values
     empty_count = new_collections_df[policy_col].isna().sum()
     print(f"  Number of empty values: {empty_count} out of {len(new_collections_df)}")
@@ -127,42 +150,53 @@ if policy_col in new_collections_df.columns:
     sample_values = new_collections_df[policy_col].dropna().sample(min(5, len(new_collections_df))).tolist()
     for val in sample_values:
         print(f"    '{val}'")
+
+if streaming_mode:
+    print(f"\nLoading '{csv_file}' in chunks of {chunk_size} rows:")
+    # Stage the whole file, then merge it into Collections; nothing is committed until the end
+    create_collections_staging(conn)
+    stats = stream_collections_csv(csv_file, conn, column_map, stage_collections_chunk,
+                                   chunk_size=chunk_size, skip_missing_policy_no=True, use_manifest=True)
+    # Months that get new or changed rows; only these need rewriting in the Parquet mirror
+    changed_months = staged_months(conn, COLLECTIONS_STAGING_TABLE)
+    rows_inserted, rows_updated, rows_identical = merge_collections_staging(conn)
+
+    total_rows = stats["rows_read"]
+    rows_skipped = stats["rows_skipped"]
+    rows_processed = stats.get("staged", 0)
+    rows_unchanged = stats["rows_unchanged"] + rows_identical
+    dates_unparseable = stats["dates_unparseable"]
+    print_premium_audit(stats)
 else:
-    print("\nWARNING: 'Policy No' column not found in the CSV!")
-    print("Available columns are:", new_collections_df.columns.tolist())
-
-# Create cursor for database operations
-cursor = conn.cursor()
-
-# Track stats
-rows_processed = 0
-rows_skipped = 0
-rows_updated = 0
-rows_inserted = 0
-
-# Process each row in the new collections data
-for idx, row in new_collections_df.iterrows():
-    # Map CSV columns to required columns
-    mapped_values = {}
-    policy_no_value = None
-    transaction_date_value = None
+    total_rows = len(new_collections_df)
+    rows_unchanged = 0
+    # The row-by-row path doesn't keep track of months, so the whole mirror is rewritten
+    changed_months = None
+    dates_unparseable = 0
+
+    # Columns written to the table: the required columns plus Transaction_Date_EpochDay
+    table_columns = collections_table_columns(required_columns)
+
+    # Create cursor for database operations
+    cursor = conn.cursor()
+
+    # Track stats
+    rows_processed = 0
+    rows_skipped = 0
+    rows_updated = 0
+    rows_inserted = 0
+    # (Policy_No, Transaction_Date) of every row written, for the ingest manifest
+    written_keys = []
+
+    # Process each row in the new collections data
+    for idx, row in new_collections_df.iterrows():
+        # Map CSV columns to required columns
+        mapped_values = {}
+        policy_no_value = None
+        transaction_date_value = None
     
-    for target_col in required_columns:
-        # Try to get the corresponding column from our mapping
-        if target_col in column_mapping:
-            csv_col = column_mapping[target_col]
-            if csv_col in new_collections_df.columns:
-                if target_col == "Policy_No":
-                    policy_no_value = row[csv_col]
-                elif target_col == "Transaction_Date":
-                    value = row[csv_col]
-                    transaction_date_value = value
-                mapped_values[target_col] = row[csv_col]
-            else:
-                mapped_values[target_col] = None
-        else:
-            # Fall back to automatic mapping
-            matching_col = get_matching_column(new_collections_df, target_col)
+        for target_col in required_columns:
+            matching_col = column_map[target_col]
             if matching_col:
                 if target_col == "Policy_No":
                     policy_no_value = row[matching_col]
@@ -172,139 +206,159 @@ for idx, row in new_collections_df.iterrows():
                 mapped_values[target_col] = row[matching_col]
             else:
                 mapped_values[target_col] = None
+
+        # Store the date as ISO text plus its day number, the same as streaming mode
+        transaction_date_value, mapped_values["Transaction_Date_EpochDay"] = normalize_date_value(transaction_date_value)
+        mapped_values["Transaction_Date"] = transaction_date_value
+        if transaction_date_value is not None and mapped_values["Transaction_Date_EpochDay"] is None:
+            dates_unparseable += 1
     
-    # Check transaction type and adjust Premium value
-    transaction_type = mapped_values.get("Transaction_type")
-    premium_value = mapped_values.get("Premium")
+        # Check transaction type and adjust Premium value
+        transaction_type = mapped_values.get("Transaction_type")
+        premium_value = mapped_values.get("Premium")
     
-    if transaction_type is not None and premium_value is not None and not pd.isna(premium_value):
-        # Convert to string, strip whitespace, and convert to lowercase for comparison
-        trans_type_clean = str(transaction_type).strip().lower()
+        if transaction_type is not None and premium_value is not None and not pd.isna(premium_value):
+            # Convert to string, strip whitespace, and convert to lowercase for comparison
+            trans_type_clean = str(transaction_type).strip().lower()
         
-        # Convert Premium to numeric if it's not already
-        if not isinstance(premium_value, (int, float)):
-            try:
-                premium_value = float(premium_value)
-            except (ValueError, TypeError):
-                # If conversion fails, keep original value
-                pass
+            # Convert Premium to numeric if it's not already
+            if not isinstance(premium_value, (int, float)):
+                try:
+                    premium_value = float(premium_value)
+                except (ValueError, TypeError):
+                    # If conversion fails, keep original value
+                    pass
         
-        if isinstance(premium_value, (int, float)):
-            # If transaction type is "accepted", make Premium positive
-            if trans_type_clean == "accepted":
-                mapped_values["Premium"] = abs(premium_value)
-                if premium_value != abs(premium_value):  # Only log if changed
-                    print(f"Row {idx+1}: Transaction type 'accepted' - Premium adjusted to positive: {abs(premium_value)}")
+            if isinstance(premium_value, (int, float)):
+                # If transaction type is "accepted", make Premium positive
+                if trans_type_clean == "accepted":
+                    mapped_values["Premium"] = abs(premium_value)
+                    if premium_value != abs(premium_value):  # Only log if changed
+                        print(f"Row {idx+1}: Transaction type 'accepted' - Premium adjusted to positive: {abs(premium_value)}")
             
-            # If transaction type is "default", make Premium negative
-            elif trans_type_clean == "default":
-                mapped_values["Premium"] = -abs(premium_value)
-                if premium_value != -abs(premium_value):  # Only log if changed
-                    print(f"Row {idx+1}: Transaction type 'default' - Premium adjusted to negative: {-abs(premium_value)}")
-    
-    # Skip if no Policy_No value (we still need this one)
-    if pd.isna(policy_no_value) or str(policy_no_value).strip() == "":
-        print(f"Skipping row {idx+1}: Missing Policy_No (value: {policy_no_value})")
-        rows_skipped += 1
-        continue
-    
-    rows_processed += 1
+                # If transaction type is "default", make Premium negative
+                elif trans_type_clean == "default":
+                    mapped_values["Premium"] = -abs(premium_value)
+                    if premium_value != -abs(premium_value):  # Only log if changed
+                        print(f"Row {idx+1}: Transaction type 'default' - Premium adjusted to negative: {-abs(premium_value)}")
     
-    # Check if the Policy_No and Transaction_Date combination already exists
-    # Use IS NULL for NULL transaction dates
-    if pd.isna(transaction_date_value) or str(transaction_date_value).strip() == "":
-        cursor.execute("""
-            SELECT Policy_No 
-            FROM Collections 
-            WHERE Policy_No = ? AND Transaction_Date IS NULL
-        """, (policy_no_value,))
-        transaction_date_for_query = None
-    else:
-        cursor.execute("""
-            SELECT Policy_No 
-            FROM Collections 
-            WHERE Policy_No = ? AND Transaction_Date = ?
-        """, (policy_no_value, transaction_date_value))
-        transaction_date_for_query = transaction_date_value
+        # Skip if no Policy_No value (we still need this one)
+        if pd.isna(policy_no_value) or str(policy_no_value).strip() == "":
+            print(f"Skipping row {idx+1}: Missing Policy_No (value: {policy_no_value})")
+            rows_skipped += 1
+            continue
     
-    exists = cursor.fetchone() is not None
+        rows_processed += 1
+
+        # Note the change for the report
+        record_changes(conn, [(policy_no_value, None)], "Collections")
+        written_keys.append((policy_no_value, transaction_date_value))
     
-    if exists:
-        # First retrieve the existing record to show what's being updated
+        # Check if the Policy_No and Transaction_Date combination already exists
+        # Use IS NULL for NULL transaction dates
         if pd.isna(transaction_date_value) or str(transaction_date_value).strip() == "":
             cursor.execute("""
-                SELECT * FROM Collections 
+                SELECT Policy_No 
+                FROM Collections 
                 WHERE Policy_No = ? AND Transaction_Date IS NULL
             """, (policy_no_value,))
+            transaction_date_for_query = None
         else:
             cursor.execute("""
-                SELECT * FROM Collections 
+                SELECT Policy_No 
+                FROM Collections 
                 WHERE Policy_No = ? AND Transaction_Date = ?
             """, (policy_no_value, transaction_date_value))
+            transaction_date_for_query = transaction_date_value
+    
+        exists = cursor.fetchone() is not None
+    
+        if exists:
+            # First retrieve the existing record to show what's being updated
+            if pd.isna(transaction_date_value) or str(transaction_date_value).strip() == "":
+                cursor.execute("""
+                    SELECT * FROM Collections 
+                    WHERE Policy_No = ? AND Transaction_Date IS NULL
+                """, (policy_no_value,))
+            else:
+                cursor.execute("""
+                    SELECT * FROM Collections 
+                    WHERE Policy_No = ? AND Transaction_Date = ?
+                """, (policy_no_value, transaction_date_value))
         
-        existing_record = cursor.fetchone()
-        column_names = [description[0] for description in cursor.description]
-        existing_record_dict = dict(zip(column_names, existing_record))
+            existing_record = cursor.fetchone()
+            column_names = [description[0] for description in cursor.description]
+            existing_record_dict = dict(zip(column_names, existing_record))
         
-        # Update existing record
-        set_clauses = []
-        values = []
+            # Update existing record
+            set_clauses = []
+            values = []
         
-        for col in required_columns:
-            if col not in ["Policy_No", "Transaction_Date"]:  # Skip these in the SET clause
-                set_clauses.append(f"{col} = ?")
-                values.append(mapped_values[col])
+            for col in table_columns:
+                if col not in ["Policy_No", "Transaction_Date"]:  # Skip these in the SET clause
+                    set_clauses.append(f"{col} = ?")
+                    values.append(mapped_values[col])
         
-        # Add values for the WHERE clause
-        values.append(policy_no_value)
+            # Add values for the WHERE clause
+            values.append(policy_no_value)
         
-        # Handle NULL in the WHERE clause
-        if pd.isna(transaction_date_value) or str(transaction_date_value).strip() == "":
-            query = f"""
-                UPDATE Collections 
-                SET {', '.join(set_clauses)} 
-                WHERE Policy_No = ? AND Transaction_Date IS NULL
-            """
-        else:
-            query = f"""
-                UPDATE Collections 
-                SET {', '.join(set_clauses)} 
-                WHERE Policy_No = ? AND Transaction_Date = ?
-            """
-            values.append(transaction_date_value)
+            # Handle NULL in the WHERE clause
+            if pd.isna(transaction_date_value) or str(transaction_date_value).strip() == "":
+                query = f"""
+                    UPDATE Collections 
+                    SET {', '.join(set_clauses)} 
+                    WHERE Policy_No = ? AND Transaction_Date IS NULL
+                """
+            else:
+                query = f"""
+                    UPDATE Collections 
+                    SET {', '.join(set_clauses)} 
+                    WHERE Policy_No = ? AND Transaction_Date = ?
+                """
+                values.append(transaction_date_value)
         
-        cursor.execute(query, values)
-        rows_updated += 1
+            cursor.execute(query, values)
+            rows_updated += 1
         
-        if rows_updated <= 5 or rows_updated % 100 == 0:  # Limit output to first 5 and then every 100
-            print(f"\nUpdated record {rows_updated} for Policy_No: {policy_no_value}, Transaction_Date: {transaction_date_value or 'NULL'}")
-            print("  Before update:")
-            for col, val in existing_record_dict.items():
-                print(f"    {col}: {val}")
-            print("  After update:")
-            for col in required_columns:
-                if col in mapped_values:
-                    print(f"    {col}: {mapped_values[col]}")
-    else:
-        # Insert new record
-        columns = ', '.join(required_columns)
-        placeholders = ', '.join(['?' for _ in required_columns])
-        values = [mapped_values[col] for col in required_columns]
+            if rows_updated <= 5 or rows_updated % 100 == 0:  # Limit output to first 5 and then every 100
+                print(f"\nUpdated record {rows_updated} for Policy_No: {policy_no_value}, Transaction_Date: {transaction_date_value or 'NULL'}")
+                print("  Before update:")
+                for col, val in existing_record_dict.items():
+                    print(f"    {col}: {val}")
+                print("  After update:")
+                for col in required_columns:
+                    if col in mapped_values:
+                        print(f"    {col}: {mapped_values[col]}")
+        else:
+            # Insert new record
+            columns = ', '.join(table_columns)
+            placeholders = ', '.join(['?' for _ in table_columns])
+            values = [mapped_values[col] for col in table_columns]
         
-        query = f"INSERT INTO Collections ({columns}) VALUES ({placeholders})"
-        cursor.execute(query, values)
-        rows_inserted += 1
-        if rows_inserted <= 5 or rows_inserted % 100 == 0:  # Limit output to first 5 and then every 100
-            print(f"Inserted new record {rows_inserted} for Policy_No: {policy_no_value}, Transaction_Date: {transaction_date_value or 'NULL'}")
+            query = f"INSERT INTO Collections ({columns}) VALUES ({placeholders})"
+            cursor.execute(query, values)
+            rows_inserted += 1
+            if rows_inserted <= 5 or rows_inserted % 100 == 0:  # Limit output to first 5 and then every 100
+                print(f"Inserted new record {rows_inserted} for Policy_No: {policy_no_value}, Transaction_Date: {transaction_date_value or 'NULL'}")
+
+    # These rows weren't hashed, so the manifest forgets them and the next streaming ingest writes them again
+    forget_rows(conn, "Collections", pd.DataFrame(written_keys, columns=COLLECTIONS_KEY_COLUMNS, dtype=object),
+                COLLECTIONS_KEY_COLUMNS)
 
-# Commit changes and close connection
+# Record the file as ingested, commit everything in one transaction and close connection
+record_file(conn, file_hash, "Collections", csv_file, total_rows)
 conn.commit()
+if parquet_mirror:
+    update_mirror(conn, "Collections", months=None if duplicates_removed else changed_months)
 conn.close()
 
 print("\nSummary:")
-print(f"  Total rows in CSV: {len(new_collections_df)}")
+print(f"  Total rows in CSV: {total_rows}")
 print(f"  Rows processed: {rows_processed}")
 print(f"  Rows skipped: {rows_skipped}")
+print(f"  Rows unchanged since last ingest: {rows_unchanged}")
 print(f"  Records updated: {rows_updated}")
 print(f"  Records inserted: {rows_inserted}")
+if dates_unparseable:
+    print(f"  WARNING: {dates_unparseable} Transaction_Date values could not be read as dates and were kept as text")
 print("\nData successfully inserted/updated in the Collections table!")
\ No newline at end of file
@@ -13,7 +13,7 @@ Steps:
 6. Commits the changes to the database and closes the connection.
 
 Dependencies:
-- sqlite3 (built into Python)
+- sqlite3 (built into Python), opened through database.py in WAL mode
 - pandas (for handling the CSV file)
 
 Notes:
@@ -22,16 +22,64 @@ Notes:
 - New records are added without affecting existing ones
 - Leading and trailing whitespace is removed from column headings
 - Only columns required by report_active_policies.py are used
+- CSV columns are matched to the table columns with the shared resolver in column_resolver.py
+- With bulk_mode = True (the default) the whole file is bulk-loaded into a temporary staging table
+  and merged into Policies with set-based SQL (insert new fcertificates, update changed ones),
+  all in a single transaction (see policies_ingest.py).
+  Set bulk_mode = False to use the original row-by-row path, which prints a line for every row.
+- Ingested files and rows are recorded in an ingest manifest in policies.db (see ingest_manifest.py).
+  Running the script again on the same file does nothing, and on an overlapping file only new or
+  changed rows are written (in bulk mode).
+- FirstCollectionDate and InceptionDate are stored as ISO text plus integer <column>_EpochDay
+  columns (see date_columns.py). Databases created before that are migrated the first time this runs.
+- After the table is written, the Parquet copy of it used for analysis is refreshed
+  (see parquet_mirror.py). Set parquet_mirror = False to skip that.
+- The fcertificates that were inserted or changed are written to the change log (see change_log.py),
+  so the next report only works out the status of their main policies again.
 """
 
-import sqlite3
+import sys
 import pandas as pd
+from database import connect
+from change_log import record_changes, record_full_rebuild
+from column_resolver import print_column_plan, resolve_column_plan
+from date_columns import (
+    DATE_COLUMNS, ensure_date_columns, epoch_day_column, normalize_date_columns, normalize_date_value,
+    with_epoch_day_columns
+)
+from parquet_mirror import update_mirror
+from ingest_manifest import file_content_hash, filter_changed_rows, forget_rows, is_file_ingested, record_file, record_rows
+from policies_ingest import MANDATORY_POLICY_COLUMNS, build_policies_batch, merge_policies
+
+csv_file = 'Sales File 5th May.csv'
+
+# Use the set-based bulk upsert instead of one SELECT and UPDATE/INSERT per row
+bulk_mode = True
+
+# Refresh the Parquet copy of the Policies table after the ingest (needs pyarrow)
+parquet_mirror = True
 
 # Connect to SQLite database
-conn = sqlite3.connect('policies.db')
+conn = connect('policies.db')
+
+# Databases created before dates were normalized get their date columns migrated in place
+dates_migrated = ensure_date_columns(conn, "Policies")
+if dates_migrated:
+    # Every stored date has been rewritten, so no stored report status can be trusted
+    record_full_rebuild(conn, "Policies")
+conn.commit()
+if dates_migrated:
+    print(f"Normalized the dates of {dates_migrated} existing Policies rows")
+
+# Nothing to do if exactly this file has already been ingested
+file_hash = file_content_hash(csv_file)
+if is_file_ingested(conn, file_hash, "Policies"):
+    print(f"'{csv_file}' has already been ingested into the Policies table - nothing to do.")
+    conn.close()
+    sys.exit(0)
 
 # Load the new sales data from CSV
-new_sales_df = pd.read_csv('Sales File 5th May.csv')
+new_sales_df = pd.read_csv(csv_file)
 
 # Clean column names by removing leading/trailing whitespace
 original_columns = new_sales_df.columns.tolist()
@@ -64,95 +112,117 @@ required_columns = [
     "PayAtReference"
 ]
 
+# Columns written to the table: the required columns plus the day number of each date column
+table_columns = with_epoch_day_columns(required_columns, DATE_COLUMNS["Policies"])
+
 print("\nRequired columns for report_active_policies.py:")
 for col in required_columns:
     print(f"  '{col}'")
 
-# Function to map CSV columns to required columns (case-insensitive and ignoring whitespace)
-def get_matching_column(df, target_col):
-    # Remove the type definition from the target column
-    clean_target = target_col.split()[0] if ' ' in target_col else target_col
-    
-    # First check for exact match after whitespace stripping
-    if clean_target in df.columns:
-        return clean_target
-    
-    # Handle underscore vs space (Status_Name vs Status Name)
-    space_version = clean_target.replace('_', ' ')
-    underscore_version = clean_target.replace(' ', '_')
-    
-    for col in df.columns:
-        if col == space_version or col == underscore_version:
-            return col
-    
-    # Then try case-insensitive match
-    for col in df.columns:
-        if col.lower() == clean_target.lower():
-            return col
-        if col.lower() == space_version.lower():
-            return col
-        if col.lower() == underscore_version.lower():
-            return col
-    
-    # If no match, return None
-    return None
+# Work out which CSV column supplies each required column, once for the whole file
+column_map = resolve_column_plan(new_sales_df.columns, required_columns, mandatory_columns=MANDATORY_POLICY_COLUMNS)
+print_column_plan(column_map)
 
 # Create cursor for database operations
 cursor = conn.cursor()
 
-# Process each row in the new sales data
-for _, row in new_sales_df.iterrows():
-    # Map CSV columns to required columns
-    mapped_values = {}
-    fcertificate_value = None
+if bulk_mode:
+    batch_df = build_policies_batch(new_sales_df, column_map, required_columns)
+    rows_skipped = len(new_sales_df) - len(batch_df)
+    if rows_skipped:
+        print(f"Skipping {rows_skipped} rows: No fcertificate value found")
+
+    # Parse the dates once, storing ISO text plus day numbers
+    batch_df, dates_unparseable = normalize_date_columns(batch_df, DATE_COLUMNS["Policies"])
+    if dates_unparseable:
+        print(f"WARNING: {dates_unparseable} date values could not be read as dates and were kept as text")
+
+    # Only write rows that are new or have changed since they were last ingested
+    batch_df, row_keys, row_hashes, rows_unchanged = filter_changed_rows(conn, "Policies", batch_df, ["fcertificate"])
+
+    # Stage the batch and merge it into Policies; committed together with the manifest below
+    rows_inserted, rows_updated, rows_identical = merge_policies(conn, batch_df, required_columns)
+    rows_unchanged += rows_identical
+    record_rows(conn, "Policies", row_keys, row_hashes)
+
+    print("\nSummary:")
+    print(f"  Total rows in CSV: {len(new_sales_df)}")
+    print(f"  Rows skipped: {rows_skipped}")
+    print(f"  Rows unchanged since last ingest: {rows_unchanged}")
+    print(f"  Records updated: {rows_updated}")
+    print(f"  Records inserted: {rows_inserted}")
+else:
+    # fcertificate of every row written, for the ingest manifest
+    written_fcertificates = []
+
+    # Process each row in the new sales data
+    for _, row in new_sales_df.iterrows():
+        # Map CSV columns to required columns
+        mapped_values = {}
+        fcertificate_value = None
     
-    for target_col in required_columns:
-        matching_col = get_matching_column(new_sales_df, target_col)
+        for target_col in required_columns:
+            matching_col = column_map[target_col]
         
-        if matching_col:
-            if target_col == "fcertificate":
-                fcertificate_value = row[matching_col]
-            mapped_values[target_col] = row[matching_col]
-        else:
-            mapped_values[target_col] = None
+            if matching_col:
+                if target_col == "fcertificate":
+                    fcertificate_value = row[matching_col]
+                mapped_values[target_col] = row[matching_col]
+            else:
+                mapped_values[target_col] = None
     
-    # Skip if no fcertificate value
-    if not fcertificate_value:
-        print(f"Skipping row: No fcertificate value found")
-        continue
+        # Store the dates as ISO text plus their day numbers, the same as bulk mode
+        for date_col in DATE_COLUMNS["Policies"]:
+            mapped_values[date_col], mapped_values[epoch_day_column(date_col)] = normalize_date_value(mapped_values[date_col])
+
+        # Skip if no fcertificate value
+        if not fcertificate_value:
+            print(f"Skipping row: No fcertificate value found")
+            continue
     
-    # Check if the fcertificate already exists
-    cursor.execute("SELECT fcertificate FROM Policies WHERE fcertificate = ?", (fcertificate_value,))
-    exists = cursor.fetchone() is not None
+        # Check if the fcertificate already exists
+        cursor.execute("SELECT TransactionNo FROM Policies WHERE fcertificate = ?", (fcertificate_value,))
+        existing = cursor.fetchone()
+        exists = existing is not None
+
+        # Note the change (and the main policy it belonged to) for the report
+        record_changes(conn, [(fcertificate_value, existing[0] if exists else None)], "Policies")
+        written_fcertificates.append(fcertificate_value)
     
-    if exists:
-        # Update existing record
-        set_clauses = []
-        values = []
+        if exists:
+            # Update existing record
+            set_clauses = []
+            values = []
         
-        for col in required_columns:
-            if col != "fcertificate":  # Skip fcertificate in the SET clause
-                set_clauses.append(f"{col} = ?")
-                values.append(mapped_values[col])
+            for col in table_columns:
+                if col != "fcertificate":  # Skip fcertificate in the SET clause
+                    set_clauses.append(f"{col} = ?")
+                    values.append(mapped_values[col])
         
-        # Add fcertificate value at the end for the WHERE clause
-        values.append(fcertificate_value)
+            # Add fcertificate value at the end for the WHERE clause
+            values.append(fcertificate_value)
         
-        query = f"UPDATE Policies SET {', '.join(set_clauses)} WHERE fcertificate = ?"
-        cursor.execute(query, values)
-        print(f"Updated record for fcertificate: {fcertificate_value}")
-    else:
-        # Insert new record
-        columns = ', '.join(required_columns)
-        placeholders = ', '.join(['?' for _ in required_columns])
-        values = [mapped_values[col] for col in required_columns]
+            query = f"UPDATE Policies SET {', '.join(set_clauses)} WHERE fcertificate = ?"
+            cursor.execute(query, values)
+            print(f"Updated record for fcertificate: {fcertificate_value}")
+        else:
+            # Insert new record
+            columns = ', '.join(table_columns)
+            placeholders = ', '.join(['?' for _ in table_columns])
+            values = [mapped_values[col] for col in table_columns]
         
-        query = f"INSERT INTO Policies ({columns}) VALUES ({placeholders})"
-        cursor.execute(query, values)
-        print(f"Inserted new record for fcertificate: {fcertificate_value}")
+            query = f"INSERT INTO Policies ({columns}) VALUES ({placeholders})"
+            cursor.execute(query, values)
+            print(f"Inserted new record for fcertificate: {fcertificate_value}")
+
+    # These rows weren't hashed, so the manifest forgets them and the next bulk ingest writes them again
+    forget_rows(conn, "Policies", pd.DataFrame({"fcertificate": written_fcertificates}, dtype=object), ["fcertificate"])
 
-# Commit changes and close connection
+# Record the file as ingested, commit everything in one transaction and close connection
+record_file(conn, file_hash, "Policies", csv_file, len(new_sales_df))
 conn.commit()
+if parquet_mirror:
+    update_mirror(conn, "Policies")
 conn.close()
 
 print("\nData successfully inserted/updated in the Policies table!")
\ No newline at end of file
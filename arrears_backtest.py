@@ -0,0 +1,99 @@
+"""
+This script works out the arrears position of the active policies as of several dates at once,
+for example every month-end of the past two years, to see how arrears develop over time.
+
+Steps:
+1. Loads the active policies and all of their collections from policies.db once.
+2. Works out the status of every main policy as of each date with the same rules as
+   report_active_policies.py (see status_engine.evaluate_as_of_dates). The collections are
+   sorted and added up once for all the dates, instead of running the report once per date.
+3. Saves one long-format table with a row per main policy and as-of date (TransactionNo,
+   As Of Date, Up to Date, Amount due, Next Payment Due, Next Collection Already Paid,
+   Payment Method), and prints the number of main policies in arrears and the total amount
+   due for each date.
+
+Usage:
+    python3 arrears_backtest.py --month-ends 24
+    python3 arrears_backtest.py --month-ends 12 --until 2025-05-30 --output arrears_2024.csv
+    python3 arrears_backtest.py --as-of 2025-03-31 2025-04-30 2025-05-30
+
+Dependencies:
+- sqlite3 (built into Python), opened through database.py in WAL mode
+- pandas and numpy
+
+Notes:
+- The statuses are worked out from the data as it is now: only policies that are active now are
+  included, and collections loaded after an as-of date but dated before it count.
+- Policies whose first period starts after an as-of date come out as up to date, as in the report.
+"""
+
+import argparse
+
+import pandas as pd
+from database import DEFAULT_DB_PATH, begin_read_snapshot, connect
+from period_calendar import calendar_cache
+from status_engine import evaluate_as_of_dates, load_active_portfolio
+
+# Where the table is saved unless --output is given
+DEFAULT_OUTPUT_FILE = "arrears_backtest.csv"
+
+
+def month_ends(count, until):
+    """The last count month-ends on or before until, oldest first."""
+    return list(pd.date_range(end=pd.Timestamp(until).normalize(), periods=count, freq="ME"))
+
+
+def arrears_history(conn, as_of_dates):
+    """
+    Status of every active main policy as of each date.
+
+    Args:
+        conn: sqlite3 connection to policies.db
+        as_of_dates (list): dates to work the statuses out for
+
+    Returns:
+        DataFrame: one row per (TransactionNo, As Of Date), see status_engine.evaluate_as_of_dates
+    """
+    # Read everything from one consistent snapshot, even if an ingest commits meanwhile
+    begin_read_snapshot(conn)
+    policies, transactions = load_active_portfolio(conn)
+    main_policy_nos = policies["TransactionNo"].unique().tolist()
+    return evaluate_as_of_dates(policies, transactions, main_policy_nos, sorted(pd.Timestamp(date) for date in as_of_dates))
+
+
+def print_arrears_summary(history):
+    """Number of main policies in arrears and total amount due for each as-of date."""
+    in_arrears = history[history["Up to Date"] == False]
+    summary = pd.DataFrame({
+        "Main Policies": history.groupby("As Of Date").size(),
+        "In Arrears": in_arrears.groupby("As Of Date").size(),
+        "Total Amount Due": pd.to_numeric(in_arrears["Amount due"], errors="coerce").groupby(in_arrears["As Of Date"]).sum(),
+    }).fillna(0)
+    summary["In Arrears"] = summary["In Arrears"].astype(int)
+    print(summary.to_string())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Arrears position of the active policies as of several dates.")
+    dates = parser.add_mutually_exclusive_group(required=True)
+    dates.add_argument("--as-of", nargs="+", help="as-of dates, e.g. 2025-04-30 2025-05-30")
+    dates.add_argument("--month-ends", type=int, help="use this many month-ends, up to --until")
+    parser.add_argument("--until", default=None, help="last date for --month-ends (default: today)")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite database to read")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_FILE, help="CSV file to save the table to")
+    args = parser.parse_args()
+
+    if args.as_of:
+        as_of_dates = args.as_of
+    else:
+        as_of_dates = month_ends(args.month_ends, args.until or pd.Timestamp.today())
+
+    conn = connect(args.db)
+    history = arrears_history(conn, as_of_dates)
+    conn.close()
+
+    history.to_csv(args.output, index=False)
+    print(f"Saved {len(history)} rows for {history['As Of Date'].nunique()} as-of dates to {args.output}")
+    print_arrears_summary(history)
+    cache_stats = calendar_cache.stats()
+    print(f"Period calendar cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
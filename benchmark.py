@@ -0,0 +1,187 @@
+"""
+This script times the ingest scripts and the report on synthetic portfolios of different sizes
+(see synthetic_data.py), and saves the results as JSON so that versions can be compared.
+
+Steps:
+1. For each size (number of sub-policies), writes the synthetic CSV files to a folder of their own.
+2. Runs the scripts there one after the other, the way they are used, each in its own process:
+   create_policies_table.py, create_collections_table.py, add_new_sales.py,
+   add_new_collections.py, then report_active_policies.py twice (the second time most statuses
+   are reused from policy_status_summary.db).
+3. Records the time and peak memory of every step and saves everything, with the versions of
+   Python, pandas and numpy and the git commit of this folder, to the JSON file.
+4. With --compare, prints how much faster or slower each step got compared to an earlier file.
+
+Usage:
+    python3 benchmark.py                                  (10k, 100k and 1M sub-policies)
+    python3 benchmark.py --sizes 10000 100000 --output after.json --compare before.json
+
+Dependencies:
+- numpy, pandas (for synthetic_data.py)
+- subprocess, json (built into Python)
+
+Notes:
+- Each step's output goes to <step>.log in the size's folder. If a step fails, the later
+  steps of that size are skipped.
+- The data is generated in a process of its own too, and this script doesn't import pandas:
+  on Linux a process's peak memory includes the memory of the process that started it, so
+  this one is kept small.
+- The 1M run needs several GB of disk space and takes a while. The folders are deleted
+  afterwards unless --keep-data is given.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from importlib.metadata import PackageNotFoundError, version
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_OUTPUT_FILE = "benchmark_results.json"
+DEFAULT_WORK_DIR = "benchmark_runs"
+
+# Version of the layout of the JSON file
+RESULTS_FORMAT = 1
+
+# (step name, script) in the order they are run
+STEPS = [
+    ("create_policies_table", "create_policies_table.py"),
+    ("create_collections_table", "create_collections_table.py"),
+    ("add_new_sales", "add_new_sales.py"),
+    ("add_new_collections", "add_new_collections.py"),
+    ("report", "report_active_policies.py"),
+    ("report_rerun", "report_active_policies.py"),
+]
+
+# Folder with the scripts (this file's folder)
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def package_version(package):
+    """Installed version of a package (without importing it), or None if it isn't installed."""
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def git_commit():
+    """Commit of the scripts being timed, or None if it can't be found."""
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run_step(script, work_dir, log_file, arguments=()):
+    """
+    Run one script in work_dir and time it.
+
+    Returns:
+        dict: seconds, peak_rss_mb (None where the system can't tell) and exit_code
+    """
+    with open(log_file, "w") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script), *arguments], cwd=work_dir,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            # wait4 gives the resource use of this process alone
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+            peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        else:
+            process.wait()
+            peak_rss_mb = None
+        seconds = time.perf_counter() - started
+    return {"seconds": round(seconds, 3), "peak_rss_mb": None if peak_rss_mb is None else round(peak_rss_mb, 1),
+            "exit_code": process.returncode}
+
+
+def benchmark_size(n_policies, work_dir, seed=0):
+    """Generate the data for one size and time every step on it."""
+    size_dir = os.path.join(work_dir, f"policies_{n_policies}")
+    shutil.rmtree(size_dir, ignore_errors=True)
+    os.makedirs(size_dir)
+
+    log_file = os.path.join(size_dir, "generate.log")
+    generated = run_step("synthetic_data.py", size_dir, log_file, ["--policies", str(n_policies), "--seed", str(seed), "--json"])
+    result = {"policies": n_policies, "seed": seed, "generate_seconds": generated["seconds"], "files": {}, "steps": []}
+    if generated["exit_code"] != 0:
+        print(f"{n_policies} sub-policies: generating the data failed, see generate.log - skipping this size")
+        return result, size_dir
+    with open(log_file) as f:
+        rows = json.loads(f.read().splitlines()[-1])
+    result["files"] = {csv_file: {"rows": count, "bytes": os.path.getsize(os.path.join(size_dir, csv_file))}
+                       for csv_file, count in rows.items()}
+    print(f"{n_policies} sub-policies: data written in {result['generate_seconds']:.1f}s")
+
+    for step, script in STEPS:
+        timing = run_step(script, size_dir, os.path.join(size_dir, f"{step}.log"))
+        result["steps"].append({"step": step, **timing})
+        peak = "" if timing["peak_rss_mb"] is None else f", peak memory {timing['peak_rss_mb']:.0f} MB"
+        print(f"  {step}: {timing['seconds']:.2f}s{peak}")
+        if timing["exit_code"] != 0:
+            print(f"  {step} failed (exit code {timing['exit_code']}), see {step}.log - skipping the rest of this size")
+            break
+    return result, size_dir
+
+
+def compare_results(old, new):
+    """Print the time of each step in both result files and the ratio (above 1 = slower now)."""
+    old_times = {(run["policies"], step["step"]): step["seconds"] for run in old["runs"] for step in run["steps"]}
+    lines = []
+    for run in new["runs"]:
+        for step in run["steps"]:
+            before = old_times.get((run["policies"], step["step"]))
+            if before:
+                lines.append((run["policies"], step["step"], before, step["seconds"], step["seconds"] / before))
+    if not lines:
+        print("Nothing to compare: no step was timed at the same size in both files")
+        return
+    print(f"\nCompared with {old.get('git_commit') or 'the earlier results'}:")
+    print(f"{'Policies':>10}  {'Step':<26}{'Before (s)':>11}{'Now (s)':>10}{'Ratio':>8}")
+    for policies, step, before, now, ratio in lines:
+        print(f"{policies:>10}  {step:<26}{before:>11.2f}{now:>10.2f}{ratio:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the ingest scripts and the report on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of sub-policies to try")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_FILE, help="JSON file to save the results to")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR, help="folder for the generated data and databases")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument("--keep-data", action="store_true", help="keep the generated files and databases")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    results = {
+        "format": RESULTS_FORMAT,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": package_version("pandas"),
+        "numpy": package_version("numpy"),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "runs": [],
+    }
+    for n_policies in args.sizes:
+        run, size_dir = benchmark_size(n_policies, args.work_dir, args.seed)
+        results["runs"].append(run)
+        # Save after every size, so a long run that is stopped still leaves its results
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        if not args.keep_data:
+            shutil.rmtree(size_dir, ignore_errors=True)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
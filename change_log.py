@@ -0,0 +1,108 @@
+"""
+Change log stored in policies.db: which policies each ingest touched, so that
+report_active_policies.py only has to work out again the status of those policies.
+
+Every ingest adds a row to the PolicyChanges table for each sub-policy (fcertificate) it inserted
+or changed, in Policies or in Collections. For sales, the main policy (TransactionNo) the
+sub-policy belonged to before the change is kept as well, so that a sub-policy moving to another
+main policy marks both of them. Scripts that rebuild a whole table add one row without an
+fcertificate, which means "everything changed".
+
+The rows are numbered (change_id) in the order they were written. The report remembers the last
+number it has seen and asks for everything after it (see changes_since).
+
+The log is written in the same transaction as the data, so the two always agree.
+
+Dependencies:
+- sqlite3 (built into Python)
+- datetime (built into Python)
+"""
+
+from datetime import datetime
+
+CHANGE_LOG_TABLE = "PolicyChanges"
+
+
+def ensure_change_log(conn):
+    """Create the PolicyChanges table if it doesn't exist yet."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fcertificate TEXT,
+            TransactionNo TEXT,
+            source_table TEXT,
+            changed_at TEXT
+        )
+    """)
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def record_changes(conn, changes, source_table):
+    """
+    Record changed sub-policies (the caller commits).
+
+    Args:
+        conn: sqlite3 connection to policies.db
+        changes (list): (fcertificate, TransactionNo before the change or None) pairs
+        source_table (str): table that was changed ('Policies' or 'Collections')
+    """
+    ensure_change_log(conn)
+    changed_at = _now()
+    conn.executemany(
+        f"INSERT INTO {CHANGE_LOG_TABLE} (fcertificate, TransactionNo, source_table, changed_at) VALUES (?, ?, ?, ?)",
+        [(fcertificate, transaction_no, source_table, changed_at) for fcertificate, transaction_no in changes]
+    )
+
+
+def record_changes_sql(conn, select_sql, params, source_table):
+    """
+    Record the changed sub-policies returned by a query with two columns, fcertificate and
+    TransactionNo before the change (the caller commits).
+    """
+    ensure_change_log(conn)
+    conn.execute(f"""
+        INSERT INTO {CHANGE_LOG_TABLE} (fcertificate, TransactionNo, source_table, changed_at)
+        SELECT changed.*, ?, ? FROM ({select_sql}) AS changed
+    """, [source_table, _now()] + list(params))
+
+
+def record_full_rebuild(conn, source_table):
+    """Record that a whole table was rebuilt, so every policy has to be worked out again (the caller commits)."""
+    record_changes(conn, [(None, None)], source_table)
+
+
+def latest_change_id(conn):
+    """Number of the last change recorded (0 if nothing has been recorded)."""
+    ensure_change_log(conn)
+    return conn.execute(f"SELECT IFNULL(MAX(change_id), 0) FROM {CHANGE_LOG_TABLE}").fetchone()[0]
+
+
+def changes_since(conn, change_id, up_to_change_id):
+    """
+    The main policies touched by the changes after change_id, up to and including up_to_change_id.
+    A changed sub-policy marks the main policy it belonged to before the change and the one it
+    belongs to now.
+
+    Returns:
+        set: TransactionNo values, or None if a table was rebuilt (everything changed)
+    """
+    ensure_change_log(conn)
+    cursor = conn.execute(f"""
+        SELECT 1 FROM {CHANGE_LOG_TABLE}
+        WHERE change_id > ? AND change_id <= ? AND fcertificate IS NULL
+        LIMIT 1
+    """, (change_id, up_to_change_id))
+    if cursor.fetchone() is not None:
+        return None
+
+    cursor = conn.execute(f"""
+        SELECT c.TransactionNo FROM {CHANGE_LOG_TABLE} c
+        WHERE c.change_id > ? AND c.change_id <= ? AND c.TransactionNo IS NOT NULL
+        UNION
+        SELECT p.TransactionNo FROM {CHANGE_LOG_TABLE} c JOIN Policies p ON p.fcertificate = c.fcertificate
+        WHERE c.change_id > ? AND c.change_id <= ? AND p.TransactionNo IS NOT NULL
+    """, (change_id, up_to_change_id, change_id, up_to_change_id))
+    return {row[0] for row in cursor.fetchall()}
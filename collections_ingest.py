@@ -0,0 +1,381 @@
+"""
+Streaming helpers for loading collections (CPS) data into the 'Collections' table of policies.db.
+
+Loading a full CPS export with pd.read_csv and then building a list of dicts keeps several
+copies of the file in memory at once. The functions here instead:
+1. Read the CSV in bounded chunks (only the columns that are needed).
+2. Map each chunk to the Collections columns and fix the sign of Premium by Transaction_type
+   (rows with an unknown Transaction_type are written to a quarantine CSV instead).
+3. Hand each chunk to a writer function: add_new_collections.py loads it into a temporary
+   staging table, create_collections_table.py appends it to the new table.
+
+Pandas only ever holds one chunk, so its memory use depends on the chunk size, not on the size
+of the file. The staging table is written to a temporary file rather than kept in memory (see
+temp_store in database.py), so it doesn't grow with the file either.
+
+The Collections table has a unique key on (Policy_No, Transaction_Date) (see ensure_collections_key).
+Once the whole file is staged it is merged into Collections with set-based SQL (insert new keys,
+update changed rows), and the caller commits everything in a single transaction.
+
+Transaction_Date is stored as ISO text plus a Transaction_Date_EpochDay day number (see date_columns.py).
+
+Dependencies:
+- sqlite3 (built into Python)
+- pandas (for reading the CSV in chunks)
+"""
+
+import os
+import pandas as pd
+from change_log import record_full_rebuild
+from date_columns import (
+    DATE_COLUMNS, ensure_date_columns, missing_epoch_day_columns, normalize_date_columns, with_epoch_day_columns
+)
+from ingest_manifest import filter_changed_rows, record_rows
+from policies_ingest import (
+    batch_rows, create_staging_table, load_staging_table, merge_staging_table, record_staged_changes
+)
+
+# Columns of the Collections table needed by report_active_policies.py
+COLLECTION_COLUMNS = [
+    "Transaction_Date",
+    "Premium",
+    "Transaction_type",
+    "Payment_Method",
+    "Policy_No"
+]
+
+# Columns that must be present in a CPS CSV; the others are left empty if they can't be found
+MANDATORY_COLLECTION_COLUMNS = [
+    "Transaction_Date",
+    "Premium",
+    "Transaction_type",
+    "Policy_No"
+]
+
+# Manual mapping for specific columns we know need special handling in the CPS exports
+COLLECTIONS_COLUMN_MAPPING = {
+    "Transaction_Date": "Transaction Date",
+    "Premium": "Premium",
+    "Transaction_type": "Transaction Type",
+    "Payment_Method": "Payment Method",
+    "Policy_No": "Policy No"
+}
+
+# Number of CSV rows read and written at a time
+DEFAULT_CHUNK_SIZE = 50000
+
+# Transaction types whose Premium sign is normalized. Rows with any other (or an empty)
+# Transaction_type are not written to the database but go to a quarantine CSV instead.
+KNOWN_TRANSACTION_TYPES = ["accepted", "default"]
+
+# Unique key of the Collections table: one row per (Policy_No, Transaction_Date), where all
+# empty Transaction_Date values count as the same date
+COLLECTIONS_KEY_COLUMNS = ["Policy_No", "Transaction_Date"]
+COLLECTIONS_KEY_INDEX = "idx_collections_policy_date"
+COLLECTIONS_KEY_DATE = "IFNULL(Transaction_Date, '')"
+
+# Index for looking up a policy's transactions in a date range by day number
+COLLECTIONS_DATE_INDEX = "idx_collections_policy_epoch_day"
+
+# Temporary table each chunk is loaded into before the whole file is merged into Collections
+COLLECTIONS_STAGING_TABLE = "staging_collections"
+
+
+def read_clean_header(csv_file):
+    """Read only the header of the CSV and return (raw column names, cleaned column names)."""
+    raw_columns = pd.read_csv(csv_file, nrows=0).columns.tolist()
+    return raw_columns, [col.strip() for col in raw_columns]
+
+
+def map_collections_chunk(chunk, column_map, required_columns=COLLECTION_COLUMNS):
+    """
+    Map a chunk of CSV data (with cleaned column names) to the Collections columns.
+
+    Args:
+        chunk (DataFrame): CSV rows with cleaned column names
+        column_map (dict): required column -> matching CSV column (or None if not found)
+
+    Returns:
+        DataFrame: columns in required_columns order, None where no CSV column was found
+    """
+    mapped = pd.DataFrame(index=chunk.index)
+    for target_col in required_columns:
+        csv_col = column_map.get(target_col)
+        if csv_col is not None:
+            mapped[target_col] = chunk[csv_col]
+        else:
+            mapped[target_col] = None
+    return mapped
+
+
+def normalize_premium_signs(df, known_types=KNOWN_TRANSACTION_TYPES):
+    """
+    Make Premium positive for 'accepted' transactions and negative for 'default' transactions.
+
+    Works on the whole DataFrame (or chunk) at once. Transaction types are compared after stripping
+    whitespace and lower-casing. Premium values that cannot be converted to a number are left as they are.
+
+    Returns:
+        tuple: (rows with a known transaction type, Premium fixed,
+                rows with an unknown or empty transaction type, to be quarantined,
+                dict of transaction type -> number of rows whose Premium sign was changed)
+    """
+    trans_type_clean = df["Transaction_type"].astype(str).str.strip().str.lower()
+    known = df["Transaction_type"].notna() & trans_type_clean.isin(known_types)
+    quarantined = df[~known]
+    df = df[known].copy()
+    trans_type_clean = trans_type_clean[known]
+
+    premium_numeric = pd.to_numeric(df["Premium"], errors="coerce")
+    accepted = (trans_type_clean == "accepted") & premium_numeric.notna()
+    default = (trans_type_clean == "default") & premium_numeric.notna()
+
+    adjusted_counts = {
+        "accepted": int((accepted & (premium_numeric < 0)).sum()),
+        "default": int((default & (premium_numeric > 0)).sum())
+    }
+
+    if accepted.any() or default.any():
+        premium = df["Premium"].astype(object)
+        premium[accepted] = premium_numeric[accepted].abs()
+        premium[default] = -premium_numeric[default].abs()
+        df["Premium"] = premium
+    return df, quarantined, adjusted_counts
+
+
+def write_quarantine(quarantined, quarantine_file, first_write):
+    """
+    Append quarantined rows (with their 1-based row number in the source CSV) to the quarantine CSV.
+    The file is replaced on the first write of a run.
+    """
+    out = quarantined.copy()
+    out.insert(0, "Source_Row", out.index + 1)
+    out.to_csv(quarantine_file, mode="w" if first_write else "a", header=first_write, index=False)
+
+
+def default_quarantine_file(csv_file):
+    """Name of the quarantine CSV for a collections CSV, e.g. 'quarantine_April to 3 May CPS.csv'."""
+    return f"quarantine_{os.path.basename(csv_file)}"
+
+
+def drop_rows_without_policy_no(df):
+    """Remove rows with an empty Policy_No. Returns (remaining rows, number of rows removed)."""
+    policy_no = df["Policy_No"]
+    missing = policy_no.isna() | (policy_no.astype(str).str.strip() == "")
+    return df[~missing], int(missing.sum())
+
+
+def collections_table_columns(required_columns=COLLECTION_COLUMNS):
+    """Columns written to the Collections table: the CSV columns plus Transaction_Date_EpochDay."""
+    return with_epoch_day_columns(required_columns, DATE_COLUMNS["Collections"])
+
+
+def normalize_collections_dates(chunk):
+    """Store Transaction_Date as ISO text plus its day number. Returns (chunk, unparseable dates)."""
+    return normalize_date_columns(chunk, DATE_COLUMNS["Collections"])
+
+
+def insert_collections_chunk(conn, chunk, required_columns=COLLECTION_COLUMNS):
+    """Append a chunk (with normalized dates) to the Collections table (the caller commits)."""
+    table_columns = collections_table_columns(required_columns)
+    columns = ', '.join(table_columns)
+    placeholders = ', '.join(['?' for _ in table_columns])
+    conn.executemany(
+        f"INSERT INTO Collections ({columns}) VALUES ({placeholders})",
+        batch_rows(chunk[table_columns])
+    )
+    return {"inserted": len(chunk)}
+
+
+def ensure_collections_key(conn):
+    """
+    Make sure the Collections table has its unique key on (Policy_No, Transaction_Date).
+
+    SQLite treats NULLs as different from each other in a unique index, so the key is built on
+    IFNULL(Transaction_Date, '') to make rows with an empty Transaction_Date collide as well.
+    This also migrates existing databases in place: if the index is missing, duplicate
+    (Policy_No, Transaction_Date) rows are removed first, keeping the most recently written one
+    (the same row the row-by-row update would have left behind).
+
+    Databases from before dates were normalized get their Transaction_Date values rewritten as
+    ISO text (see date_columns.py). Two rows whose dates were written in different formats can
+    then have the same key, so the key is rebuilt after that migration.
+
+    Returns:
+        int: number of duplicate rows removed (0 if the key already existed)
+    """
+    cursor = conn.cursor()
+    with conn:
+        if missing_epoch_day_columns(conn, "Collections"):
+            cursor.execute(f"DROP INDEX IF EXISTS {COLLECTIONS_KEY_INDEX}")
+            ensure_date_columns(conn, "Collections")
+            # Every stored date has been rewritten, so no stored report status can be trusted
+            record_full_rebuild(conn, "Collections")
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {COLLECTIONS_DATE_INDEX}
+            ON Collections (Policy_No, Transaction_Date_EpochDay)
+        """)
+
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+            (COLLECTIONS_KEY_INDEX,)
+        )
+        if cursor.fetchone() is not None:
+            return 0
+
+        cursor.execute(f"""
+            DELETE FROM Collections
+            WHERE Policy_No IS NOT NULL
+              AND rowid NOT IN (
+                  SELECT MAX(rowid) FROM Collections
+                  WHERE Policy_No IS NOT NULL
+                  GROUP BY Policy_No, {COLLECTIONS_KEY_DATE}
+              )
+        """)
+        duplicates_removed = cursor.rowcount
+        cursor.execute(f"""
+            CREATE UNIQUE INDEX {COLLECTIONS_KEY_INDEX}
+            ON Collections (Policy_No, {COLLECTIONS_KEY_DATE})
+        """)
+        if duplicates_removed:
+            record_full_rebuild(conn, "Collections")
+    return duplicates_removed
+
+
+def create_collections_staging(conn, required_columns=COLLECTION_COLUMNS):
+    """Create the empty temporary staging table that chunks are loaded into before merging."""
+    create_staging_table(conn, COLLECTIONS_STAGING_TABLE, "Collections", collections_table_columns(required_columns),
+                         COLLECTIONS_KEY_COLUMNS, null_as_empty=["Transaction_Date"])
+
+
+def stage_collections_chunk(conn, chunk, required_columns=COLLECTION_COLUMNS):
+    """Bulk-load a chunk (with normalized dates) into the staging table (the caller commits, after merging)."""
+    load_staging_table(conn, COLLECTIONS_STAGING_TABLE, chunk, collections_table_columns(required_columns))
+    return {"staged": len(chunk)}
+
+
+def merge_collections_staging(conn, required_columns=COLLECTION_COLUMNS):
+    """
+    Merge the staging table into Collections with set-based SQL: insert new
+    (Policy_No, Transaction_Date) keys and update rows whose values changed. The policies of
+    those rows are added to the change log. Does not commit.
+
+    Returns:
+        tuple: (rows inserted, rows updated, rows unchanged)
+    """
+    record_staged_changes(conn, COLLECTIONS_STAGING_TABLE, "Collections", collections_table_columns(required_columns),
+                          COLLECTIONS_KEY_COLUMNS, "Policy_No", null_as_empty=["Transaction_Date"])
+    return merge_staging_table(conn, COLLECTIONS_STAGING_TABLE, "Collections", collections_table_columns(required_columns),
+                               COLLECTIONS_KEY_COLUMNS, null_as_empty=["Transaction_Date"])
+
+
+def stream_collections_csv(csv_file, conn, column_map, write_chunk, chunk_size=DEFAULT_CHUNK_SIZE,
+                           skip_missing_policy_no=False, quarantine_file=None, use_manifest=False,
+                           show_progress=True, required_columns=COLLECTION_COLUMNS):
+    """
+    Read the collections CSV in chunks, map each chunk, normalize its Premium signs and dates and
+    write it with write_chunk.
+
+    Args:
+        csv_file (str): path to the CPS CSV file
+        conn: sqlite3 connection to policies.db
+        column_map (dict): required column -> matching (cleaned) CSV column, or None
+        write_chunk (function): called as write_chunk(conn, chunk); returns a dict of counters.
+                                Nothing is committed here, the caller commits when it is done
+        chunk_size (int): number of CSV rows held in memory at a time
+        skip_missing_policy_no (bool): drop rows with an empty Policy_No before writing
+        quarantine_file (str): CSV for rows with an unknown Transaction_type
+                               (default: 'quarantine_<csv_file name>')
+        use_manifest (bool): only write rows that are new or changed since they were last
+                             ingested, and record them in the ingest manifest (see ingest_manifest.py)
+        show_progress (bool): print the counters after every chunk
+
+    Returns:
+        dict: progress counters (chunks, rows_read, rows_skipped, rows_quarantined, rows_unchanged,
+              dates_unparseable, adjusted_<transaction type> plus the writer's counters)
+    """
+    if quarantine_file is None:
+        quarantine_file = default_quarantine_file(csv_file)
+    # Don't leave quarantined rows from an earlier run of the same file lying around
+    if os.path.exists(quarantine_file):
+        os.remove(quarantine_file)
+
+    raw_columns, clean_columns = read_clean_header(csv_file)
+    clean_to_raw = dict(zip(clean_columns, raw_columns))
+    usecols = [clean_to_raw[col] for col in set(column_map.values()) if col is not None]
+
+    stats = {"chunks": 0, "rows_read": 0, "rows_skipped": 0, "rows_quarantined": 0, "rows_unchanged": 0,
+             "dates_unparseable": 0}
+    for chunk in pd.read_csv(csv_file, chunksize=chunk_size, usecols=usecols):
+        chunk.columns = [col.strip() for col in chunk.columns]
+        mapped = map_collections_chunk(chunk, column_map, required_columns)
+
+        if skip_missing_policy_no:
+            mapped, skipped = drop_rows_without_policy_no(mapped)
+            stats["rows_skipped"] += skipped
+
+        mapped, quarantined, adjusted_counts = normalize_premium_signs(mapped)
+        for trans_type, count in adjusted_counts.items():
+            stats[f"adjusted_{trans_type}"] = stats.get(f"adjusted_{trans_type}", 0) + count
+        if not quarantined.empty:
+            write_quarantine(quarantined, quarantine_file, first_write=stats["rows_quarantined"] == 0)
+            stats["rows_quarantined"] += len(quarantined)
+
+        # Parse the dates once here, so nothing downstream has to parse them again
+        mapped, unparseable = normalize_collections_dates(mapped)
+        stats["dates_unparseable"] += unparseable
+
+        if use_manifest:
+            mapped, keys, hashes, unchanged = filter_changed_rows(conn, "Collections", mapped, COLLECTIONS_KEY_COLUMNS)
+            stats["rows_unchanged"] += unchanged
+
+        for key, value in write_chunk(conn, mapped, required_columns).items():
+            stats[key] = stats.get(key, 0) + value
+
+        if use_manifest:
+            record_rows(conn, "Collections", keys, hashes)
+
+        stats["chunks"] += 1
+        stats["rows_read"] += len(chunk)
+        if show_progress:
+            print(f"  Chunk {stats['chunks']}: {stats['rows_read']} rows read, "
+                  f"{stats['rows_skipped']} skipped, {stats['rows_quarantined']} quarantined, "
+                  f"{stats['rows_unchanged']} unchanged, "
+                  f"{stats.get('inserted', 0)} inserted, {stats.get('staged', 0)} staged")
+
+    if stats["rows_quarantined"] and show_progress:
+        print(f"  {stats['rows_quarantined']} rows with an unknown Transaction_type written to '{quarantine_file}'")
+    return stats
+
+
+def parse_collections_file(csv_file, column_map, chunk_size=DEFAULT_CHUNK_SIZE, required_columns=COLLECTION_COLUMNS):
+    """
+    Read, map and normalize a whole CPS file without touching the database, so that several
+    files can be parsed at the same time in a process pool (see ingest_collections_files.py).
+    Rows with an empty Policy_No are skipped and unknown transaction types are quarantined as usual.
+
+    Returns:
+        tuple: (DataFrame of Collections rows in file order, dict of counters)
+    """
+    parts = []
+
+    def keep_chunk(conn, chunk, required_columns):
+        parts.append(chunk)
+        return {"parsed": len(chunk)}
+
+    stats = stream_collections_csv(csv_file, None, column_map, keep_chunk, chunk_size=chunk_size,
+                                   skip_missing_policy_no=True, show_progress=False,
+                                   required_columns=required_columns)
+    if parts:
+        rows = pd.concat(parts, ignore_index=True)
+    else:
+        rows = pd.DataFrame(columns=collections_table_columns(required_columns))
+    return rows, stats
+
+
+def print_premium_audit(stats):
+    """Print how many Premium values had their sign changed, per transaction type."""
+    print("\nPremium sign adjustments:")
+    for trans_type in KNOWN_TRANSACTION_TYPES:
+        print(f"  '{trans_type}': {stats.get(f'adjusted_{trans_type}', 0)} rows adjusted")
+    print(f"  Unknown transaction type (quarantined): {stats.get('rows_quarantined', 0)} rows")
@@ -0,0 +1,165 @@
+"""
+Shared resolver that maps the column headings of a Sales or CPS CSV to the columns of the
+Policies and Collections tables.
+
+The mapping (the "column plan") is worked out once per file instead of once per row and column:
+1. A manual override from column_mapping, if that heading is in the file.
+2. An exact match on the heading (after stripping leading/trailing whitespace).
+3. A match with underscores and spaces swapped (Status_Name vs Status Name).
+4. A case-insensitive match on any of the above.
+
+Plans are cached by a fingerprint of the header (plus the wanted columns and overrides), in memory
+and in a small JSON file, so repeat exports with the same layout skip the resolution entirely.
+A cached plan that doesn't fit the header (e.g. the JSON file was edited) is resolved again.
+If a mandatory column can't be found, resolve_column_plan raises a ValueError listing what is
+missing, whether the plan was just resolved or came from the cache.
+
+Dependencies:
+- hashlib, json, os (built into Python)
+"""
+
+import hashlib
+import json
+import os
+
+# File where column plans are kept between runs
+DEFAULT_PLAN_CACHE_FILE = "column_plan_cache.json"
+
+# Plans already resolved in this run, keyed by fingerprint
+_plan_cache = {}
+
+
+def clean_header(columns):
+    """Strip leading and trailing whitespace from each column heading."""
+    return [str(col).strip() for col in columns]
+
+
+def header_fingerprint(columns, target_columns, overrides=None):
+    """Return a short hash identifying a header layout together with the wanted columns and overrides."""
+    key = json.dumps([list(columns), list(target_columns), sorted((overrides or {}).items())])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _plan_fits_header(plan, columns, target_columns):
+    """True if a cached plan has every target column and only maps to headings that are in the file."""
+    headings = set(columns)
+    return (isinstance(plan, dict) and all(col in plan for col in target_columns)
+            and all(csv_col is None or csv_col in headings for csv_col in plan.values()))
+
+
+def _check_mandatory(plan, columns, mandatory_columns):
+    """Raise a ValueError listing the mandatory columns the plan has no CSV heading for."""
+    missing = [col for col in (mandatory_columns or []) if plan.get(col) is None]
+    if missing:
+        raise ValueError(
+            "Could not find these required columns in the CSV: " + ", ".join(missing)
+            + "\nAvailable columns are: " + ", ".join(f"'{col}'" for col in columns)
+            + "\nAdd the right heading to the column mapping or fix the CSV header."
+        )
+
+
+def _compile_header(columns):
+    """Build the lookups used for matching: exact heading -> heading, lower-cased heading -> position."""
+    exact = {}
+    lower_positions = {}
+    for position, col in enumerate(columns):
+        exact.setdefault(col, col)
+        lower_positions.setdefault(col.lower(), position)
+    return exact, lower_positions
+
+
+def _match_column(columns, exact, lower_positions, target_col):
+    """Find the heading for one target column using the compiled lookups, or None."""
+    # Remove a type definition such as "Premium REAL" from the target column
+    clean_target = target_col.split()[0] if ' ' in target_col else target_col
+
+    if clean_target in exact:
+        return clean_target
+
+    # Handle underscore vs space (Status_Name vs Status Name)
+    variants = [clean_target.replace('_', ' '), clean_target.replace(' ', '_')]
+    for variant in variants:
+        if variant in exact:
+            return variant
+
+    # Case-insensitive: take whichever matching heading comes first in the file
+    positions = [lower_positions.get(v.lower()) for v in [clean_target] + variants]
+    positions = [p for p in positions if p is not None]
+    if positions:
+        return columns[min(positions)]
+    return None
+
+
+def resolve_column_plan(columns, target_columns, overrides=None, mandatory_columns=None,
+                        cache_file=DEFAULT_PLAN_CACHE_FILE):
+    """
+    Work out which CSV column supplies each target column.
+
+    Args:
+        columns (list): CSV column headings (whitespace is stripped here)
+        target_columns (list): table columns to fill, e.g. POLICY_COLUMNS
+        overrides (dict): manual target column -> CSV heading mapping, used when that heading exists
+        mandatory_columns (list): target columns that must be found, otherwise ValueError is raised
+        cache_file (str): JSON file used to keep plans between runs (None to only cache in memory)
+
+    Returns:
+        dict: target column -> matching CSV heading (None if not found)
+    """
+    columns = clean_header(columns)
+    overrides = overrides or {}
+    fingerprint = header_fingerprint(columns, target_columns, overrides)
+
+    # The fingerprint doesn't include mandatory_columns, so cached plans are checked here as well
+    if fingerprint in _plan_cache:
+        _check_mandatory(_plan_cache[fingerprint], columns, mandatory_columns)
+        return dict(_plan_cache[fingerprint])
+
+    stored_plans = _load_plan_cache(cache_file)
+    stored_plan = stored_plans.get(fingerprint)
+    if stored_plan is not None and _plan_fits_header(stored_plan, columns, target_columns):
+        _check_mandatory(stored_plan, columns, mandatory_columns)
+        _plan_cache[fingerprint] = stored_plan
+        return dict(stored_plan)
+
+    exact, lower_positions = _compile_header(columns)
+    plan = {}
+    for target_col in target_columns:
+        override = overrides.get(target_col)
+        if override is not None and override in exact:
+            plan[target_col] = override
+        else:
+            plan[target_col] = _match_column(columns, exact, lower_positions, target_col)
+
+    _check_mandatory(plan, columns, mandatory_columns)
+
+    _plan_cache[fingerprint] = plan
+    if cache_file is not None:
+        stored_plans[fingerprint] = plan
+        _save_plan_cache(cache_file, stored_plans)
+    return dict(plan)
+
+
+def print_column_plan(plan):
+    """Print the mapping from CSV columns to required columns."""
+    print("\nColumn mapping from CSV to required columns:")
+    for target_col, csv_col in plan.items():
+        if csv_col is not None:
+            print(f"  '{target_col}' → mapped to → '{csv_col}'")
+        else:
+            print(f"  '{target_col}' → NO MATCH FOUND")
+
+
+def _load_plan_cache(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # A damaged cache file is simply rebuilt
+        return {}
+
+
+def _save_plan_cache(cache_file, plans):
+    with open(cache_file, "w") as f:
+        json.dump(plans, f, indent=2)
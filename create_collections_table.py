@@ -11,20 +11,53 @@ Steps:
 5. Inserts the data from the CSV into the 'Collections' table.
 
 Dependencies:
-- sqlite3 (built into Python)
+- sqlite3 (built into Python), opened through database.py in WAL mode
 - pandas (for loading and processing the CSV)
 
 Notes:
 - Only specific columns needed by report_active_policies.py are included in the table.
 - Leading and trailing whitespace is removed from column headings.
+- CSV columns are matched to the table columns with the shared resolver in column_resolver.py.
+- After loading, a unique index on (Policy_No, Transaction_Date) is added. If the CSV has the same
+  Policy_No and Transaction_Date more than once, only the last of those rows is kept.
+- With streaming_mode = True (the default) the CSV is read and inserted chunk_size rows at a time
+  (see collections_ingest.py). SQLite sorts the rows for the unique key in a temporary file (see
+  temp_store in database.py) and the Parquet copy is written in chunks too, so memory use stays
+  flat however big the file is. In this mode the
+  sign of Premium is also fixed by Transaction_type, the same way add_new_collections.py does it,
+  and rows with an unknown Transaction_type are written to a quarantine CSV instead of the table.
+- Transaction_Date is stored as ISO text ('YYYY-MM-DD') plus an integer Transaction_Date_EpochDay
+  column (days since 1970-01-01), so the dates only have to be parsed once (see date_columns.py).
+- Afterwards the Parquet copy of the table used for analysis, with one folder per month, is
+  rebuilt (see parquet_mirror.py). Set parquet_mirror = False to skip that.
 """
 
-import sqlite3
 import pandas as pd
+from database import connect
+from column_resolver import print_column_plan, resolve_column_plan
+from collections_ingest import (
+    COLLECTIONS_COLUMN_MAPPING, DEFAULT_CHUNK_SIZE, MANDATORY_COLLECTION_COLUMNS, ensure_collections_key,
+    insert_collections_chunk, normalize_collections_dates, print_premium_audit, stream_collections_csv
+)
+from parquet_mirror import update_mirror
+from ingest_manifest import reset_manifest
+from change_log import record_full_rebuild
 
 # Load CSV file
 csv_file = 'CPS_Jan_2024tillMarch_2025.csv'
-df = pd.read_csv(csv_file)
+
+# Read and insert the CSV in chunks instead of loading the whole file at once
+streaming_mode = True
+chunk_size = DEFAULT_CHUNK_SIZE
+
+# Rebuild the Parquet copy of the Collections table afterwards (needs pyarrow)
+parquet_mirror = True
+
+if streaming_mode:
+    # Only read the header here; the rows are read chunk by chunk below
+    df = pd.read_csv(csv_file, nrows=0)
+else:
+    df = pd.read_csv(csv_file)
 
 # Clean column names by removing leading/trailing whitespace
 original_columns = df.columns.tolist()
@@ -43,7 +76,7 @@ for col in clean_columns:
 df.columns = clean_columns
 
 # Connect to SQLite database
-conn = sqlite3.connect("policies.db")
+conn = connect('policies.db')
 cursor = conn.cursor()
 
 # Define the required columns for the Collections table
@@ -55,62 +88,82 @@ required_columns = [
     "Policy_No TEXT"
 ]
 
+# Day number of Transaction_Date, filled in from the parsed dates rather than from the CSV
+date_day_columns = ["Transaction_Date_EpochDay INTEGER"]
+
 # Drop existing table and create a new one with only the required columns
 cursor.execute('DROP TABLE IF EXISTS Collections')
+# The ingest manifest no longer describes what is in the table
+reset_manifest(conn, "Collections")
+# and the report has to work out the status of every policy again
+record_full_rebuild(conn, "Collections")
 create_table_sql = f"""
 CREATE TABLE IF NOT EXISTS Collections (
-    {', '.join(required_columns)}
+    {', '.join(required_columns + date_day_columns)}
 );
 """
 cursor.execute(create_table_sql)
 
 print("\nCreated table with these columns:")
-for col in required_columns:
+for col in required_columns + date_day_columns:
     print(f"  {col}")
 
-# Function to map CSV columns to required columns (case-insensitive and ignoring whitespace)
-def get_matching_column(df, target_col):
-    # Remove the type definition from the target column
-    clean_target = target_col.split()[0]
-    
-    # First check for exact match after whitespace stripping
-    if clean_target in df.columns:
-        return clean_target
-    
-    # Then try case-insensitive match
-    for col in df.columns:
-        if col.lower() == clean_target.lower():
-            return col
-    
-    # If no match, return None
-    return None
-
-# Prepare data for insertion
-data_to_insert = []
-for _, row in df.iterrows():
-    new_row = {}
-    for col_def in required_columns:
-        col_name = col_def.split()[0]
-        matching_col = get_matching_column(df, col_name)
+# Work out which CSV column supplies each required column, once for the whole file
+column_map = resolve_column_plan(
+    df.columns,
+    [col_def.split()[0] for col_def in required_columns],
+    overrides=COLLECTIONS_COLUMN_MAPPING,
+    mandatory_columns=MANDATORY_COLLECTION_COLUMNS
+)
+print_column_plan(column_map)
+
+if streaming_mode:
+    # Stream the file into the table
+    print(f"\nLoading '{csv_file}' in chunks of {chunk_size} rows:")
+    stats = stream_collections_csv(csv_file, conn, column_map, insert_collections_chunk, chunk_size=chunk_size)
+    conn.commit()
+    print(f"\nInserted {stats.get('inserted', 0)} rows in {stats['chunks']} chunks")
+    dates_unparseable = stats["dates_unparseable"]
+    print_premium_audit(stats)
+else:
+    # Prepare data for insertion
+    data_to_insert = []
+    for _, row in df.iterrows():
+        new_row = {}
+        for col_def in required_columns:
+            col_name = col_def.split()[0]
+            matching_col = column_map[col_name]
         
-        if matching_col:
-            new_row[col_name] = row[matching_col]
-        else:
-            new_row[col_name] = None
+            if matching_col:
+                new_row[col_name] = row[matching_col]
+            else:
+                new_row[col_name] = None
             
-    data_to_insert.append(new_row)
+        data_to_insert.append(new_row)
+
+    # Convert to DataFrame for easy insertion
+    insert_df = pd.DataFrame(data_to_insert)
+
+    # Replace spaces with underscores in column names for SQL compatibility
+    insert_df.columns = [col.replace(" ", "_") for col in insert_df.columns]
+
+    # Store Transaction_Date as ISO text plus its day number
+    insert_df, dates_unparseable = normalize_collections_dates(insert_df)
 
-# Convert to DataFrame for easy insertion
-insert_df = pd.DataFrame(data_to_insert)
+    # Insert data into the table
+    insert_df.to_sql('Collections', conn, if_exists='append', index=False)
 
-# Replace spaces with underscores in column names for SQL compatibility
-insert_df.columns = [col.replace(" ", "_") for col in insert_df.columns]
+if dates_unparseable:
+    print(f"\nWARNING: {dates_unparseable} Transaction_Date values could not be read as dates and were kept as text")
 
-# Insert data into the table
-insert_df.to_sql('Collections', conn, if_exists='append', index=False)
+# Add the unique key on (Policy_No, Transaction_Date) once all the rows are loaded
+duplicates_removed = ensure_collections_key(conn)
+print(f"\nAdded unique key on (Policy_No, Transaction_Date), removed {duplicates_removed} duplicate rows")
 
 # Commit and close connection
 conn.commit()
+if parquet_mirror:
+    update_mirror(conn, "Collections")
 conn.close()
 
 print("\nDatabase created and connection closed successfully!")
\ No newline at end of file
@@ -12,21 +12,35 @@ Steps:
 6. Commits the changes to the database and closes the connection.
 
 Dependencies:
-- sqlite3 (built into Python)
+- sqlite3 (built into Python), opened through database.py in WAL mode
 - pandas (for loading and processing the CSV)
 
 Notes:
 - Only specific columns needed by report_active_policies.py are included in the table.
 - The 'fcertificate' column is treated as the primary key.
 - Leading and trailing whitespace is removed from column headings.
+- CSV columns are matched to the table columns with the shared resolver in column_resolver.py.
+- FirstCollectionDate and InceptionDate are stored as ISO text ('YYYY-MM-DD') plus integer
+  <column>_EpochDay columns (days since 1970-01-01), so the dates only have to be parsed once
+  (see date_columns.py).
+- After the table is written, the Parquet copy of it used for analysis is refreshed
+  (see parquet_mirror.py). Set parquet_mirror = False to skip that.
 """
 
-import sqlite3
 import pandas as pd
-import re
+from database import connect
+from column_resolver import print_column_plan, resolve_column_plan
+from date_columns import DATE_COLUMNS, epoch_day_column, normalize_date_columns
+from parquet_mirror import update_mirror
+from ingest_manifest import reset_manifest
+from change_log import record_full_rebuild
+from policies_ingest import MANDATORY_POLICY_COLUMNS
 
 # Load CSV file
 csv_file = 'March 2025 Sales File.csv'
+
+# Rebuild the Parquet copy of the Policies table afterwards (needs pyarrow)
+parquet_mirror = True
 df = pd.read_csv(csv_file)
 
 # Clean column names by removing leading/trailing whitespace
@@ -46,7 +60,7 @@ for col in clean_columns:
 df.columns = clean_columns
 
 # Connect to SQLite database
-conn = sqlite3.connect("policies.db")
+conn = connect('policies.db')
 cursor = conn.cursor()
 
 # Define the required columns for the Policies table
@@ -64,47 +78,33 @@ required_columns = [
     "PayAtReference TEXT"
 ]
 
+# Day numbers of the date columns, filled in from the parsed dates rather than from the CSV
+date_day_columns = [f"{epoch_day_column(col)} INTEGER" for col in DATE_COLUMNS["Policies"]]
+
 # Drop existing table and create a new one with only the required columns
 cursor.execute('DROP TABLE IF EXISTS Policies')
+# The ingest manifest no longer describes what is in the table
+reset_manifest(conn, "Policies")
+# and the report has to work out the status of every policy again
+record_full_rebuild(conn, "Policies")
 create_table_sql = f"""
 CREATE TABLE IF NOT EXISTS Policies (
-    {', '.join(required_columns)}
+    {', '.join(required_columns + date_day_columns)}
 );
 """
 cursor.execute(create_table_sql)
 
 print("\nCreated table with these columns:")
-for col in required_columns:
+for col in required_columns + date_day_columns:
     print(f"  {col}")
 
-# Function to map CSV columns to required columns (case-insensitive and ignoring whitespace)
-def get_matching_column(df, target_col):
-    # Remove the type definition from the target column
-    clean_target = target_col.split()[0] if ' ' in target_col else target_col
-    
-    # First check for exact match after whitespace stripping
-    if clean_target in df.columns:
-        return clean_target
-    
-    # Handle underscore vs space (Status_Name vs Status Name)
-    space_version = clean_target.replace('_', ' ')
-    underscore_version = clean_target.replace(' ', '_')
-    
-    for col in df.columns:
-        if col == space_version or col == underscore_version:
-            return col
-    
-    # Then try case-insensitive match
-    for col in df.columns:
-        if col.lower() == clean_target.lower():
-            return col
-        if col.lower() == space_version.lower():
-            return col
-        if col.lower() == underscore_version.lower():
-            return col
-    
-    # If no match, return None
-    return None
+# Work out which CSV column supplies each required column, once for the whole file
+column_map = resolve_column_plan(
+    df.columns,
+    [col_def.split()[0] for col_def in required_columns],
+    mandatory_columns=MANDATORY_POLICY_COLUMNS
+)
+print_column_plan(column_map)
 
 # Prepare data for insertion
 data_to_insert = []
@@ -112,7 +112,7 @@ for _, row in df.iterrows():
     new_row = {}
     for col_def in required_columns:
         col_name = col_def.split()[0]
-        matching_col = get_matching_column(df, col_name)
+        matching_col = column_map[col_name]
         
         if matching_col:
             new_row[col_name] = row[matching_col]
@@ -127,11 +127,18 @@ insert_df = pd.DataFrame(data_to_insert)
 # Replace spaces with underscores in column names for SQL compatibility
 insert_df.columns = [col.replace(" ", "_") for col in insert_df.columns]
 
+# Store the dates as ISO text plus their day numbers
+insert_df, dates_unparseable = normalize_date_columns(insert_df, DATE_COLUMNS["Policies"])
+if dates_unparseable:
+    print(f"\nWARNING: {dates_unparseable} date values could not be read as dates and were kept as text")
+
 # Insert data into the table
 insert_df.to_sql('Policies', conn, if_exists='append', index=False)
 
 # Commit and close connection
 conn.commit()
+if parquet_mirror:
+    update_mirror(conn, "Policies")
 conn.close()
 
 print("\nDatabase created and connection closed successfully!")
@@ -0,0 +1,49 @@
+"""
+Opening policies.db with the settings shared by the ingest scripts and the report.
+
+The database runs in WAL (write-ahead log) mode, so a report can keep reading a consistent
+snapshot of Policies and Collections while an ingest script is writing to them. The other
+pragmas are tuned for bulk loading:
+- synchronous = NORMAL: in WAL mode this is still safe if the program crashes, and much faster
+  than FULL because SQLite doesn't wait for the disk after every commit.
+- cache_size: about 64 MB of page cache (negative values are in KiB).
+- temp_store = FILE: the temporary staging tables used for merging, and the sorts behind index
+  builds and GROUP BY, go to a temporary file once they outgrow a small cache. Keeping them in
+  memory would make an ingest's memory use grow with the size of the CSV file.
+- busy_timeout: wait up to 30 seconds instead of failing straight away if another
+  connection is holding the write lock.
+
+Dependencies:
+- sqlite3 (built into Python)
+"""
+
+import sqlite3
+
+DEFAULT_DB_PATH = "policies.db"
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "temp_store": "FILE",
+    "busy_timeout": 30000
+}
+
+
+def connect(db_path=DEFAULT_DB_PATH):
+    """Open the database and apply the shared pragmas."""
+    conn = sqlite3.connect(db_path)
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def begin_read_snapshot(conn):
+    """
+    Start a read transaction, so every query on this connection sees the database as it was
+    at this moment, even if an ingest commits in the meantime. Call conn.rollback() (or close
+    the connection) when done.
+    """
+    conn.execute("BEGIN")
+    # In WAL mode the snapshot is taken at the first read, so read something straight away
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
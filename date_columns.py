@@ -0,0 +1,138 @@
+"""
+Typed date columns for the Policies and Collections tables.
+
+The CSV exports write dates in their own format (e.g. '2025/04/10'), and they used to be stored
+exactly as they came in. Every report run then had to parse them again with pd.to_datetime, one
+policy at a time, and SQL date comparisons such as DATE(FirstCollectionDate) > DATE('now') could
+neither use an index nor even read that format.
+
+Dates are now parsed once, at ingest time, in one vectorized step per chunk, and stored as:
+- the canonical ISO text 'YYYY-MM-DD' in the original column (with ' HH:MM:SS' added only if
+  the export had a time of day), so the text sorts and compares correctly
+- an extra INTEGER column '<column>_EpochDay' with the number of days since 1970-01-01, so date
+  ranges and "is it before today" checks are plain integer comparisons
+
+Values that can't be parsed as dates are kept as they were (so nothing is lost), with an empty
+epoch day. Empty values are stored as NULL.
+
+Older databases are migrated in place by ensure_date_columns.
+
+Dependencies:
+- pandas and numpy (for parsing whole columns at once)
+"""
+
+import numpy as np
+import pandas as pd
+
+# Date columns of each table
+DATE_COLUMNS = {
+    "Policies": ["FirstCollectionDate", "InceptionDate"],
+    "Collections": ["Transaction_Date"]
+}
+
+EPOCH_DAY_SUFFIX = "_EpochDay"
+
+
+def epoch_day_column(col):
+    """Name of the integer day-number column stored next to a date column."""
+    return f"{col}{EPOCH_DAY_SUFFIX}"
+
+
+def with_epoch_day_columns(columns, date_columns):
+    """The table columns for these CSV columns: the columns plus an epoch-day column per date column."""
+    return list(columns) + [epoch_day_column(col) for col in date_columns if col in columns]
+
+
+def parse_dates(values):
+    """
+    Parse a column of date text in one go.
+
+    The format is worked out from the first value and applied to the whole column, which is fast.
+    Values that don't fit that format (a file that mixes formats) are then parsed one by one,
+    the same way pd.to_datetime parses a single value.
+
+    Returns:
+        tuple: (stripped text with blanks as missing, parsed Timestamps with NaT where missing or invalid)
+    """
+    text = values.astype("string").str.strip()
+    text = text.mask(text == "")
+    parsed = pd.to_datetime(text, errors="coerce")
+    leftover = parsed.isna() & text.notna()
+    if leftover.any():
+        parsed[leftover] = pd.to_datetime(text[leftover], format="mixed", errors="coerce")
+    return text, parsed
+
+
+def normalize_date_columns(batch, date_columns):
+    """
+    Rewrite the date columns of a batch as ISO text and add their epoch-day columns.
+
+    Returns:
+        tuple: (new DataFrame, number of non-empty values that could not be parsed)
+    """
+    batch = batch.copy()
+    unparseable = 0
+    for col in date_columns:
+        text, parsed = parse_dates(batch[col])
+        days = parsed.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+        valid = parsed.notna().to_numpy()
+
+        iso = pd.Series(np.datetime_as_string(days), index=batch.index, dtype=object)
+        has_time = parsed.notna() & (parsed != parsed.dt.normalize())
+        if has_time.any():
+            iso[has_time] = parsed[has_time].dt.strftime("%Y-%m-%d %H:%M:%S")
+
+        # Keep values that aren't dates as they were; empty values become NULL
+        invalid = ~valid & text.notna().to_numpy()
+        iso[~valid] = None
+        iso[invalid] = text[invalid].astype(object)
+        unparseable += int(invalid.sum())
+
+        epoch_days = pd.Series(days.astype("int64"), index=batch.index, dtype=object)
+        epoch_days[~valid] = None
+
+        batch[col] = iso
+        batch[epoch_day_column(col)] = epoch_days
+    return batch, unparseable
+
+
+def normalize_date_value(value):
+    """Normalize a single date value (for the row-by-row paths). Returns (ISO text, epoch day)."""
+    batch, _ = normalize_date_columns(pd.DataFrame({"date": [value]}, dtype=object), ["date"])
+    return batch["date"].iloc[0], batch[epoch_day_column("date")].iloc[0]
+
+
+def missing_epoch_day_columns(conn, table):
+    """Epoch-day columns that the table doesn't have yet (an older database)."""
+    existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    return [epoch_day_column(col) for col in DATE_COLUMNS[table] if epoch_day_column(col) not in existing]
+
+
+def ensure_date_columns(conn, table):
+    """
+    Migrate an older table in place: add the epoch-day columns and rewrite the stored dates as
+    ISO text with their day numbers. Runs once per table; afterwards every ingest writes
+    normalized dates itself. Does not commit.
+
+    Returns:
+        int: number of rows whose dates were rewritten (0 if the table was already migrated)
+    """
+    missing = missing_epoch_day_columns(conn, table)
+    if not missing:
+        return 0
+
+    for col in missing:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} INTEGER")
+
+    date_columns = DATE_COLUMNS[table]
+    rows = pd.read_sql_query(f"SELECT rowid AS row_id, {', '.join(date_columns)} FROM {table}", conn)
+    normalized, _ = normalize_date_columns(rows, date_columns)
+    table_columns = with_epoch_day_columns(date_columns, date_columns)
+
+    set_clauses = ', '.join(f"{col} = ?" for col in table_columns)
+    values = normalized[table_columns + ["row_id"]].astype(object).where(normalized.notna(), None)
+    conn.executemany(
+        f"UPDATE {table} SET {set_clauses} WHERE rowid = ?",
+        [tuple(row) for row in values.itertuples(index=False, name=None)]
+    )
+    return len(rows)
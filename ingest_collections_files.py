@@ -0,0 +1,182 @@
+"""
+This script adds several collections (CPS) CSV files to the 'Collections' table at once,
+for example a batch of weekly files or one file per insurer.
+
+Steps:
+1. Expands the file names and glob patterns given on the command line (in the order given).
+2. Skips files that have already been ingested (see ingest_manifest.py).
+3. Works out the column mapping of each file, then reads, maps and sign-normalizes the files in
+   parallel in a process pool (one file per worker).
+4. Merges the parsed rows. When the same (Policy_No, Transaction_Date) appears in more than one
+   file, the row from the file listed last wins, the same as running add_new_collections.py on
+   the files one after the other.
+5. Writes the merged rows to policies.db from this process only (SQLite has a single writer):
+   staging table, set-based merge, ingest manifest and file records in one transaction.
+
+Usage:
+    python3 ingest_collections_files.py "weekly CPS/*.csv" "April to 3 May CPS.csv" --workers 8
+
+Dependencies:
+- sqlite3 (built into Python), opened through database.py in WAL mode
+- pandas (for handling the CSV files)
+- concurrent.futures (built into Python, for the process pool)
+
+Notes:
+- Parsing scales with the number of worker processes; writing is done once, at the end.
+- The parsed rows of all the files are held in memory until they are written, so memory use
+  grows with the total size of the files. For a single very large file use
+  add_new_collections.py, which streams it in chunks. The staging table itself is written to a
+  temporary file (see temp_store in database.py).
+- Rows with an unknown Transaction_type go to 'quarantine_<csv file name>' as usual.
+- Afterwards the months of the Parquet mirror (see parquet_mirror.py) that received new or
+  changed rows are rewritten, unless --no-parquet-mirror is given.
+- The policies of new or changed rows are written to the change log (see change_log.py).
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from database import DEFAULT_DB_PATH, connect
+from column_resolver import resolve_column_plan
+from collections_ingest import (
+    COLLECTION_COLUMNS, COLLECTIONS_COLUMN_MAPPING, COLLECTIONS_KEY_COLUMNS, DEFAULT_CHUNK_SIZE,
+    COLLECTIONS_STAGING_TABLE, MANDATORY_COLLECTION_COLUMNS, create_collections_staging, ensure_collections_key,
+    merge_collections_staging, parse_collections_file, print_premium_audit, read_clean_header,
+    stage_collections_chunk
+)
+from parquet_mirror import DEFAULT_MIRROR_DIR, staged_months, update_mirror
+from ingest_manifest import (
+    file_content_hash, filter_changed_rows, is_file_ingested, record_file, record_rows, row_keys
+)
+
+
+def expand_csv_files(patterns):
+    """Turn file names and glob patterns into a list of files, keeping the order and dropping repeats."""
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            print(f"WARNING: no files match '{pattern}'")
+        for csv_file in matches:
+            if csv_file not in files:
+                files.append(csv_file)
+    return files
+
+
+def ingest_collections_files(csv_files, db_path=DEFAULT_DB_PATH, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                             parquet_mirror=True):
+    """
+    Parse the CPS files in parallel and write the merged result to the Collections table.
+
+    Args:
+        csv_files (list): CSV files, in the order they should be applied
+        db_path (str): SQLite database to write to
+        workers (int): number of parsing processes (default: number of CPU cores)
+        chunk_size (int): rows read at a time within each file
+        parquet_mirror (bool): refresh the changed months of the Parquet mirror afterwards
+
+    Returns:
+        dict: counters for the whole run
+    """
+    conn = connect(db_path)
+    duplicates_removed = ensure_collections_key(conn)
+
+    # Skip files whose exact contents have already been ingested
+    to_ingest = []
+    for csv_file in csv_files:
+        file_hash = file_content_hash(csv_file)
+        if is_file_ingested(conn, file_hash, "Collections"):
+            print(f"'{csv_file}' has already been ingested - skipping.")
+        else:
+            to_ingest.append((csv_file, file_hash))
+
+    totals = {"files": len(to_ingest), "rows_read": 0, "rows_skipped": 0, "rows_quarantined": 0,
+              "duplicates_across_files": 0, "rows_unchanged": 0, "inserted": 0, "updated": 0}
+    if not to_ingest:
+        conn.close()
+        return totals
+
+    # Resolve each file's column plan here, so the workers don't race on the plan cache file
+    column_maps = []
+    for csv_file, _ in to_ingest:
+        _, clean_columns = read_clean_header(csv_file)
+        column_maps.append(resolve_column_plan(
+            clean_columns, COLLECTION_COLUMNS,
+            overrides=COLLECTIONS_COLUMN_MAPPING, mandatory_columns=MANDATORY_COLLECTION_COLUMNS
+        ))
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Parsing {len(to_ingest)} files with {min(workers, len(to_ingest))} worker processes...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            parse_collections_file,
+            [csv_file for csv_file, _ in to_ingest],
+            column_maps,
+            [chunk_size] * len(to_ingest)
+        ))
+
+    parsed = []
+    for (csv_file, _), (rows, stats) in zip(to_ingest, results):
+        print(f"  '{csv_file}': {stats['rows_read']} rows read, {stats['rows_skipped']} skipped, "
+              f"{stats['rows_quarantined']} quarantined")
+        for key, value in stats.items():
+            if key.startswith("rows_") or key.startswith("adjusted_") or key == "dates_unparseable":
+                totals[key] = totals.get(key, 0) + value
+        parsed.append(rows)
+
+    # Resolve duplicates across files: the last file (and last row within it) wins
+    merged = pd.concat(parsed, ignore_index=True)
+    duplicated = row_keys(merged, COLLECTIONS_KEY_COLUMNS).duplicated(keep="last")
+    totals["duplicates_across_files"] = int(duplicated.sum())
+    merged = merged[~duplicated]
+
+    # Single writer: stage, merge and record everything in one transaction
+    merged, keys, hashes, unchanged = filter_changed_rows(conn, "Collections", merged, COLLECTIONS_KEY_COLUMNS)
+    create_collections_staging(conn)
+    stage_collections_chunk(conn, merged)
+    changed_months = staged_months(conn, COLLECTIONS_STAGING_TABLE)
+    inserted, updated, identical = merge_collections_staging(conn)
+    record_rows(conn, "Collections", keys, hashes)
+    for (csv_file, file_hash), (_, stats) in zip(to_ingest, results):
+        record_file(conn, file_hash, "Collections", csv_file, stats["rows_read"])
+    conn.commit()
+    if parquet_mirror:
+        # The mirror folder sits next to the database
+        mirror_dir = os.path.join(os.path.dirname(db_path), DEFAULT_MIRROR_DIR)
+        update_mirror(conn, "Collections", mirror_dir, months=None if duplicates_removed else changed_months)
+    conn.close()
+
+    totals["rows_unchanged"] = unchanged + identical
+    totals["inserted"] = inserted
+    totals["updated"] = updated
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add several collections (CPS) CSV files to policies.db at once.")
+    parser.add_argument("csv_files", nargs="+", help="CSV files or glob patterns, e.g. 'weekly/*.csv'")
+    parser.add_argument("--workers", type=int, default=None, help="number of parsing processes (default: all cores)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rows read at a time per file")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite database to write to")
+    parser.add_argument("--no-parquet-mirror", action="store_true", help="don't refresh the Parquet mirror")
+    args = parser.parse_args()
+
+    totals = ingest_collections_files(expand_csv_files(args.csv_files), db_path=args.db,
+                                      workers=args.workers, chunk_size=args.chunk_size,
+                                      parquet_mirror=not args.no_parquet_mirror)
+
+    print_premium_audit(totals)
+    print("\nSummary:")
+    print(f"  Files ingested: {totals['files']}")
+    print(f"  Total rows in CSVs: {totals['rows_read']}")
+    print(f"  Rows skipped: {totals['rows_skipped']}")
+    print(f"  Duplicate rows across files: {totals['duplicates_across_files']}")
+    print(f"  Rows unchanged since last ingest: {totals['rows_unchanged']}")
+    print(f"  Records updated: {totals['updated']}")
+    print(f"  Records inserted: {totals['inserted']}")
+    if totals.get("dates_unparseable"):
+        print(f"  WARNING: {totals['dates_unparseable']} Transaction_Date values could not be read as dates and were kept as text")
+    print("\nData successfully inserted/updated in the Collections table!")
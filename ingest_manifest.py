@@ -0,0 +1,164 @@
+"""
+Ingest manifest stored in policies.db, so that re-running an ingest script is cheap and safe.
+
+Two tables are kept next to Policies and Collections:
+- IngestFiles: a content hash of every CSV file that was fully ingested, per target table.
+  Running a script again on the same file is then a no-op.
+- IngestRows: for every row written, its key (fcertificate, or Policy_No + Transaction_Date)
+  and a hash of its values. On overlapping files (e.g. "April to 3 May CPS.csv" after an
+  earlier April file) only rows that are new or have changed are written again.
+  The row-by-row modes of the ingest scripts don't hash what they write, so they remove the
+  entries of the rows they wrote instead (see forget_rows); the next bulk ingest then writes
+  those rows again rather than comparing them against values that are no longer in the table.
+
+The manifest is written in the same transaction as the rows themselves, so after a crash the
+database and the manifest still agree and the run can simply be started again.
+
+Dependencies:
+- sqlite3 (built into Python)
+- hashlib, os, datetime (built into Python)
+- pandas (for hashing rows in bulk)
+"""
+
+import hashlib
+import os
+from datetime import datetime
+
+import pandas as pd
+from policies_ingest import KEY_LOOKUP_CHUNK
+
+# Block size used when hashing a CSV file
+FILE_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def ensure_manifest_tables(conn):
+    """Create the IngestFiles and IngestRows tables if they don't exist yet."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS IngestFiles (
+            file_hash TEXT,
+            target_table TEXT,
+            file_name TEXT,
+            rows_in_file INTEGER,
+            ingested_at TEXT,
+            PRIMARY KEY (file_hash, target_table)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS IngestRows (
+            target_table TEXT,
+            row_key TEXT,
+            row_hash INTEGER,
+            PRIMARY KEY (target_table, row_key)
+        )
+    """)
+
+
+def reset_manifest(conn, target_table):
+    """Forget everything ingested into a table (used when the table is dropped and rebuilt)."""
+    ensure_manifest_tables(conn)
+    with conn:
+        conn.execute("DELETE FROM IngestFiles WHERE target_table = ?", (target_table,))
+        conn.execute("DELETE FROM IngestRows WHERE target_table = ?", (target_table,))
+
+
+def file_content_hash(csv_file):
+    """Return the SHA-256 hash of the file's contents."""
+    sha = hashlib.sha256()
+    with open(csv_file, "rb") as f:
+        for block in iter(lambda: f.read(FILE_HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def is_file_ingested(conn, file_hash, target_table):
+    """True if a file with this content hash has already been fully ingested into the table."""
+    ensure_manifest_tables(conn)
+    cursor = conn.execute(
+        "SELECT 1 FROM IngestFiles WHERE file_hash = ? AND target_table = ?",
+        (file_hash, target_table)
+    )
+    return cursor.fetchone() is not None
+
+
+def record_file(conn, file_hash, target_table, csv_file, rows_in_file):
+    """Record that the whole file has been ingested into the table (the caller commits)."""
+    conn.execute(
+        "INSERT OR REPLACE INTO IngestFiles VALUES (?, ?, ?, ?, ?)",
+        (file_hash, target_table, os.path.basename(csv_file), rows_in_file,
+         datetime.now().isoformat(timespec="seconds"))
+    )
+
+
+def row_keys(batch, key_columns):
+    """Build one text key per row from the key columns (empty values become '')."""
+    keys = None
+    for col in key_columns:
+        part = batch[col].astype(object).where(batch[col].notna(), "").astype(str).str.strip()
+        keys = part if keys is None else keys + "|" + part
+    return keys
+
+
+def row_hashes(batch):
+    """Hash every row's values in one vectorized step. Missing values all hash the same way."""
+    values = batch.astype(object).where(batch.notna(), None).astype(str)
+    hashes = pd.util.hash_pandas_object(values, index=False)
+    # SQLite integers are signed 64-bit, so store the unsigned hash's bits as a signed number
+    return pd.Series(hashes.values.view("int64"), index=batch.index)
+
+
+def _stored_hashes(conn, target_table, keys):
+    stored = {}
+    for i in range(0, len(keys), KEY_LOOKUP_CHUNK):
+        chunk = keys[i:i + KEY_LOOKUP_CHUNK]
+        placeholders = ', '.join(['?' for _ in chunk])
+        cursor = conn.execute(
+            f"SELECT row_key, row_hash FROM IngestRows WHERE target_table = ? AND row_key IN ({placeholders})",
+            [target_table] + chunk
+        )
+        stored.update(cursor.fetchall())
+    return stored
+
+
+def filter_changed_rows(conn, target_table, batch, key_columns):
+    """
+    Keep only the rows of the batch that are new or differ from what was last ingested.
+    When a key appears more than once in the batch only its last row is kept, since that is
+    the one that ends up in the table.
+
+    Returns:
+        tuple: (changed rows, their keys, their hashes, number of rows dropped)
+    """
+    keys = row_keys(batch, key_columns)
+    hashes = row_hashes(batch)
+
+    stored = _stored_hashes(conn, target_table, list(dict.fromkeys(keys)))
+    changed = pd.Series(
+        [stored.get(key) != row_hash for key, row_hash in zip(keys, hashes)],
+        index=batch.index, dtype=bool
+    )
+    changed &= ~keys.duplicated(keep="last")
+    return batch[changed], keys[changed], hashes[changed], int((~changed).sum())
+
+
+def record_rows(conn, target_table, keys, hashes):
+    """Remember the hash of every written row (the caller commits)."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO IngestRows VALUES (?, ?, ?)",
+        [(target_table, key, int(row_hash)) for key, row_hash in zip(keys, hashes)]
+    )
+
+
+def forget_rows(conn, target_table, rows, key_columns):
+    """
+    Remove the stored hashes of rows written without going through filter_changed_rows, e.g. by
+    a row-by-row ingest, so they count as changed next time (the caller commits).
+
+    Args:
+        rows (DataFrame): the written rows; only the key columns are used
+        key_columns (list): columns making up the key, as for filter_changed_rows
+    """
+    ensure_manifest_tables(conn)
+    conn.executemany(
+        "DELETE FROM IngestRows WHERE target_table = ? AND row_key = ?",
+        [(target_table, key) for key in row_keys(rows, key_columns).unique()]
+    )
@@ -0,0 +1,216 @@
+"""
+Columnar Parquet copy ("mirror") of the Policies and Collections tables, for analysis.
+
+Reading a whole table out of SQLite with pd.read_sql_query builds every row as Python objects
+first. A Parquet file stores each column separately and compressed, so loading a few columns of
+the whole portfolio takes a fraction of a second, and filters are applied while reading.
+
+The mirror lives in the 'parquet_mirror' folder next to policies.db:
+- parquet_mirror/Policies.parquet: the whole Policies table (rewritten after every sales ingest)
+- parquet_mirror/Collections/Transaction_Month=YYYY-MM/: one folder per month of
+  Transaction_Date ('undated' for rows without a date). After a collections ingest only the
+  months that received new or changed rows are rewritten.
+
+Loading, for example the accepted transactions of April 2025 for two columns only:
+    from parquet_mirror import load_collections
+    df = load_collections(columns=["Policy_No", "Premium"],
+                          filters=[("Transaction_Month", "=", "2025-04"), ("Transaction_type", "=", "Accepted")])
+
+The ingest scripts keep the mirror up to date (see parquet_mirror = True at the top of each).
+To rebuild it from scratch run:
+    python3 parquet_mirror.py
+
+Dependencies:
+- pyarrow (optional; without it the mirror is simply not written)
+- sqlite3 (built into Python), pandas
+
+Notes:
+- SQLite is still the source of truth. The mirror is written after the ingest has committed,
+  so if writing it fails the database is unaffected; rebuild the mirror with the command above.
+- Column types follow the table definitions: TEXT columns are stored as strings, REAL as
+  floats and INTEGER as (nullable) integers.
+- The Collections mirror is read from SQLite and written MIRROR_CHUNK_SIZE rows at a time, so
+  rebuilding it doesn't need the whole table in memory.
+"""
+
+import os
+import shutil
+
+import pandas as pd
+from database import DEFAULT_DB_PATH, connect
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+DEFAULT_MIRROR_DIR = "parquet_mirror"
+
+# Number of Collections rows read from SQLite and written to the mirror at a time
+MIRROR_CHUNK_SIZE = 200000
+
+# Partition column of the Collections mirror, and its value for rows without a Transaction_Date
+MONTH_COLUMN = "Transaction_Month"
+UNDATED_MONTH = "undated"
+
+# Month ('YYYY-MM') of a Collections row, worked out from its day number
+MONTH_SQL = (
+    f"IFNULL(strftime('%Y-%m', Transaction_Date_EpochDay * 86400, 'unixepoch'), '{UNDATED_MONTH}')"
+)
+
+
+def mirror_available():
+    """True if pyarrow is installed, so the mirror can be written and read."""
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The Parquet mirror needs pyarrow: pip install pyarrow")
+
+
+def table_schema(conn, table):
+    """Arrow schema built from the column types declared in SQLite."""
+    arrow_types = {"TEXT": pa.string(), "REAL": pa.float64(), "INTEGER": pa.int64()}
+    return pa.schema([
+        (name, arrow_types.get(declared_type.upper(), pa.string()))
+        for _, name, declared_type, *_ in conn.execute(f"PRAGMA table_info({table})")
+    ])
+
+
+def _to_arrow(df, schema):
+    """Convert a DataFrame read from SQLite to an Arrow table with the given schema."""
+    df = df.copy()
+    for field in schema:
+        col = df[field.name]
+        if pa.types.is_string(field.type):
+            df[field.name] = col.where(col.isna(), col.astype(str))
+        else:
+            # SQLite may hold text in a numeric column; such values can't be stored as numbers
+            df[field.name] = pd.to_numeric(col, errors="coerce")
+            if pa.types.is_integer(field.type):
+                df[field.name] = df[field.name].astype("Int64")
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def write_policies_mirror(conn, mirror_dir=DEFAULT_MIRROR_DIR):
+    """Write the whole Policies table to parquet_mirror/Policies.parquet. Returns the number of rows."""
+    _require_pyarrow()
+    os.makedirs(mirror_dir, exist_ok=True)
+    policies = pd.read_sql_query("SELECT * FROM Policies", conn)
+    path = os.path.join(mirror_dir, "Policies.parquet")
+    # Write to a temporary file first, so a reader never sees a half-written file
+    pq.write_table(_to_arrow(policies, table_schema(conn, "Policies")), path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return len(policies)
+
+
+def staged_months(conn, table):
+    """Months ('YYYY-MM' or 'undated') of the rows in a table with Collections columns, e.g. a staging table."""
+    cursor = conn.execute(f"SELECT DISTINCT {MONTH_SQL} FROM {table}")
+    return sorted(row[0] for row in cursor.fetchall())
+
+
+def write_collections_mirror(conn, mirror_dir=DEFAULT_MIRROR_DIR, months=None, chunk_size=MIRROR_CHUNK_SIZE):
+    """
+    Write the Collections table to the mirror, partitioned by month of Transaction_Date.
+
+    Args:
+        conn: sqlite3 connection to policies.db
+        mirror_dir (str): folder of the mirror
+        months (list): only rewrite these months ('YYYY-MM' or 'undated'); None rewrites everything
+        chunk_size (int): rows read and written at a time
+
+    Returns:
+        int: number of rows written
+    """
+    _require_pyarrow()
+    collections_dir = os.path.join(mirror_dir, "Collections")
+    if months is None or not os.path.isdir(collections_dir):
+        # Full rebuild: start from an empty folder so months that no longer exist disappear
+        shutil.rmtree(collections_dir, ignore_errors=True)
+        query, params = f"SELECT *, {MONTH_SQL} AS {MONTH_COLUMN} FROM Collections", []
+    elif not months:
+        return 0
+    else:
+        # Remove the folders of the months being rewritten, leave the other months alone
+        for month in months:
+            shutil.rmtree(os.path.join(collections_dir, f"{MONTH_COLUMN}={month}"), ignore_errors=True)
+        placeholders = ', '.join(['?' for _ in months])
+        query = f"SELECT *, {MONTH_SQL} AS {MONTH_COLUMN} FROM Collections WHERE {MONTH_SQL} IN ({placeholders})"
+        params = list(months)
+
+    schema = table_schema(conn, "Collections").append(pa.field(MONTH_COLUMN, pa.string()))
+    rows = 0
+    for chunk_number, chunk in enumerate(pd.read_sql_query(query, conn, params=params, chunksize=chunk_size)):
+        pq.write_to_dataset(
+            _to_arrow(chunk, schema),
+            collections_dir,
+            partition_cols=[MONTH_COLUMN],
+            # Every chunk gets files of its own, next to the files of the earlier chunks
+            basename_template=f"part-{chunk_number}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore"
+        )
+        rows += len(chunk)
+    return rows
+
+
+def update_mirror(conn, table, mirror_dir=DEFAULT_MIRROR_DIR, months=None):
+    """
+    Bring the mirror of one table up to date after an ingest has committed. Prints what it did,
+    and skips the mirror (with a message) if pyarrow is not installed.
+    """
+    if not mirror_available():
+        print("\npyarrow is not installed - the Parquet mirror was not updated")
+        return
+    if table == "Policies":
+        rows = write_policies_mirror(conn, mirror_dir)
+        print(f"\nParquet mirror: wrote {rows} Policies rows to '{mirror_dir}'")
+    else:
+        rows = write_collections_mirror(conn, mirror_dir, months)
+        which = "all months" if months is None else f"{len(months)} months"
+        print(f"\nParquet mirror: wrote {rows} Collections rows ({which}) to '{mirror_dir}'")
+
+
+def load_policies(columns=None, filters=None, mirror_dir=DEFAULT_MIRROR_DIR):
+    """
+    Load the Policies mirror into a DataFrame.
+
+    Args:
+        columns (list): only read these columns (default: all)
+        filters (list): pyarrow filters, e.g. [("Status_Name", "in", ["Active", "Active Policy"])]
+        mirror_dir (str): folder of the mirror
+    """
+    _require_pyarrow()
+    path = os.path.join(mirror_dir, "Policies.parquet")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No Parquet mirror at '{path}' - run python3 parquet_mirror.py to build it")
+    return pq.read_table(path, columns=columns, filters=filters).to_pandas()
+
+
+def load_collections(columns=None, filters=None, mirror_dir=DEFAULT_MIRROR_DIR):
+    """
+    Load the Collections mirror into a DataFrame. Filters on Transaction_Month only open the
+    folders of the matching months; other filters skip row groups that can't match.
+
+    Args:
+        columns (list): only read these columns (default: all, including Transaction_Month)
+        filters (list): pyarrow filters, e.g. [("Transaction_Date_EpochDay", ">=", 20000)]
+        mirror_dir (str): folder of the mirror
+    """
+    _require_pyarrow()
+    path = os.path.join(mirror_dir, "Collections")
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"No Parquet mirror at '{path}' - run python3 parquet_mirror.py to build it")
+    partitioning = ds.partitioning(pa.schema([(MONTH_COLUMN, pa.string())]), flavor="hive")
+    return pq.read_table(path, columns=columns, filters=filters, partitioning=partitioning).to_pandas()
+
+
+if __name__ == "__main__":
+    # Rebuild the whole mirror from policies.db
+    conn = connect(DEFAULT_DB_PATH)
+    update_mirror(conn, "Policies")
+    update_mirror(conn, "Collections")
+    conn.close()
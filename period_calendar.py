@@ -0,0 +1,522 @@
+"""
+Vectorized payment-period calendar for report_active_policies.py.
+
+A sub-policy's payment periods used to be generated one month at a time: a Python loop that
+called add_one_month_strict (see status_engine.py) for every period of every policy, building
+new pd.Timestamp objects each time. The functions here work out the periods of every policy at
+once with numpy datetime64 arithmetic, following exactly the same rules:
+
+- PayAt: the first period starts on the InceptionDate, or on the FirstCollectionDate if the
+  policy started before 2022 or starts after today.
+- Direct Debit: the first period starts on the first PreferredCollectionDay after the
+  InceptionDate.
+- Each following period starts one month later on the same day of the month. If the next month
+  doesn't have that day, the period starts on the 1st of the month after instead, and all later
+  periods then start on the 1st (that is what repeating add_one_month_strict does).
+- Periods stop at today: the last one ends today. If the first period starts after today there
+  is a single period, which runs for a whole month.
+
+Because of the "roll to the 1st" rule the start of period k can be worked out directly:
+it is day D of month k (counting from the first period's month) until the first month that is
+too short for day D; from that period on it is the 1st of month k + 1.
+
+Calendars are also kept in a bounded LRU cache (PeriodCalendarCache) keyed by the first period
+start and the as-of date: policies that start on the same day share one calendar, so each
+distinct start is only worked out once, and a run that looks policies up one at a time (or a
+later run, if the cache is saved to a file) reuses what was worked out before. The calendar
+doesn't depend on the collection day, so it is not part of the key.
+
+When the status is worked out for several as-of dates (see status_engine.evaluate_as_of_dates),
+the collections are sorted once (SortedTransactions) and the premium paid in a period is the
+difference between two running totals, found with binary searches, for every date.
+
+Dependencies:
+- numpy, pandas
+- json, os, collections (built into Python)
+
+Notes:
+- Only the first period start keeps the time of day of the date it came from; later periods
+  start at midnight, as add_one_month_strict builds them from the year, month and day only.
+- Policies whose first period can't be worked out (unknown payment method, missing dates,
+  a Direct Debit PreferredCollectionDay that isn't a whole number) are flagged as invalid;
+  status_engine.py reports those with the same error messages as before.
+"""
+
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# PayAt policies that started before this date are billed from their FirstCollectionDate
+PAYAT_INCEPTION_CUTOFF = np.datetime64("2022-01-01", "ns")
+
+ONE_DAY = np.timedelta64(1, "D")
+
+# Number of calendars kept in memory by the cache (the least recently used ones go first)
+CALENDAR_CACHE_SIZE = 4096
+
+# File where cached calendars can be kept between runs (see PeriodCalendarCache.load and save)
+DEFAULT_CALENDAR_CACHE_FILE = "period_calendar_cache.json"
+
+# Days 30 and 31 are missing from every February, but day 29 only from Februaries outside leap
+# years; the next month too short for a day 29-31 is always less than 24 months away
+MAX_MONTHS_TO_SHORT_MONTH = 24
+
+
+def days_in_month(months):
+    """Number of days in each month of a datetime64[M] array."""
+    return ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype(np.int64)
+
+
+def add_months_strict(dates, steps):
+    """
+    Apply add_one_month_strict to each date 'steps' times, for whole arrays at once.
+
+    Args:
+        dates (array): datetime64 dates (the time of day is ignored)
+        steps (array or int): number of months to move each date on (0 returns the date itself)
+
+    Returns:
+        array: datetime64[D] dates
+    """
+    dates = np.asarray(dates).astype("datetime64[D]")
+    steps = np.broadcast_to(np.asarray(steps, dtype=np.int64), dates.shape)
+    months = dates.astype("datetime64[M]")
+    day = (dates - months.astype("datetime64[D]")).astype(np.int64) + 1
+
+    # First step that lands in a month without this day (never, for days 1-28)
+    first_short_step = np.full(dates.shape, np.iinfo(np.int64).max)
+    late_day = day > 28
+    ahead = np.arange(1, MAX_MONTHS_TO_SHORT_MONTH + 1)
+    too_short = days_in_month(months[late_day][:, None] + ahead) < day[late_day][:, None]
+    first_short_step[late_day] = too_short.argmax(axis=1) + 1
+
+    same_day = (months + steps).astype("datetime64[D]") + (day - 1)
+    rolled_to_first = (months + steps + 1).astype("datetime64[D]")
+    return np.where(steps < first_short_step, same_day, rolled_to_first)
+
+
+def full_periods(period_starts, period_ends):
+    """
+    Which periods are a full month: start + relativedelta(months=1) - 1 day <= end, for whole
+    arrays at once. Like relativedelta, a day the next month doesn't have moves to its last day,
+    and the time of day of the start is kept.
+
+    Args:
+        period_starts (array): datetime64 period starts (no NaT)
+        period_ends (array): datetime64 period ends
+
+    Returns:
+        array: True for the full periods
+    """
+    starts = np.asarray(period_starts, dtype="datetime64[ns]")
+    ends = np.asarray(period_ends, dtype="datetime64[ns]")
+    days = starts.astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    day = (days - months.astype("datetime64[D]")).astype(np.int64) + 1
+    next_month = months + 1
+    month_later = (next_month.astype("datetime64[D]") + (np.minimum(day, days_in_month(next_month)) - 1)
+                   + (starts - days))
+    return month_later - ONE_DAY <= ends
+
+
+def _whole_number(value):
+    """int(value), or None if that fails (as int() does for None, NaN and text like '15.0')."""
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def first_period_starts(policies, today_date):
+    """
+    Work out the first period start of every sub-policy.
+
+    Args:
+        policies (DataFrame): FirstCollectionDate and InceptionDate (parsed, datetime64),
+                              Payment_Method and PreferredCollectionDay
+        today_date (Timestamp): date the status is worked out for
+
+    Returns:
+        tuple of arrays: (first period start as datetime64[ns], collection day used for Direct
+        Debit next payment dates, True where the start could be worked out)
+    """
+    today = np.datetime64(pd.Timestamp(today_date), "ns")
+    first_collection = policies["FirstCollectionDate"].to_numpy(dtype="datetime64[ns]")
+    inception = policies["InceptionDate"].to_numpy(dtype="datetime64[ns]")
+    methods = np.array([
+        method.lower() if isinstance(method, str) else None for method in policies["Payment_Method"]
+    ], dtype=object)
+    preferred_days = [_whole_number(day) for day in policies["PreferredCollectionDay"]]
+    has_preferred_day = np.array([day is not None for day in preferred_days], dtype=bool)
+    # Days outside 1-31 only need to be recognised as invalid, so keep them small
+    preferred_day = np.clip([day if day is not None else 0 for day in preferred_days], -1, 99).astype(np.int64)
+
+    # PayAt: the inception date, unless the policy started before 2022 or starts after today
+    payat = methods == "payat"
+    use_first_collection = (inception < PAYAT_INCEPTION_CUTOFF) | (inception > today)
+    payat_start = np.where(use_first_collection, first_collection, inception)
+
+    # Direct Debit: the preferred day in the inception month if that month has it (keeping the
+    # inception's time of day), otherwise add_one_month_strict of the inception date; then one
+    # more month if that is not after the inception date
+    direct_debit = methods == "direct debit"
+    inception_month = inception.astype("datetime64[M]")
+    time_of_day = inception - inception.astype("datetime64[D]")
+    day_fits = (preferred_day >= 1) & (preferred_day <= days_in_month(inception_month))
+    same_month = (inception_month.astype("datetime64[D]") + (np.maximum(preferred_day, 1) - 1)) + time_of_day
+    candidate = np.where(day_fits, same_month, add_months_strict(inception, 1).astype("datetime64[ns]"))
+    debit_start = np.where(candidate > inception, candidate, add_months_strict(candidate, 1).astype("datetime64[ns]"))
+
+    starts = np.where(payat, payat_start, debit_start)
+    valid = (payat | (direct_debit & has_preferred_day)) & ~np.isnat(starts)
+
+    # Collection day for the next payment date: the preferred day if it is a day of the month,
+    # otherwise the day of the first period start
+    start_day = (starts.astype("datetime64[D]") - starts.astype("datetime64[M]").astype("datetime64[D]")).astype(np.int64) + 1
+    collection_day = np.where((preferred_day > 0) & (preferred_day < 32), preferred_day, start_day)
+    return starts, collection_day, valid
+
+
+class PeriodCalendarCache:
+    """
+    Bounded LRU cache of period calendars, keyed by (first period start, as-of date), with hit
+    and miss counters to see how often calendars are shared.
+    """
+
+    def __init__(self, max_size=CALENDAR_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # (start, as-of date) as int64 nanoseconds -> (period starts, period ends) as int64 nanoseconds
+        self._calendars = OrderedDict()
+
+    def __len__(self):
+        return len(self._calendars)
+
+    def get(self, key):
+        """The (period starts, period ends) of a key, or None; counts a hit or a miss."""
+        calendar = self._calendars.get(key)
+        if calendar is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._calendars.move_to_end(key)
+        return calendar
+
+    def put(self, key, calendar):
+        self._calendars[key] = calendar
+        self._calendars.move_to_end(key)
+        while len(self._calendars) > self.max_size:
+            self._calendars.popitem(last=False)
+
+    def stats(self):
+        """Hits, misses, hit rate and size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._calendars),
+            "max_size": self.max_size,
+        }
+
+    def clear(self):
+        """Drop every calendar and reset the counters."""
+        self._calendars.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, cache_file=DEFAULT_CALENDAR_CACHE_FILE):
+        """Add the calendars saved in cache_file (if it exists). Returns the number loaded."""
+        if not os.path.exists(cache_file):
+            return 0
+        try:
+            with open(cache_file) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            # A damaged cache file is simply rebuilt
+            return 0
+        for start, today, period_starts, period_ends in stored:
+            self.put((start, today), (np.array(period_starts, dtype=np.int64), np.array(period_ends, dtype=np.int64)))
+        return len(stored)
+
+    def save(self, cache_file=DEFAULT_CALENDAR_CACHE_FILE):
+        """Write the cached calendars to cache_file, least recently used first."""
+        stored = [[start, today, period_starts.tolist(), period_ends.tolist()]
+                  for (start, today), (period_starts, period_ends) in self._calendars.items()]
+        with open(cache_file, "w") as f:
+            json.dump(stored, f)
+
+
+# Cache used by period_calendar unless told otherwise
+calendar_cache = PeriodCalendarCache()
+
+
+def period_calendar(starts, today_date, cache=calendar_cache):
+    """
+    Build the payment periods of every sub-policy from their first period starts.
+
+    Args:
+        starts (array): first period start of each sub-policy (datetime64, no NaT)
+        today_date (Timestamp): date the status is worked out for
+        cache (PeriodCalendarCache): where calendars are looked up and kept; each distinct start
+                                     is worked out at most once (None works every policy out)
+
+    Returns:
+        tuple: (DataFrame with one row per period - policy (position in starts), period_start,
+        period_end - ordered by policy and then by period; array that is True for the
+        sub-policies whose first period starts after today)
+    """
+    today = np.datetime64(pd.Timestamp(today_date), "ns")
+    starts = np.asarray(starts, dtype="datetime64[ns]")
+    first_after_today = starts > today
+    if cache is None:
+        return _build_calendar(starts, today), first_after_today
+
+    # Look every distinct start up once; work out the missing ones together
+    distinct, inverse = np.unique(starts.view(np.int64), return_inverse=True)
+    today_key = int(today.view(np.int64))
+    calendars = [cache.get((int(start), today_key)) for start in distinct]
+    missing = [position for position, calendar in enumerate(calendars) if calendar is None]
+    if missing:
+        built = _build_calendar(distinct[missing].view("datetime64[ns]"), today)
+        bounds = np.searchsorted(built["policy"].to_numpy(), np.arange(len(missing) + 1))
+        built_starts = built["period_start"].to_numpy().view(np.int64)
+        built_ends = built["period_end"].to_numpy().view(np.int64)
+        for row, position in enumerate(missing):
+            calendar = (built_starts[bounds[row]:bounds[row + 1]].copy(), built_ends[bounds[row]:bounds[row + 1]].copy())
+            cache.put((int(distinct[position]), today_key), calendar)
+            calendars[position] = calendar
+
+    # Copy each policy's shared calendar into place
+    lengths = np.array([len(period_starts) for period_starts, _ in calendars], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    all_starts = np.concatenate([period_starts for period_starts, _ in calendars]) if calendars else np.array([], np.int64)
+    all_ends = np.concatenate([period_ends for _, period_ends in calendars]) if calendars else np.array([], np.int64)
+    counts = lengths[inverse]
+    policy = np.repeat(np.arange(len(starts)), counts)
+    rows = np.repeat(offsets[inverse], counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    calendar = pd.DataFrame({
+        "policy": policy,
+        "period_start": all_starts[rows].view("datetime64[ns]"),
+        "period_end": all_ends[rows].view("datetime64[ns]"),
+    })
+    return calendar, first_after_today
+
+
+def _build_calendar(starts, today):
+    """The calendar DataFrame of period_calendar, worked out for every start (no cache)."""
+    first_after_today = starts > today
+
+    # Months from the first period to today, plus two, is always enough periods; the extra
+    # ones start after today and are dropped below
+    months_to_today = (today.astype("datetime64[M]") - starts.astype("datetime64[M]")).astype(np.int64)
+    candidates = np.where(starts < today, np.maximum(months_to_today, 0) + 2, 1)
+    policy = np.repeat(np.arange(len(starts)), candidates)
+    step = np.arange(len(policy)) - np.repeat(np.cumsum(candidates) - candidates, candidates)
+
+    start_dates = starts[policy]
+    period_start = np.where(step == 0, start_dates, add_months_strict(start_dates, step).astype("datetime64[ns]"))
+    next_start = add_months_strict(start_dates, step + 1).astype("datetime64[ns]")
+    period_end = next_start - ONE_DAY
+    # Only a first period that starts after today runs past today
+    period_end = np.where(first_after_today[policy], period_end, np.minimum(period_end, today))
+
+    # The first period is always kept, later ones only if they start before today
+    keep = (step == 0) | (period_start < today)
+    calendar = pd.DataFrame({
+        "policy": policy[keep],
+        "period_start": period_start[keep],
+        "period_end": period_end[keep],
+    })
+    return calendar
+
+
+def period_totals(calendar, transaction_policy, transaction_dates, transaction_premiums):
+    """
+    Total premium paid in every period of the calendar, for the whole portfolio in one go.
+
+    Rather than filtering the transactions once per period, every transaction is placed in its
+    period with one binary search (np.searchsorted) over the sorted period starts, and the
+    premiums are then added up per period. A transaction counts towards a period if its date
+    lies between the period's start and end (both included), as before.
+
+    Args:
+        calendar (DataFrame): periods from period_calendar
+        transaction_policy (array): position of each transaction's sub-policy (-1 if not in the calendar)
+        transaction_dates (array): date of each transaction (datetime64, NaT if unknown)
+        transaction_premiums (array): premium of each transaction (float, NaN if unknown)
+
+    Returns:
+        array: total premium paid in each period (float), in calendar order
+    """
+    period_policy = calendar["policy"].to_numpy(dtype=np.int64)
+    starts = calendar["period_start"].to_numpy(dtype="datetime64[ns]")
+    ends = calendar["period_end"].to_numpy(dtype="datetime64[ns]")
+    policy = np.asarray(transaction_policy, dtype=np.int64)
+    dates = np.asarray(transaction_dates, dtype="datetime64[ns]")
+    premiums = np.asarray(transaction_premiums, dtype="float64")
+
+    usable = (policy >= 0) & ~np.isnat(dates)
+    policy, dates = policy[usable], dates[usable]
+    # Unknown premiums add nothing, as pandas' sum skips them
+    premiums = np.where(np.isnan(premiums[usable]), 0.0, premiums[usable])
+
+    # Replace every date by its rank among all the dates involved, so that (policy, date) fits in
+    # one sortable integer key without losing any precision
+    periods = len(starts)
+    _, rank = np.unique(np.concatenate([starts, ends, dates]), return_inverse=True)
+    width = np.int64(len(rank) + 1)
+    start_key = period_policy * width + rank[:periods]
+    end_key = period_policy * width + rank[periods:2 * periods]
+    transaction_key = policy * width + rank[2 * periods:]
+
+    # Calendar rows are ordered by policy and start, so the keys of the starts are sorted: the
+    # period of a transaction is the last one starting at or before it, if it hasn't ended yet
+    period = np.searchsorted(start_key, transaction_key, side="right") - 1
+    in_period = (period >= 0) & (transaction_key <= end_key[np.maximum(period, 0)])
+    period, premiums = period[in_period], premiums[in_period]
+
+    # Adding up in transaction order gives the same result as summing each period's premiums
+    # with numpy, except that numpy adds up 8 or more values pairwise; redo those periods its way
+    # (bincount gives integers when there is nothing to add up, so make sure the totals are floats)
+    totals = np.bincount(period, weights=premiums, minlength=periods).astype(np.float64)
+    counts = np.bincount(period, minlength=periods)
+    long_periods = np.flatnonzero(counts >= 8)
+    if len(long_periods):
+        order = np.argsort(period, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        for index in long_periods:
+            totals[index] = premiums[order[bounds[index]:bounds[index + 1]]].sum()
+    return totals
+
+
+class SortedTransactions:
+    """
+    The collections of a portfolio sorted once by sub-policy and date, with running totals of
+    their premiums, so that the premium paid in the periods of any number of calendars (one per
+    as-of date) can be worked out without sorting them again (see period_totals).
+    """
+
+    def __init__(self, transaction_policy, transaction_dates, transaction_premiums):
+        """
+        Args:
+            transaction_policy (array): position of each transaction's sub-policy (-1 if not in the portfolio)
+            transaction_dates (array): date of each transaction (datetime64, NaT if unknown)
+            transaction_premiums (array): premium of each transaction (float, NaN if unknown)
+        """
+        policy = np.asarray(transaction_policy, dtype=np.int64)
+        dates = np.asarray(transaction_dates, dtype="datetime64[ns]")
+        premiums = np.asarray(transaction_premiums, dtype="float64")
+        # Kept as given, for the periods the running totals can't add up exactly
+        self._transactions = (policy, dates, premiums)
+
+        usable = (policy >= 0) & ~np.isnat(dates)
+        policy, dates = policy[usable], dates[usable]
+        # Unknown premiums add nothing, as in period_totals
+        premiums = np.where(np.isnan(premiums[usable]), 0.0, premiums[usable])
+
+        # Sort by (policy, date) using the rank of each date, as period_totals does
+        self._dates, rank = np.unique(dates, return_inverse=True)
+        self._width = np.int64(len(self._dates) + 1)
+        keys = policy * self._width + rank
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        premiums = premiums[order]
+
+        # Whole amounts add up exactly in any order, so a difference of running totals is exactly
+        # what period_totals gives. Other amounts are left out of the running totals and only
+        # counted, so that the periods they fall into can be added up the usual way
+        whole = premiums == np.round(premiums)
+        self._running_total = np.concatenate([[0.0], np.cumsum(np.where(whole, premiums, 0.0))])
+        self._running_not_whole = np.concatenate([[0], np.cumsum(~whole)])
+
+    def period_totals(self, calendar):
+        """
+        Total premium paid in every period of the calendar; the same values as period_totals.
+
+        Args:
+            calendar (DataFrame): periods from period_calendar (positions in the same portfolio)
+
+        Returns:
+            array: total premium paid in each period (float), in calendar order
+        """
+        period_policy = calendar["policy"].to_numpy(dtype=np.int64)
+        starts = calendar["period_start"].to_numpy(dtype="datetime64[ns]")
+        ends = calendar["period_end"].to_numpy(dtype="datetime64[ns]")
+
+        # The period's transactions are the ones of its policy dated from its start to its end
+        first = np.searchsorted(self._keys, period_policy * self._width + np.searchsorted(self._dates, starts, side="left"))
+        last = np.searchsorted(self._keys, period_policy * self._width + np.searchsorted(self._dates, ends, side="right"))
+        # A first period that starts after today ends before it starts, and holds nothing
+        last = np.maximum(first, last)
+
+        totals = self._running_total[last] - self._running_total[first]
+        not_whole = np.flatnonzero(self._running_not_whole[last] > self._running_not_whole[first])
+        if len(not_whole):
+            policy, dates, premiums = self._transactions
+            totals[not_whole] = period_totals(calendar.iloc[not_whole], policy, dates, premiums)
+        return totals
+
+
+def next_status_change(calendar, first_after_today, payat_inception, transaction_policy, transaction_dates,
+                       today_date):
+    """
+    The first as-of date after today_date on which each sub-policy's status could be different,
+    assuming none of its data changes. Until then a status worked out for today_date still holds.
+
+    A status only moves with the as-of date when:
+    - a new period starts (the day after the next period start, as periods start before today),
+    - the last period becomes a full month (its start plus one month, less one day),
+    - a first period that starts after today is reached,
+    - a PayAt policy's inception date is reached (it stops starting after today),
+    - a transaction dated after today falls into the last period.
+    The dates are rounded down to the day, so a status is never kept for too long.
+
+    Args:
+        calendar (DataFrame): periods from period_calendar
+        first_after_today (array): from period_calendar
+        payat_inception (array): InceptionDate of PayAt sub-policies (datetime64, NaT for the others)
+        transaction_policy (array): position of each transaction's sub-policy (-1 if not in the calendar)
+        transaction_dates (array): date of each transaction (datetime64, NaT if unknown)
+        today_date (Timestamp): date the status was worked out for
+
+    Returns:
+        array: datetime64[D] date of the next possible change of each sub-policy (NaT if never)
+    """
+    today = np.datetime64(pd.Timestamp(today_date), "ns")
+    today_day = today.astype("datetime64[D]")
+    sub_policies = len(first_after_today)
+    period_policy = calendar["policy"].to_numpy(dtype=np.int64)
+    period_start = calendar["period_start"].to_numpy(dtype="datetime64[ns]")
+    last_start = period_start[np.searchsorted(period_policy, np.arange(sub_policies), side="right") - 1]
+    last_day = last_start.astype("datetime64[D]")
+
+    # Start of the period after the last one (a new period appears the day after)
+    new_period = add_months_strict(last_start, 1) + 1
+    # Start plus one month (relativedelta moves to the last day of a shorter month), less one day
+    next_month = last_start.astype("datetime64[M]") + 1
+    day = (last_day - last_start.astype("datetime64[M]").astype("datetime64[D]")).astype(np.int64) + 1
+    full_month = next_month.astype("datetime64[D]") + (np.minimum(day, days_in_month(next_month)) - 1) - 1
+    # First period that hasn't started yet
+    first_start = np.where(first_after_today, last_day, np.datetime64("NaT", "D"))
+    inception = np.asarray(payat_inception, dtype="datetime64[ns]").astype("datetime64[D]")
+
+    # Earliest transaction of each sub-policy dated after today
+    policy = np.asarray(transaction_policy, dtype=np.int64)
+    dates = np.asarray(transaction_dates, dtype="datetime64[ns]")
+    future = (policy >= 0) & ~np.isnat(dates) & (dates > today)
+    earliest = np.full(sub_policies, np.iinfo(np.int64).max)
+    np.minimum.at(earliest, policy[future], dates[future].astype("datetime64[D]").astype(np.int64))
+    earliest = np.where(earliest == np.iinfo(np.int64).max, np.datetime64("NaT", "D"),
+                        earliest.astype("datetime64[D]"))
+
+    change = np.full(sub_policies, np.datetime64("NaT", "D"))
+    for candidate in [new_period, full_month, first_start, inception, earliest]:
+        # Only dates after today are changes still to come
+        upcoming = ~np.isnat(candidate) & (candidate > today_day)
+        change = np.where(upcoming & (np.isnat(change) | (candidate < change)), candidate, change)
+    return change
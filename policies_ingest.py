@@ -0,0 +1,197 @@
+"""
+Bulk helpers for writing sales data into the 'Policies' table of policies.db.
+
+Instead of looking up the column mapping and running a SELECT plus an UPDATE or INSERT
+for every row of the sales CSV, the functions here:
+1. Use a column mapping that has been resolved once for the whole file.
+2. Build the batch of rows to write with vectorized pandas operations.
+3. Bulk-load the batch into a temporary staging table and merge it into Policies with
+   set-based SQL (insert new fcertificates, update changed ones).
+
+The results are the same as the row-by-row path in add_new_sales.py: when an fcertificate
+appears more than once in the file the last row wins.
+
+The staging and merge helpers are also used for the Collections table (see collections_ingest.py).
+
+Dependencies:
+- sqlite3 (built into Python)
+- pandas (for handling the CSV data)
+"""
+
+import pandas as pd
+from change_log import record_changes_sql
+from date_columns import DATE_COLUMNS, with_epoch_day_columns
+
+# Columns of the Policies table needed by report_active_policies.py
+POLICY_COLUMNS = [
+    "fcertificate",
+    "FirstCollectionDate",
+    "Premium",
+    "Payment_Method",
+    "PreferredCollectionDay",
+    "InceptionDate",
+    "TransactionNo",
+    "Status_Name",
+    "CellPhone",
+    "Client_Name",
+    "PayAtReference"
+]
+
+# Columns that must be present in a sales CSV; the others are left empty if they can't be found
+MANDATORY_POLICY_COLUMNS = [
+    "fcertificate",
+    "Premium",
+    "Payment_Method",
+    "InceptionDate",
+    "TransactionNo",
+    "Status_Name"
+]
+
+# SQLite limits the number of ? placeholders in one statement, so look up keys in chunks
+KEY_LOOKUP_CHUNK = 500
+
+
+def build_policies_batch(df, column_map, required_columns=POLICY_COLUMNS):
+    """
+    Build the batch of Policies rows from the sales DataFrame in one vectorized step.
+
+    Args:
+        df (DataFrame): sales data with cleaned column names
+        column_map (dict): required column -> matching CSV column (or None if not found)
+        required_columns (list): columns of the Policies table to fill
+
+    Returns:
+        DataFrame: one row per CSV row with an fcertificate, columns in required_columns order
+    """
+    batch = pd.DataFrame(index=df.index)
+    for target_col in required_columns:
+        csv_col = column_map.get(target_col)
+        if csv_col is not None:
+            batch[target_col] = df[csv_col]
+        else:
+            batch[target_col] = None
+
+    # Skip rows with no fcertificate value
+    key = batch["fcertificate"]
+    has_key = key.notna() & (key.astype(str) != "")
+    return batch[has_key].reset_index(drop=True)
+
+
+def batch_rows(batch):
+    """Turn a DataFrame into a list of plain Python tuples, with missing values as None."""
+    values = batch.astype(object).where(batch.notna(), None)
+    return list(values.itertuples(index=False, name=None))
+
+
+def key_expression(col, null_as_empty, alias=""):
+    """SQL for one key column; columns in null_as_empty treat NULL as '' so that NULL keys collide."""
+    if col in null_as_empty:
+        return f"IFNULL({alias}{col}, '')"
+    return f"{alias}{col}"
+
+
+def staging_join_sql(key_columns, null_as_empty=()):
+    """SQL condition matching a staging row (alias s) with the target row (alias t) that has the same key."""
+    return ' AND '.join(
+        f"{key_expression(col, null_as_empty, 't.')} = {key_expression(col, null_as_empty, 's.')}"
+        for col in key_columns
+    )
+
+
+def changed_values_sql(value_columns):
+    """SQL condition that is true when a staging row (alias s) differs from its target row (alias t)."""
+    return ' OR '.join(f"t.{col} IS NOT s.{col}" for col in value_columns)
+
+
+def create_staging_table(conn, staging_table, target_table, columns, key_columns, null_as_empty=()):
+    """
+    Create an empty temporary staging table with the same columns (and column types) as the
+    target table. A unique index on the key means INSERT OR REPLACE keeps only the last row per key.
+    """
+    key_sql = ', '.join(key_expression(col, null_as_empty) for col in key_columns)
+    conn.execute(f"DROP TABLE IF EXISTS temp.{staging_table}")
+    conn.execute(f"CREATE TEMP TABLE {staging_table} AS SELECT {', '.join(columns)} FROM {target_table} WHERE 0")
+    conn.execute(f"CREATE UNIQUE INDEX temp.idx_{staging_table}_key ON {staging_table} ({key_sql})")
+
+
+def load_staging_table(conn, staging_table, batch, columns):
+    """Bulk-load the batch into the staging table (the last row wins when a key repeats)."""
+    placeholders = ', '.join(['?' for _ in columns])
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {staging_table} ({', '.join(columns)}) VALUES ({placeholders})",
+        batch_rows(batch[columns])
+    )
+
+
+def merge_staging_table(conn, staging_table, target_table, columns, key_columns, null_as_empty=()):
+    """
+    Merge the staging table into the target table with set-based SQL: insert the rows whose key
+    is new and update the rows whose values have changed. Rows that are identical are not touched.
+    Does not commit, so the caller decides what else belongs in the same transaction.
+
+    Returns:
+        tuple: (rows inserted, rows updated, rows unchanged)
+    """
+    value_columns = [col for col in columns if col not in key_columns]
+    join = staging_join_sql(key_columns, null_as_empty)
+    changed = changed_values_sql(value_columns)
+
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT COUNT(*) FROM {staging_table}")
+    staged = cursor.fetchone()[0]
+    cursor.execute(f"""
+        SELECT COUNT(*), SUM(CASE WHEN {changed} THEN 1 ELSE 0 END)
+        FROM {staging_table} s JOIN {target_table} t ON {join}
+    """)
+    existing, updated = cursor.fetchone()
+    updated = updated or 0
+
+    conflict_target = ', '.join(key_expression(col, null_as_empty) for col in key_columns)
+    set_clauses = ', '.join(f"{col} = excluded.{col}" for col in value_columns)
+    changed_excluded = ' OR '.join(f"{target_table}.{col} IS NOT excluded.{col}" for col in value_columns)
+    cursor.execute(f"""
+        INSERT INTO {target_table} ({', '.join(columns)})
+        SELECT {', '.join(columns)} FROM {staging_table} WHERE true
+        ON CONFLICT({conflict_target}) DO UPDATE SET {set_clauses}
+        WHERE {changed_excluded}
+    """)
+    cursor.execute(f"DROP TABLE temp.{staging_table}")
+    return staged - existing, updated, existing - updated
+
+
+def record_staged_changes(conn, staging_table, target_table, columns, key_columns, policy_column,
+                          null_as_empty=(), main_policy_column=None):
+    """
+    Add the sub-policies of the staged rows that are new or have changed to the change log (see
+    change_log.py). Must run before the merge. Does not commit.
+
+    Args:
+        policy_column (str): column of the staging table holding the fcertificate
+        main_policy_column (str): column of the target table holding the TransactionNo, if any, so
+                                  the main policy before the change is recorded as well
+    """
+    value_columns = [col for col in columns if col not in key_columns]
+    old_main_policy = f"t.{main_policy_column}" if main_policy_column else "NULL"
+    record_changes_sql(conn, f"""
+        SELECT DISTINCT s.{policy_column}, {old_main_policy}
+        FROM {staging_table} s LEFT JOIN {target_table} t ON {staging_join_sql(key_columns, null_as_empty)}
+        WHERE t.rowid IS NULL OR {changed_values_sql(value_columns)}
+    """, [], target_table)
+
+
+def merge_policies(conn, batch, required_columns=POLICY_COLUMNS):
+    """
+    Write the batch to the Policies table through a temporary staging table: bulk-load it, then
+    insert new fcertificates and update changed ones with set-based SQL. The changed
+    fcertificates are added to the change log. Does not commit.
+    The batch's dates must already be normalized (see date_columns.normalize_date_columns).
+
+    Returns:
+        tuple: (rows inserted, rows updated, rows unchanged), counting each fcertificate once
+    """
+    table_columns = with_epoch_day_columns(required_columns, DATE_COLUMNS["Policies"])
+    create_staging_table(conn, "staging_policies", "Policies", table_columns, ["fcertificate"])
+    load_staging_table(conn, "staging_policies", batch, table_columns)
+    record_staged_changes(conn, "staging_policies", "Policies", table_columns, ["fcertificate"], "fcertificate",
+                          main_policy_column="TransactionNo")
+    return merge_staging_table(conn, "staging_policies", "Policies", table_columns, ["fcertificate"])
@@ -0,0 +1,302 @@
+"""
+Streaming writers ("sinks") for the files made by report_active_policies.py.
+
+The report used to collect every row in a list, turn it into a DataFrame, print the whole frame
+and only then save it with to_csv. A sink takes the rows one at a time instead and writes them
+out in chunks of chunk_size rows, so memory use stays the same however large the portfolio grows,
+and several files (and formats) can be filled in the same pass over the main policies.
+
+Formats (see open_report_sink, and ReportSinks to write several at once):
+- "csv", "csv.gz", "csv.zst": CSV, plain or compressed with gzip or zstd. The values are written
+  the way to_csv wrote them before, so the plain CSV files don't change: missing values are left
+  empty, the float_columns (PayAtReference and Amount due in the report) are always written as
+  floats (e.g. 3758633299.0 and 1950.0), dates as YYYY-MM-DD and everything else as text.
+- "jsonl", "jsonl.gz", "jsonl.zst": one JSON object per line, with the typed values below.
+- "parquet": a Parquet file with one row group per chunk, with the typed schema below. Dialers,
+  SMS systems and analysis tools can read the columns they need without parsing any text.
+
+The typed formats give each column one type (COLUMN_TYPES): text, int, float or timestamp.
+Missing values, and values that aren't of the column's type, become null; PayAtReference is a
+whole number there rather than a float.
+
+Each file is written under a temporary name and only renamed when it is complete, so a report
+that stops halfway never leaves a half-written file behind.
+
+Dependencies:
+- csv, gzip, io, json, os (built into Python)
+- pandas (only to recognise missing values and dates)
+- pyarrow (optional; needed for "parquet" and the zstd formats only)
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import date
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Number of rows kept before they are written out
+DEFAULT_CHUNK_SIZE = 10000
+
+# Formats open_report_sink understands (also the file extension they get)
+OUTPUT_FORMATS = ["csv", "csv.gz", "csv.zst", "jsonl", "jsonl.gz", "jsonl.zst", "parquet"]
+
+# Type of each column of the report files in the typed formats (columns not listed are text)
+COLUMN_TYPES = {
+    "CellPhone": "text",
+    "Client_Name": "text",
+    "TransactionNo": "text",
+    "PreferredCollectionDay": "int",
+    "PayAtReference": "int",
+    "PayAtQR": "text",
+    "Payment_Method": "text",
+    "Amount due": "float",
+    # "Mixed" when the sub-policies of a main policy disagree, so kept as text
+    "Next Payment Due": "text",
+    # Period ledger (see status_engine.period_ledger)
+    "fcertificate": "text",
+    "Period Start": "timestamp",
+    "Period End": "timestamp",
+    "Premium Paid": "float",
+    "Premium Expected": "float",
+}
+
+
+def _is_missing(value):
+    return value is None or (pd.api.types.is_scalar(value) and pd.isna(value))
+
+
+def csv_value(value, as_float=False):
+    """Text written to a CSV file for one value (see the rules above)."""
+    if _is_missing(value):
+        return ""
+    if as_float:
+        try:
+            return repr(float(value))
+        except (TypeError, ValueError):
+            return str(value)
+    if isinstance(value, float):
+        return repr(float(value))
+    if isinstance(value, pd.Timestamp):
+        return value.date().isoformat() if value == value.normalize() else str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def typed_value(value, column_type):
+    """A value converted to its column's type for the typed formats (None if missing or not of that type)."""
+    if _is_missing(value):
+        return None
+    try:
+        if column_type == "int":
+            return int(float(value))
+        if column_type == "float":
+            return float(value)
+        if column_type == "timestamp":
+            return pd.Timestamp(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return csv_value(value)
+
+
+def _require_pyarrow(output_format):
+    if pa is None:
+        raise ImportError(f"The '{output_format}' report format needs pyarrow: pip install pyarrow")
+
+
+def _open_binary(path, compression):
+    """Binary file to write to, compressed with gzip or zstd if asked."""
+    if compression == "gz":
+        return gzip.open(path, "wb")
+    if compression == "zst":
+        _require_pyarrow("zst")
+        return pa.CompressedOutputStream(path, "zstd")
+    return open(path, "wb")
+
+
+class ReportSink:
+    """
+    Base class of the sinks: keeps the rows (dicts) handed to write and passes them on to
+    _write_chunk chunk_size at a time. Use a sink in a with block: the file is only saved under
+    its real name if the block finishes without an error.
+    """
+
+    def __init__(self, path, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self._chunk = []
+        self._temp_path = f"{path}.partial"
+        self._closed = False
+
+    def write(self, row):
+        """Add one row; columns missing from the dict are left empty."""
+        self._chunk.append(row)
+        self.rows += 1
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write out the rows kept so far."""
+        if self._chunk:
+            self._write_chunk(self._chunk)
+            self._chunk = []
+
+    def close(self, keep=True):
+        """Write out the last rows and close the file, saving it under its real name (keep) or throwing it away."""
+        if self._closed:
+            return
+        self._closed = True
+        if keep:
+            self.flush()
+        self._finish()
+        if keep:
+            os.replace(self._temp_path, self.path)
+        else:
+            os.remove(self._temp_path)
+
+    def _write_chunk(self, rows):
+        raise NotImplementedError
+
+    def _finish(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close(keep=exc_type is None)
+        return False
+
+
+class CsvReportSink(ReportSink):
+    """CSV file, plain or compressed ("gz" or "zst"), formatted like to_csv (see csv_value)."""
+
+    def __init__(self, path, columns, float_columns=(), compression=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(path, columns, chunk_size)
+        self.float_columns = set(float_columns)
+        self._file = _open_binary(self._temp_path, compression)
+        self._write_lines([self.columns])
+
+    def _write_chunk(self, rows):
+        self._write_lines([[csv_value(row.get(column), column in self.float_columns) for column in self.columns]
+                           for row in rows])
+
+    def _write_lines(self, lines):
+        text = io.StringIO()
+        csv.writer(text, lineterminator="\n").writerows(lines)
+        self._file.write(text.getvalue().encode("utf-8"))
+
+    def _finish(self):
+        self._file.close()
+
+
+class JsonlReportSink(ReportSink):
+    """Newline-delimited JSON, plain or compressed ("gz" or "zst"), with typed values (see typed_value)."""
+
+    def __init__(self, path, columns, compression=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__(path, columns, chunk_size)
+        self._types = [COLUMN_TYPES.get(column, "text") for column in self.columns]
+        self._file = _open_binary(self._temp_path, compression)
+
+    def _write_chunk(self, rows):
+        lines = []
+        for row in rows:
+            values = {}
+            for column, column_type in zip(self.columns, self._types):
+                value = typed_value(row.get(column), column_type)
+                # JSON has no dates: timestamps are written as text, like in the CSV files
+                values[column] = csv_value(value) if column_type == "timestamp" and value is not None else value
+            lines.append(json.dumps(values) + "\n")
+        self._file.write("".join(lines).encode("utf-8"))
+
+    def _finish(self):
+        self._file.close()
+
+
+class ParquetReportSink(ReportSink):
+    """Parquet file with the typed schema (see COLUMN_TYPES), one row group per chunk."""
+
+    def __init__(self, path, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+        _require_pyarrow("parquet")
+        super().__init__(path, columns, chunk_size)
+        self._types = [COLUMN_TYPES.get(column, "text") for column in self.columns]
+        arrow_types = {"text": pa.string(), "int": pa.int64(), "float": pa.float64(), "timestamp": pa.timestamp("ns")}
+        self.schema = pa.schema([(column, arrow_types[column_type])
+                                 for column, column_type in zip(self.columns, self._types)])
+        self._writer = pq.ParquetWriter(self._temp_path, self.schema)
+
+    def _write_chunk(self, rows):
+        arrays = {
+            column: [typed_value(row.get(column), column_type) for row in rows]
+            for column, column_type in zip(self.columns, self._types)
+        }
+        self._writer.write_table(pa.Table.from_pydict(arrays, schema=self.schema))
+
+    def _finish(self):
+        self._writer.close()
+
+
+def open_report_sink(path_stem, columns, output_format="csv", float_columns=(), chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Open a sink writing to path_stem + "." + output_format (see OUTPUT_FORMATS).
+
+    Args:
+        columns (list): columns of the file, in order
+        float_columns (list): CSV only: columns always written as floats
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown report format '{output_format}' (use one of {', '.join(OUTPUT_FORMATS)})")
+    path = f"{path_stem}.{output_format}"
+    kind, _, compression = output_format.partition(".")
+    if kind == "csv":
+        return CsvReportSink(path, columns, float_columns, compression or None, chunk_size)
+    if kind == "jsonl":
+        return JsonlReportSink(path, columns, compression or None, chunk_size)
+    return ParquetReportSink(path, columns, chunk_size)
+
+
+class ReportSinks:
+    """The same rows written to several sinks at once, e.g. one file in each output format."""
+
+    def __init__(self, path_stem, columns, output_formats=("csv",), float_columns=(), chunk_size=DEFAULT_CHUNK_SIZE):
+        self.sinks = []
+        try:
+            for output_format in output_formats:
+                self.sinks.append(open_report_sink(path_stem, columns, output_format, float_columns, chunk_size))
+        except Exception:
+            self.close(keep=False)
+            raise
+
+    @property
+    def rows(self):
+        return self.sinks[0].rows if self.sinks else 0
+
+    @property
+    def paths(self):
+        return [sink.path for sink in self.sinks]
+
+    def write(self, row):
+        for sink in self.sinks:
+            sink.write(row)
+
+    def close(self, keep=True):
+        for sink in self.sinks:
+            sink.close(keep)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close(keep=exc_type is None)
+        return False
@@ -1,10 +1,20 @@
 """
 This script checks if all policies in the Collections table have a status of either 'Active' or 'Cancelled'.
 In other words, it checks all the policies for which payment has been made, then checks that they are either active or cancelled (not void)
+If the Parquet mirror of the tables exists (see parquet_mirror.py) the two columns needed are read from it instead of from SQLite.
 """
+import os
+import sys
 import sqlite3
 import pandas as pd
 
+# The shared modules are in the main MicroInsure folder, one level up from this one
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parquet_mirror import DEFAULT_MIRROR_DIR, load_collections, load_policies, mirror_available
+
+# Read from the Parquet mirror when it is there
+use_parquet_mirror = True
+
 # Connect to your database
 conn = sqlite3.connect("policies.db")
 
@@ -13,16 +23,22 @@ conn = sqlite3.connect("policies.db")
 #DISTINCT removes duplicate values
 #AS fcertificate is a column alias. It renames [Policy No] to fcertificate in the result of the query, so you can reference more easily
 # Step 2: Join with Policies to get their Status_Name
-status_check = pd.read_sql_query(
-    """
-    SELECT p.fcertificate, p.Status_Name
-    FROM Policies p
-    INNER JOIN (
-        SELECT DISTINCT Policy_No AS fcertificate FROM Collections
-    ) c ON p.fcertificate = c.fcertificate
-    """,
-    conn
-)
+if use_parquet_mirror and mirror_available() and os.path.isdir(DEFAULT_MIRROR_DIR):
+    # Only the needed columns are read from the mirror; merge does the same inner join as the SQL below
+    policies = load_policies(columns=["fcertificate", "Status_Name"])
+    paid = load_collections(columns=["Policy_No"])["Policy_No"].drop_duplicates().rename("fcertificate")
+    status_check = policies.merge(paid, on="fcertificate", how="inner")
+else:
+    status_check = pd.read_sql_query(
+        """
+        SELECT p.fcertificate, p.Status_Name
+        FROM Policies p
+        INNER JOIN (
+            SELECT DISTINCT Policy_No AS fcertificate FROM Collections
+        ) c ON p.fcertificate = c.fcertificate
+        """,
+        conn
+    )
 #INNER JOIN (...) c means we're joining the main table with the results of a subquery, which is given the alias c
 #An INNER JOIN behaves like an intersection between two tables — it only keeps the rows that match in both.
 #the subquery gives us a list of unique fcertificate values from the Collections table
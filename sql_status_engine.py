@@ -0,0 +1,324 @@
+"""
+SQL status engine: works out the payment status of every sub-policy inside SQLite, with one query
+and no Python loop over the policies. Handy on small machines where pandas is the bottleneck.
+
+The query follows the same rules as status_engine.py (see its notes at the top):
+1. The first period start of each sub-policy is worked out from its Payment_Method,
+   InceptionDate, FirstCollectionDate and PreferredCollectionDay.
+2. A recursive CTE generates the monthly periods of every sub-policy, moving each start on with
+   the same rule as add_one_month_strict: the same day next month, or the 1st of the month after
+   that if next month doesn't have that day.
+3. The periods are joined to Collections through the index on (Policy_No,
+   Transaction_Date_EpochDay) and the premiums paid in each period are added up.
+4. Window functions drop the periods before the first one with a payment, and the remaining
+   full periods, amount due, next payment date and "already paid" flag are worked out per
+   sub-policy.
+
+Dates are compared as ISO text ('YYYY-MM-DD', with ' HH:MM:SS' only if there is a time, see
+date_columns.py), which sorts the same way as the dates themselves.
+
+Dependencies:
+- sqlite3 (built into Python; SQLite 3.25 or later for window functions)
+- pandas
+
+Notes:
+- Sub-policies whose first period start can't be worked out (e.g. a Direct Debit policy without
+  an InceptionDate) are left out with a warning, where the pandas engine stops with an error.
+- SQLite adds up the premiums in its own order, so an amount can differ from the pandas engine
+  in the last digits of a fraction of a cent.
+- Run this file to cross-check the engine against get_payment_status_for_sub_policy in
+  report_active_policies.py for every sub-policy in policies.db.
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from database import begin_read_snapshot, connect
+from period_calendar import PAYAT_INCEPTION_CUTOFF
+from status_engine import ACTIVE_STATUSES, STATUS_FIELDS, SubPolicyStatus, combine_by_main_policy, sub_status_frame
+
+# As-of dates the cross-check is run for when this file is run
+CROSS_CHECK_DATES = ["2025-05-30", "2024-02-29", "2025-12-31"]
+
+
+def _add_one_month_strict_sql(value):
+    """SQL for add_one_month_strict of a date text expression (the time of day is dropped)."""
+    return f"""(CASE WHEN strftime('%d', {value}, '+1 month') = strftime('%d', {value})
+                     THEN date({value}, '+1 month')
+                     ELSE date({value}, 'start of month', '+2 months') END)"""
+
+
+def _add_one_month_clipped_sql(value):
+    """SQL for value + relativedelta(months=1): the same day next month, or its last day (time of day dropped)."""
+    return f"""(CASE WHEN strftime('%d', {value}, '+1 month') = strftime('%d', {value})
+                     THEN date({value}, '+1 month')
+                     ELSE date({value}, 'start of month', '+2 months', '-1 day') END)"""
+
+
+def _days_in_month_sql(value):
+    return f"CAST(strftime('%d', {value}, 'start of month', '+1 month', '-1 day') AS INTEGER)"
+
+
+def _day_of_month_sql(value, day):
+    """SQL for value with its day replaced by day (keeping the time of day), like Timestamp.replace(day=day)."""
+    return f"(date({value}, 'start of month', '+' || ({day} - 1) || ' days') || substr({value}, 11))"
+
+
+def _epoch_day_sql(value):
+    return f"(CAST(strftime('%s', date({value})) AS INTEGER) / 86400)"
+
+
+def sub_policy_status_sql(active_only=True):
+    """
+    The query giving the status of every sub-policy (one row each, in table order), with the
+    parameters :today (as-of date as ISO text) and :payat_cutoff.
+
+    Args:
+        active_only (bool): only the sub-policies of active main policies (as the report uses);
+                            False gives every sub-policy in Policies
+    """
+    active_filter = ""
+    if active_only:
+        statuses = ', '.join(f"'{status}'" for status in ACTIVE_STATUSES)
+        active_filter = f"WHERE p.TransactionNo IN (SELECT TransactionNo FROM Policies WHERE Status_Name IN ({statuses}))"
+
+    return f"""
+        WITH RECURSIVE
+        policy AS (
+            -- Dates that couldn't be parsed at ingest time count as missing
+            SELECT p.rowid AS policy_rowid, p.fcertificate, p.TransactionNo, p.Premium, p.Payment_Method,
+                   lower(p.Payment_Method) AS method,
+                   CASE WHEN p.FirstCollectionDate_EpochDay IS NOT NULL THEN p.FirstCollectionDate END AS first_collection,
+                   CASE WHEN p.InceptionDate_EpochDay IS NOT NULL THEN p.InceptionDate END AS inception,
+                   trim(p.PreferredCollectionDay) AS preferred_text
+            FROM Policies p
+            {active_filter}
+        ),
+        preferred AS (
+            -- PreferredCollectionDay as a whole number, if it is one (as int() reads it)
+            SELECT policy.*,
+                   CASE WHEN ltrim(preferred_text, '+-') <> '' AND length(preferred_text) - length(ltrim(preferred_text, '+-')) <= 1
+                             AND ltrim(preferred_text, '+-') NOT GLOB '*[^0-9]*'
+                        THEN CAST(preferred_text AS INTEGER) END AS preferred_day
+            FROM policy
+        ),
+        candidate AS (
+            -- Direct Debit: the preferred day in the inception month if that month has it
+            SELECT preferred.*,
+                   CASE WHEN preferred_day BETWEEN 1 AND {_days_in_month_sql("inception")}
+                        THEN {_day_of_month_sql("inception", "preferred_day")}
+                        ELSE {_add_one_month_strict_sql("inception")} END AS debit_candidate
+            FROM preferred
+        ),
+        starts AS (
+            SELECT candidate.*,
+                   CASE WHEN method = 'payat' THEN
+                            CASE WHEN inception < :payat_cutoff OR inception > :today THEN first_collection
+                                 ELSE inception END
+                        WHEN method = 'direct debit' AND preferred_day IS NOT NULL THEN
+                            CASE WHEN debit_candidate > inception THEN debit_candidate
+                                 ELSE {_add_one_month_strict_sql("debit_candidate")} END
+                   END AS first_start
+            FROM candidate
+        ),
+        policy_start AS (
+            SELECT starts.*,
+                   first_start > :today AS first_after_today,
+                   CASE WHEN preferred_day > 0 AND preferred_day < 32 THEN preferred_day
+                        ELSE CAST(strftime('%d', first_start) AS INTEGER) END AS collection_day,
+                   EXISTS (SELECT 1 FROM Collections c WHERE c.Policy_No = starts.fcertificate) AS has_transactions
+            FROM starts
+        ),
+        periods (fcertificate, k, period_start, next_start) AS (
+            -- Only the first period keeps the time of day of its start; the others start while
+            -- the previous one started before today
+            SELECT fcertificate, 0, first_start, {_add_one_month_strict_sql("first_start")}
+            FROM policy_start WHERE first_start IS NOT NULL
+            UNION ALL
+            SELECT fcertificate, k + 1, next_start, {_add_one_month_strict_sql("next_start")}
+            FROM periods WHERE next_start < :today
+        ),
+        period_bounds AS (
+            -- The last period ends today, unless the first period starts after today
+            SELECT periods.fcertificate, k, period_start,
+                   CASE WHEN ps.first_after_today THEN date(next_start, '-1 day')
+                        ELSE min(date(next_start, '-1 day'), :today) END AS period_end
+            FROM periods JOIN policy_start ps ON ps.fcertificate = periods.fcertificate
+        ),
+        period_paid AS (
+            -- Premium paid in each period (from the first day to the last, both included)
+            SELECT pb.fcertificate, pb.k,
+                   SUM(CASE WHEN typeof(c.Premium) IN ('integer', 'real') THEN c.Premium ELSE 0.0 END) AS paid
+            FROM period_bounds pb
+            JOIN Collections c
+              ON c.Policy_No = pb.fcertificate
+             AND c.Transaction_Date_EpochDay BETWEEN {_epoch_day_sql("pb.period_start")} AND {_epoch_day_sql("pb.period_end")}
+             AND c.Transaction_Date >= pb.period_start AND c.Transaction_Date <= pb.period_end
+            GROUP BY pb.fcertificate, pb.k
+        ),
+        ledger AS (
+            -- A sub-policy without any transaction has the whole number 0 paid in each period
+            SELECT pb.fcertificate, pb.k, pb.period_start, pb.period_end,
+                   CASE WHEN ps.has_transactions THEN IFNULL(pp.paid, 0.0) ELSE 0 END AS paid,
+                   date({_add_one_month_clipped_sql("pb.period_start")}, '-1 day') || substr(pb.period_start, 11)
+                       <= pb.period_end AS is_full
+            FROM period_bounds pb
+            JOIN policy_start ps ON ps.fcertificate = pb.fcertificate
+            LEFT JOIN period_paid pp ON pp.fcertificate = pb.fcertificate AND pp.k = pb.k
+        ),
+        counted AS (
+            -- Periods before the first one with a payment are ignored (all are kept if nothing was paid)
+            SELECT ledger.*,
+                   k >= IFNULL(MIN(CASE WHEN paid > 0 THEN k END) OVER (PARTITION BY fcertificate), 0) AS is_counted,
+                   k = MAX(k) OVER (PARTITION BY fcertificate) AS is_last
+            FROM ledger
+        ),
+        totals AS (
+            SELECT fcertificate,
+                   SUM(CASE WHEN is_counted AND is_full THEN 1 ELSE 0 END) AS full_periods,
+                   SUM(CASE WHEN is_counted THEN paid END) AS paid_total,
+                   MAX(CASE WHEN is_last THEN period_start END) AS last_start,
+                   MAX(CASE WHEN is_last THEN paid END) AS last_paid
+            FROM counted
+            GROUP BY fcertificate
+        ),
+        status AS (
+            SELECT ps.policy_rowid, ps.TransactionNo, ps.fcertificate, ps.Payment_Method, ps.method, ps.Premium,
+                   ps.first_start, ps.first_after_today, ps.collection_day, t.last_start, t.last_paid,
+                   t.full_periods * ps.Premium - t.paid_total AS difference
+            FROM policy_start ps LEFT JOIN totals t ON t.fcertificate = ps.fcertificate
+        )
+        SELECT TransactionNo, fcertificate, first_start IS NOT NULL AS has_start, first_after_today,
+               -- Amount due: max(0, expected - paid), the whole number 0 if nothing is due
+               CASE WHEN first_after_today OR NOT difference > 0 OR difference IS NULL THEN 0
+                    ELSE difference END AS amount_due,
+               CASE WHEN first_after_today THEN last_start
+                    WHEN method = 'payat' THEN {_add_one_month_strict_sql("last_start")}
+                    WHEN method = 'direct debit' THEN
+                        CASE WHEN CAST(strftime('%d', last_start) AS INTEGER) = collection_day
+                                  OR collection_day > {_days_in_month_sql("last_start")}
+                             THEN {_add_one_month_strict_sql("last_start")}
+                             ELSE date({_day_of_month_sql("last_start", "collection_day")}) END
+               END AS next_payment_due,
+               CASE WHEN first_after_today THEN 0 ELSE IFNULL(last_paid >= Premium, 0) END AS next_collection_paid,
+               Payment_Method
+        FROM status
+        ORDER BY policy_rowid
+    """
+
+
+def _as_of_text(today_date):
+    """The as-of date as ISO text, formatted like the stored dates."""
+    today = pd.Timestamp(today_date)
+    return today.strftime("%Y-%m-%d %H:%M:%S") if today != today.normalize() else today.strftime("%Y-%m-%d")
+
+
+def sql_sub_policy_statuses(conn, today_date, active_only=True):
+    """
+    Work out the status of every sub-policy with one query (see sub_policy_status_sql).
+
+    Returns:
+        DataFrame: one row per sub-policy, in table order, with TransactionNo, fcertificate and the
+        STATUS_FIELDS columns holding the same values (and types) as compute_sub_policy_status gives
+    """
+    cursor = conn.execute(sub_policy_status_sql(active_only), {
+        "today": _as_of_text(today_date),
+        "payat_cutoff": str(PAYAT_INCEPTION_CUTOFF.astype("datetime64[D]")),
+    })
+    statuses = []
+    for (transaction_no, fcertificate, has_start, first_after_today, amount_due, next_payment_due,
+         next_collection_paid, payment_method) in cursor:
+        if not has_start:
+            print(f"Warning: could not determine the first period start of sub-policy {fcertificate} - skipped")
+            continue
+        if next_payment_due is None:
+            next_payment_due = pd.NaT
+        elif first_after_today:
+            # The first period start itself, time of day included
+            next_payment_due = pd.Timestamp(next_payment_due)
+        else:
+            next_payment_due = date.fromisoformat(next_payment_due)
+        statuses.append(SubPolicyStatus(transaction_no, fcertificate, amount_due == 0, amount_due, next_payment_due,
+                                        bool(next_collection_paid), payment_method))
+    return sub_status_frame(statuses)
+
+
+def sql_main_policy_statuses(conn, main_policy_nos, today_date):
+    """
+    Combined status of each main policy, from sql_sub_policy_statuses.
+
+    Returns:
+        DataFrame: one row per main policy (index TransactionNo, in main_policy_nos order) with the
+                   combined STATUS_FIELDS columns. Main policies without any sub-policy are left out.
+    """
+    combined = combine_by_main_policy(sql_sub_policy_statuses(conn, today_date))
+    found = []
+    for mainPolicyNo in main_policy_nos:
+        if mainPolicyNo in combined.index:
+            found.append(mainPolicyNo)
+        else:
+            print(f"Warning: main policy {mainPolicyNo} has no sub-policies - skipped")
+    return combined.loc[found]
+
+
+def _same_value(label, sql_value, pandas_value):
+    if label == "Amount due":
+        return np.isclose(float(sql_value), float(pandas_value), rtol=0, atol=1e-6)
+    if label == "Next Payment Due":
+        if pd.isna(sql_value) or pd.isna(pandas_value):
+            return pd.isna(sql_value) and pd.isna(pandas_value)
+        return type(sql_value) is type(pandas_value) and sql_value == pandas_value
+    return bool(sql_value) == bool(pandas_value) if isinstance(sql_value, bool) else sql_value == pandas_value
+
+
+def cross_check(conn, today_date, active_only=False):
+    """
+    Compare the SQL engine with get_payment_status_for_sub_policy (report_active_policies.py),
+    one sub-policy at a time. A sub-policy the SQL engine leaves out must make
+    get_payment_status_for_sub_policy fail.
+
+    Returns:
+        list: (fcertificate, field, SQL value, pandas value) for every difference
+    """
+    import report_active_policies
+
+    report_active_policies.today_date = pd.Timestamp(today_date)
+    sql_statuses = sql_sub_policy_statuses(conn, today_date, active_only).set_index("fcertificate")
+    query = "SELECT fcertificate FROM Policies ORDER BY rowid"
+    if active_only:
+        query = f"""
+            SELECT fcertificate FROM Policies
+            WHERE TransactionNo IN (SELECT TransactionNo FROM Policies WHERE Status_Name IN ({', '.join(['?' for _ in ACTIVE_STATUSES])}))
+            ORDER BY rowid
+        """
+    fcertificates = pd.read_sql_query(query, conn, params=list(ACTIVE_STATUSES) if active_only else None)["fcertificate"]
+
+    differences = []
+    for fcertificate in fcertificates:
+        try:
+            _, current_status_df = report_active_policies.get_payment_status_for_sub_policy(fcertificate, conn)
+        except Exception as error:
+            if fcertificate in sql_statuses.index:
+                differences.append((fcertificate, "error", "status worked out", repr(error)))
+            continue
+        if fcertificate not in sql_statuses.index:
+            differences.append((fcertificate, "error", "left out", "status worked out"))
+            continue
+        pandas_status = dict(zip(current_status_df["Status"], current_status_df["Value"]))
+        for label in STATUS_FIELDS:
+            sql_value = sql_statuses.at[fcertificate, label]
+            if not _same_value(label, sql_value, pandas_status[label]):
+                differences.append((fcertificate, label, sql_value, pandas_status[label]))
+    return differences
+
+
+if __name__ == "__main__":
+    conn = connect("policies.db")
+    begin_read_snapshot(conn)
+    for as_of in CROSS_CHECK_DATES:
+        differences = cross_check(conn, as_of)
+        print(f"{as_of}: {len(differences)} differences between the SQL engine and get_payment_status_for_sub_policy")
+        for difference in differences[:20]:
+            print("  ", difference)
+    conn.close()
@@ -0,0 +1,731 @@
+"""
+Batch payment-status engine for report_active_policies.py.
+
+The report used to work out the status of the active policies one query at a time: one query per
+main policy for its sub-policies, one per sub-policy for its details, one per sub-policy for its
+transactions and one per overdue main policy for the contact details. Here the whole active
+portfolio is loaded with two queries instead (load_active_portfolio), grouped in memory, and
+every sub-policy is evaluated with the same rules as before (compute_sub_policy_status).
+
+The rules, for reference:
+- A sub-policy's payment periods start on its first collection date: for PayAt the inception
+  date (or the FirstCollectionDate if the policy started before 2022 or starts after today), for
+  Direct Debit the first PreferredCollectionDay after the inception date.
+- Each period runs for one month (see add_one_month_strict); the last one ends today. The
+  periods of all the sub-policies are generated at once by period_calendar.py.
+- Periods before the first one with a payment are ignored. Every full period left should have
+  been paid one Premium; the shortfall is the amount due.
+- A main policy (TransactionNo) is up to date only if all of its sub-policies are, and its
+  amount due is the sum over its sub-policies. The sub-policy statuses are kept in long format
+  (one row per sub-policy) and combined with one groupby (combine_by_main_policy); the period
+  totals can be turned into the wide time series of each main policy with pivot_period_totals.
+- period_ledger lists the premium paid and expected in every period of every sub-policy; the
+  report keeps it in policy_status_summary.db (see status_store.py).
+- evaluate_as_of_dates works the statuses out for several as-of dates in one pass (see
+  arrears_backtest.py).
+
+Dependencies:
+- pandas and numpy
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from date_columns import parse_dates
+from period_calendar import (
+    ONE_DAY, SortedTransactions, add_months_strict, first_period_starts, full_periods, next_status_change,
+    period_calendar, period_totals
+)
+from policies_ingest import KEY_LOOKUP_CHUNK
+
+# Status_Name values of active policies
+ACTIVE_STATUSES = ("Active Policy", "Active")
+
+# Order of the entries of a sub-policy's (and a main policy's) status
+STATUS_FIELDS = ["Up to Date", "Amount due", "Next Payment Due", "Next Collection Already Paid", "Payment Method"]
+
+
+class PolicyStatus:
+    """
+    The STATUS_FIELDS values of a policy. A small object with __slots__ (no per-object dict) rather
+    than a dict or a "Status"/"Value" DataFrame, so that the statuses of a whole portfolio take
+    little memory; DataFrames are only built from lists of them where a table is needed (see
+    sub_status_frame and main_status_frame).
+    """
+    __slots__ = ("transaction_no", "up_to_date", "amount_due", "next_payment_due", "next_collection_paid",
+                 "payment_method")
+
+    def __init__(self, transaction_no, up_to_date, amount_due, next_payment_due, next_collection_paid,
+                 payment_method):
+        self.transaction_no = transaction_no
+        self.up_to_date = up_to_date
+        self.amount_due = amount_due
+        self.next_payment_due = next_payment_due
+        self.next_collection_paid = next_collection_paid
+        self.payment_method = payment_method
+
+    def values(self):
+        """The status values, in STATUS_FIELDS order."""
+        return (self.up_to_date, self.amount_due, self.next_payment_due, self.next_collection_paid,
+                self.payment_method)
+
+    def as_dict(self):
+        """The status as a {STATUS_FIELDS label: value} dict."""
+        return dict(zip(STATUS_FIELDS, self.values()))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.transaction_no!r}, {self.as_dict()!r})"
+
+
+class SubPolicyStatus(PolicyStatus):
+    """Status of one sub-policy (fcertificate) of main policy transaction_no, from compute_sub_policy_status."""
+    __slots__ = ("fcertificate",)
+
+    def __init__(self, transaction_no, fcertificate, *values):
+        super().__init__(transaction_no, *values)
+        self.fcertificate = fcertificate
+
+
+class MainPolicyStatus(PolicyStatus):
+    """Combined status of one main policy (see combine_sub_policy_statuses)."""
+    __slots__ = ()
+
+
+def sub_status_frame(statuses):
+    """Long-format DataFrame (TransactionNo, fcertificate and the STATUS_FIELDS columns) of SubPolicyStatus objects."""
+    # Keep the values exactly as worked out (no conversion of the columns to a common type)
+    return pd.DataFrame(
+        [(status.transaction_no, status.fcertificate) + status.values() for status in statuses],
+        columns=["TransactionNo", "fcertificate"] + STATUS_FIELDS, dtype=object
+    )
+
+
+def main_status_frame(statuses):
+    """DataFrame of MainPolicyStatus objects: index TransactionNo, the STATUS_FIELDS columns (values kept as they are)."""
+    return pd.DataFrame(
+        [status.values() for status in statuses],
+        index=pd.Index([status.transaction_no for status in statuses], name="TransactionNo"),
+        columns=STATUS_FIELDS, dtype=object
+    )
+
+
+def add_one_month_strict(date):
+    day = date.day
+    year = date.year
+    month = date.month + 1
+    if month > 12:
+        month -= 12
+        year += 1
+
+    # Check if the next month has that day
+    max_day = pd.Timestamp(year=year, month=month, day=1).days_in_month
+    if day <= max_day:
+        return pd.Timestamp(year=year, month=month, day=day)
+    else:
+        # Move to the 1st of the month after that
+        next_month = month + 1
+        next_year = year
+        if next_month > 12:
+            next_month = 1
+            next_year += 1
+        return pd.Timestamp(year=next_year, month=next_month, day=1)
+
+
+def first_period_start(policy, today_date):
+    """
+    Work out when the first payment period of a sub-policy starts.
+
+    Returns:
+        tuple: (first period start, collection day used for Direct Debit next payment dates)
+    """
+    fcertificate = policy.get("fcertificate")
+    firstCollection = pd.to_datetime(policy["FirstCollectionDate"])
+    inception_date = pd.to_datetime(policy["InceptionDate"])
+    payment_method = policy["Payment_Method"]
+    collection_day = policy["PreferredCollectionDay"]
+
+    period_start = None
+    if payment_method.lower() == "payat":
+        # For PayAt
+        if inception_date < pd.to_datetime("2022-01-01") or inception_date > today_date:
+            period_start = firstCollection
+        else:
+            period_start = inception_date
+    if payment_method.lower() == "direct debit":
+        if pd.isna(inception_date):
+            raise ValueError("Invalid inception_date")
+
+        collection_day_int = int(collection_day)
+
+        # Try to construct a candidate date in the same month
+        try:
+            candidate_date = inception_date.replace(day=collection_day_int)
+        except ValueError:
+            # If the collection day doesn't exist in this month, move to the next valid month
+            candidate_date = add_one_month_strict(inception_date)
+
+        # If the candidate is still after the inception, use it, otherwise advance one month
+        if candidate_date > inception_date:
+            period_start = candidate_date
+        else:
+            period_start = add_one_month_strict(candidate_date)
+
+    try:
+        collection_day = int(collection_day)
+    except (TypeError, ValueError):
+        collection_day = 0  # will trigger fallback in the next line
+
+    if not (0 < collection_day < 32):
+        collection_day = period_start.day
+
+    if period_start is None or pd.isna(period_start):
+        print(f"Error: Could not determine period_start for policy {fcertificate}")
+        print(f"  Payment Method: {payment_method}")
+        print(f"  FirstCollectionDate: {firstCollection}")
+        print(f"  InceptionDate: {inception_date}")
+        raise ValueError(f"Could not determine period_start for policy {fcertificate}")
+
+    return period_start, collection_day
+
+
+def portfolio_periods(policies, transactions, today_date, sorted_transactions=None):
+    """
+    Payment periods of every sub-policy and the premium paid in each, worked out for the whole
+    portfolio at once (see period_calendar.py).
+
+    Args:
+        policies (DataFrame): one row per sub-policy, with parsed FirstCollectionDate and InceptionDate
+        transactions (DataFrame): Policy_No, parsed Transaction_Date and numeric Premium of their collections
+        today_date (Timestamp): date the status is worked out for
+        sorted_transactions (SortedTransactions): the same transactions already sorted, to reuse
+                                                  over several as-of dates (None sorts them here)
+
+    Returns:
+        tuple: (list with the periods tuple compute_sub_policy_status takes for each sub-policy, in
+        policies order; array with the first as-of date each sub-policy's status could change on,
+        see period_calendar.next_status_change)
+    """
+    starts, collection_days, valid = first_period_starts(policies, today_date)
+    for position in np.flatnonzero(~valid):
+        # The rules can't give a start for this policy; first_period_start reports why
+        starts[position], collection_days[position] = first_period_start(policies.iloc[position], today_date)
+    calendar, first_after_today = period_calendar(starts, today_date)
+
+    # fcertificate is the key of the Policies table, so each transaction belongs to one row
+    transaction_policy = pd.Index(policies["fcertificate"]).get_indexer(transactions["Policy_No"])
+    if sorted_transactions is None:
+        paid = period_totals(calendar, transaction_policy, transactions["Transaction_Date"], transactions["Premium"])
+    else:
+        paid = sorted_transactions.period_totals(calendar)
+    has_transactions = np.bincount(transaction_policy[transaction_policy >= 0], minlength=len(policies)) > 0
+
+    calendar_starts = calendar["period_start"].to_numpy()
+    calendar_ends = calendar["period_end"].to_numpy()
+    bounds = np.searchsorted(calendar["policy"].to_numpy(), np.arange(len(policies) + 1))
+    periods = []
+    for row in range(len(policies)):
+        first, last = bounds[row], bounds[row + 1]
+        # With no transactions at all each total is the integer 0, as pandas gives for an empty query result
+        row_paid = paid[first:last] if has_transactions[row] else [0] * (last - first)
+        periods.append((calendar_starts[first:last], calendar_ends[first:last], row_paid,
+                        first_after_today[row], collection_days[row]))
+
+    payat = np.array([isinstance(method, str) and method.lower() == "payat" for method in policies["Payment_Method"]],
+                     dtype=bool)
+    payat_inception = np.where(payat, policies["InceptionDate"].to_numpy(dtype="datetime64[ns]"), np.datetime64("NaT"))
+    valid_until = next_status_change(calendar, first_after_today, payat_inception, transaction_policy,
+                                     transactions["Transaction_Date"], today_date)
+    return periods, valid_until
+
+
+def sub_policy_periods(policy, transaction_dates, transaction_premiums, today_date):
+    """
+    The periods tuple of a single sub-policy (see portfolio_periods), from its Policies values as
+    stored and its collections.
+    """
+    policies = pd.DataFrame([policy])
+    for col in ["FirstCollectionDate", "InceptionDate"]:
+        policies[col] = parse_dates(policies[col])[1]
+    transactions = pd.DataFrame({
+        "Policy_No": policy["fcertificate"],
+        "Transaction_Date": np.asarray(transaction_dates, dtype="datetime64[ns]"),
+        "Premium": np.asarray(transaction_premiums, dtype="float64"),
+    })
+    periods, _ = portfolio_periods(policies, transactions, today_date)
+    return periods[0]
+
+
+def compute_sub_policy_status(policy, periods):
+    """
+    Payment status of one sub-policy, without touching the database.
+
+    Args:
+        policy (dict or Series): the sub-policy's Premium and Payment_Method
+        periods (tuple): (period starts, period ends, premium paid in each period, True if the
+                         first period starts after today, collection day), from portfolio_periods
+                         or sub_policy_periods
+
+    Returns:
+        tuple: (list of (period start, period end, total premium paid), SubPolicyStatus)
+    """
+    premium_expected = pd.to_numeric(policy["Premium"], errors='coerce')
+    payment_method = policy["Payment_Method"]
+
+    period_starts, period_ends, paid, firstCollafterToday, collection_day = periods
+    period_starts, period_ends = pd.DatetimeIndex(period_starts), pd.DatetimeIndex(period_ends)
+
+    if firstCollafterToday:
+        # Nothing can have been paid yet if the first collection is after today
+        period_totals = [(start, end, None) for start, end in zip(period_starts, period_ends)]
+    else:
+        period_totals = list(zip(period_starts, period_ends, paid))
+
+        # Remove any periods before the first one with a payment (keep them all if nothing was paid)
+        first_kept = 0
+        for index, (_, _, total_paid) in enumerate(period_totals):
+            if total_paid > 0:
+                first_kept = index
+                period_totals = period_totals[index:]
+                break
+
+    status = {}
+    if not firstCollafterToday:
+        # Calculate number of full periods (1 full month), for all the periods at once
+        num_full_periods = int(np.count_nonzero(full_periods(period_starts[first_kept:], period_ends[first_kept:])))
+
+        total_paid_all_periods = np.array([total for _, _, total in period_totals]).sum()
+        expected_total = num_full_periods * premium_expected
+        difference = max(0, expected_total - total_paid_all_periods)
+        status["Up to Date"] = difference == 0
+        status["Amount due"] = difference
+    else:
+        # If first collection is after today, we don't need to check if up to date
+        status["Up to Date"] = True
+        status["Amount due"] = 0
+
+    last_period_start = period_totals[-1][0]
+    if firstCollafterToday:
+        next_payment_date = last_period_start
+    else:
+        if payment_method.lower() == "payat":
+            next_payment_date = add_one_month_strict(last_period_start)
+        elif payment_method.lower() == "direct debit":
+            if last_period_start.day == int(collection_day):
+                # If last period is on collection day, move to next month
+                next_payment_date = add_one_month_strict(last_period_start)
+            else:
+                # Otherwise move to the next collection day, or to the first of the next month
+                # if the collection day doesn't fall within the month
+                try:
+                    next_payment_date = last_period_start.replace(day=int(collection_day))
+                except ValueError:
+                    next_payment_date = add_one_month_strict(last_period_start)
+        else:
+            next_payment_date = pd.NaT  # Unknown payment method
+
+        # Remove the time from the next payment date
+        if pd.notna(next_payment_date):
+            next_payment_date = next_payment_date.date()
+    status["Next Payment Due"] = next_payment_date
+
+    # Has the next payment already been made?
+    last_period_paid = period_totals[-1][2]
+    if pd.isna(last_period_paid):
+        status["Next Collection Already Paid"] = False
+    else:
+        status["Next Collection Already Paid"] = last_period_paid >= premium_expected
+    status["Payment Method"] = payment_method
+
+    return period_totals, SubPolicyStatus(policy.get("TransactionNo"), policy.get("fcertificate"),
+                                          *[status[label] for label in STATUS_FIELDS])
+
+
+def combine_by_main_policy(sub_statuses):
+    """
+    Combine the statuses of the sub-policies into one status per main policy, with a single groupby
+    over the long-format table: the flags must be true for every sub-policy, amounts due are added
+    up, and the other values are kept if all the sub-policies agree and become "Mixed" otherwise.
+
+    Args:
+        sub_statuses (DataFrame): one row per sub-policy with TransactionNo and the STATUS_FIELDS columns
+
+    Returns:
+        DataFrame: one row per main policy (index TransactionNo, in order of first appearance)
+                   with the combined STATUS_FIELDS columns
+    """
+    main_policy = sub_statuses["TransactionNo"]
+    combined = pd.DataFrame(index=pd.Index(main_policy.unique(), name="TransactionNo"))
+    for label in STATUS_FIELDS:
+        values = sub_statuses[label]
+        if label in ["Up to Date", "Next Collection Already Paid"]:
+            # A flag counts as true if it is True or the text "true"
+            is_true = values.astype(str).str.strip().str.lower() == "true"
+            combined[label] = is_true.groupby(main_policy, sort=False).all()
+        elif label == "Amount due":
+            # Ignore non-numeric values; the total is missing only if no value is numeric. Each main
+            # policy's amounts are converted on their own, so that whole amounts stay integers
+            # whenever pandas keeps them as integers for that main policy alone
+            combined[label] = values.astype(object).groupby(main_policy, sort=False).agg(
+                lambda amounts: pd.to_numeric(amounts, errors="coerce").sum(min_count=1)
+            )
+        else:
+            # Compare every value with the first one of its main policy (NaT never matches)
+            first_values = values[~main_policy.duplicated()]
+            first_values.index = main_policy[first_values.index]
+            agrees = values.astype(object) == main_policy.map(first_values).astype(object)
+            all_agree = agrees.groupby(main_policy, sort=False).all()
+            combined[label] = first_values.astype(object).where(all_agree, "Mixed")
+    return combined
+
+
+def combine_sub_policy_statuses(transaction_no, sub_statuses):
+    """
+    Combined status of one main policy from the SubPolicyStatus objects of its sub-policies, with
+    the same rules as combine_by_main_policy but without building a DataFrame.
+
+    Returns:
+        MainPolicyStatus
+    """
+    columns = list(zip(*[status.values() for status in sub_statuses]))
+    combined = []
+    for label, values in zip(STATUS_FIELDS, columns):
+        if label in ["Up to Date", "Next Collection Already Paid"]:
+            combined.append(all(str(value).strip().lower() == "true" for value in values))
+        elif label == "Amount due":
+            combined.append(pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").sum(min_count=1))
+        else:
+            # NaT never matches, as in combine_by_main_policy
+            all_agree = all(value == values[0] for value in values)
+            combined.append(values[0] if all_agree else "Mixed")
+    return MainPolicyStatus(transaction_no, *combined)
+
+
+# Columns of the long-format period totals (see evaluate_sub_policies)
+PERIOD_COLUMNS = ["TransactionNo", "fcertificate", "Period Start", "Period End", "Total Premium Paid"]
+
+
+def pivot_period_totals(period_rows):
+    """
+    Turn the long-format period totals (see evaluate_sub_policies) into the wide time series of
+    each main policy: one row per period, a "Paid for <sub-policy>" column for each sub-policy and
+    their total.
+
+    Returns:
+        DataFrame: TransactionNo, Period Start, Period End, the "Paid for" columns and
+                   "Total Paid for All Sub-Policies"
+    """
+    wide = period_rows.pivot(
+        index=["TransactionNo", "Period Start", "Period End"], columns="fcertificate", values="Total Premium Paid"
+    )
+    # Keep the sub-policies in their original order rather than sorted
+    wide = wide[period_rows["fcertificate"].unique()]
+    wide.columns = [f"Paid for {sub}" for sub in wide.columns]
+    wide["Total Paid for All Sub-Policies"] = wide.sum(axis=1)
+    return wide.reset_index()
+
+
+def load_active_portfolio(conn, transaction_nos=None):
+    """
+    Load every sub-policy of the active main policies, and all of their collections, with one
+    query each.
+
+    Args:
+        conn: sqlite3 connection to policies.db
+        transaction_nos (list): only load these (active) main policies, KEY_LOOKUP_CHUNK at a time;
+                                None loads the whole active portfolio
+
+    Returns:
+        tuple: (policies DataFrame in table order, transactions DataFrame with parsed dates)
+    """
+    if transaction_nos is None:
+        main_policy_filters = [(f"""
+            SELECT TransactionNo FROM Policies
+            WHERE Status_Name IN ({', '.join(repr(status) for status in ACTIVE_STATUSES)})
+        """, [])]
+    else:
+        transaction_nos = list(transaction_nos)
+        main_policy_filters = []
+        for i in range(0, len(transaction_nos), KEY_LOOKUP_CHUNK):
+            chunk = transaction_nos[i:i + KEY_LOOKUP_CHUNK]
+            main_policy_filters.append((', '.join(['?' for _ in chunk]), chunk))
+
+    policy_parts = []
+    transaction_parts = []
+    for main_policies, params in main_policy_filters:
+        policy_parts.append(pd.read_sql_query(f"""
+            SELECT rowid AS policy_rowid, fcertificate, FirstCollectionDate, Premium, Payment_Method,
+                   PreferredCollectionDay, InceptionDate, TransactionNo, CellPhone, Client_Name, PayAtReference
+            FROM Policies
+            WHERE TransactionNo IN ({main_policies})
+            ORDER BY rowid
+        """, conn, params=params))
+        transaction_parts.append(pd.read_sql_query(f"""
+            SELECT Policy_No, Transaction_Date, Premium
+            FROM Collections
+            WHERE Policy_No IN (SELECT fcertificate FROM Policies WHERE TransactionNo IN ({main_policies}))
+            ORDER BY Policy_No, rowid
+        """, conn, params=params))
+    if not policy_parts:
+        # Nothing asked for: empty tables with the right columns
+        return load_active_portfolio(conn, transaction_nos=[None])
+    policies = pd.concat(policy_parts, ignore_index=True)
+    transactions = pd.concat(transaction_parts, ignore_index=True)
+
+    # Parse every date once for the whole portfolio
+    for col in ["FirstCollectionDate", "InceptionDate"]:
+        policies[col] = parse_dates(policies[col])[1]
+    transactions["Transaction_Date"] = parse_dates(transactions["Transaction_Date"])[1]
+    transactions["Premium"] = pd.to_numeric(transactions["Premium"], errors="coerce")
+    return policies, transactions
+
+
+def contact_rows_by_main_policy(policies):
+    """
+    Contact details of each main policy from its first Policies row, with missing values as None
+    (the way a single-row query returns them).
+
+    Returns:
+        dict: TransactionNo -> dict of that row's columns
+    """
+    first_rows = policies.drop_duplicates("TransactionNo")
+    first_rows = first_rows.astype(object).where(first_rows.notna(), None)
+    return {row["TransactionNo"]: row for row in first_rows.to_dict("records")}
+
+
+def load_contact_rows(conn, transaction_nos):
+    """Contact details of the given main policies (see contact_rows_by_main_policy), KEY_LOOKUP_CHUNK at a time."""
+    transaction_nos = list(transaction_nos)
+    parts = []
+    for i in range(0, len(transaction_nos), KEY_LOOKUP_CHUNK):
+        chunk = transaction_nos[i:i + KEY_LOOKUP_CHUNK]
+        parts.append(pd.read_sql_query(f"""
+            SELECT CellPhone, Client_Name, TransactionNo, Premium, PreferredCollectionDay,
+                   PayAtReference, Payment_Method
+            FROM Policies
+            WHERE TransactionNo IN ({', '.join(['?' for _ in chunk])})
+            ORDER BY rowid
+        """, conn, params=chunk))
+    if not parts:
+        return {}
+    return contact_rows_by_main_policy(pd.concat(parts, ignore_index=True))
+
+
+# Columns of the period ledger (see period_ledger)
+LEDGER_COLUMNS = ["TransactionNo", "fcertificate", "Period Start", "Period End", "Premium Paid", "Premium Expected"]
+
+
+def period_ledger(policies, periods):
+    """
+    Long-format ledger of the payment periods of every sub-policy, with the premium paid in each
+    and the premium the rules expect for it, built for the whole portfolio at once.
+
+    - Period End is the day before the next period starts, so the current period runs past the
+      as-of date; the ledger of a policy therefore only changes when its status could (see
+      period_calendar.next_status_change).
+    - Premium Paid is missing if the first period starts after the as-of date.
+    - Premium Expected is the Premium for the full periods from the first one with a payment on,
+      and 0 for the others, so the amount due is the expected total less the paid total over
+      those periods.
+
+    Args:
+        policies (DataFrame): the sub-policies, as loaded by load_active_portfolio
+        periods (list): periods tuple of each sub-policy, from portfolio_periods
+
+    Returns:
+        DataFrame: LEDGER_COLUMNS, one row per period, ordered by sub-policy and then by period
+    """
+    counts = np.array([len(row_periods[0]) for row_periods in periods], dtype=np.int64)
+    if not counts.sum():
+        return pd.DataFrame(columns=LEDGER_COLUMNS)
+    sub = np.repeat(np.arange(len(periods)), counts)
+    step = np.arange(len(sub)) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.concatenate([row_periods[0] for row_periods in periods]).astype("datetime64[ns]")
+    ends = np.concatenate([row_periods[1] for row_periods in periods]).astype("datetime64[ns]")
+    paid = np.concatenate([np.asarray(row_periods[2], dtype=np.float64) for row_periods in periods])
+    first_after_today = np.array([bool(row_periods[3]) for row_periods in periods], dtype=bool)[sub]
+
+    # Periods before the first one with a payment are ignored (all are kept if nothing was paid)
+    no_payment = len(sub)
+    first_paid_step = pd.Series(np.where(paid > 0, step, no_payment)).groupby(sub).transform("min").to_numpy()
+    counted = step >= np.where(first_paid_step == no_payment, 0, first_paid_step)
+
+    # A period is full once it has lasted a whole month (as in compute_sub_policy_status)
+    full = pd.DatetimeIndex(starts) + pd.DateOffset(months=1) - pd.Timedelta(days=1) <= pd.DatetimeIndex(ends)
+    premium = pd.to_numeric(policies["Premium"], errors="coerce").to_numpy(dtype=np.float64)[sub]
+    expected = np.where(counted & full & ~first_after_today, premium, 0.0)
+
+    # The last period of each sub-policy runs until the day before the next one would start
+    last = np.cumsum(counts) - 1
+    first = last - counts + 1
+    ends[last] = add_months_strict(starts[first], counts).astype("datetime64[ns]") - ONE_DAY
+
+    return pd.DataFrame({
+        "TransactionNo": policies["TransactionNo"].to_numpy()[sub],
+        "fcertificate": policies["fcertificate"].to_numpy()[sub],
+        "Period Start": starts,
+        "Period End": ends,
+        "Premium Paid": np.where(first_after_today, np.nan, paid),
+        "Premium Expected": expected,
+    }, columns=LEDGER_COLUMNS)
+
+
+def evaluate_sub_policies(policies, transactions, today_date, with_periods=False, with_ledger=False):
+    """
+    Work out the status of every sub-policy of the portfolio loaded by load_active_portfolio.
+
+    Returns:
+        tuple: (long-format DataFrame with one row per sub-policy - TransactionNo, fcertificate, the
+        STATUS_FIELDS columns and Valid Until, the first as-of date the status could change on -;
+        if with_periods is set a long-format DataFrame with one row per period - TransactionNo,
+        fcertificate, Period Start, Period End, Total Premium Paid -, otherwise None; if
+        with_ledger is set the period ledger (see period_ledger), otherwise None)
+    """
+    # Payment periods and premiums paid of every sub-policy, worked out at once
+    periods, valid_until = portfolio_periods(policies, transactions, today_date)
+
+    statuses = []
+    period_rows = []
+    for row, policy in enumerate(policies.to_dict("records")):
+        period_totals, status = compute_sub_policy_status(policy, periods[row])
+        statuses.append(status)
+        if with_periods:
+            for start, end, total_paid in period_totals:
+                period_rows.append((status.transaction_no, status.fcertificate, start, end, total_paid))
+
+    sub_statuses = sub_status_frame(statuses)
+    sub_statuses["Valid Until"] = pd.to_datetime(valid_until)
+    ledger = period_ledger(policies, periods) if with_ledger else None
+    if not with_periods:
+        return sub_statuses, None, ledger
+    return sub_statuses, pd.DataFrame(period_rows, columns=PERIOD_COLUMNS), ledger
+
+
+# Columns of the portfolio the status rules need; only these are sent to worker processes
+SHARD_POLICY_COLUMNS = ["fcertificate", "TransactionNo", "FirstCollectionDate", "Premium", "Payment_Method",
+                        "PreferredCollectionDay", "InceptionDate"]
+SHARD_TRANSACTION_COLUMNS = ["Policy_No", "Transaction_Date", "Premium"]
+
+# Number of main policies in each shard handed to a worker process
+DEFAULT_SHARD_SIZE = 500
+
+
+def shard_portfolio(policies, transactions, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Split the portfolio into shards of up to shard_size main policies, keeping all the
+    sub-policies of a main policy (and their collections) together and in their original order.
+
+    Returns:
+        list: (policies, transactions) DataFrames of each shard, with only the columns the rules need
+    """
+    main_policy_rank = pd.Series(pd.factorize(policies["TransactionNo"])[0], index=policies.index)
+    policy_shard = main_policy_rank // shard_size
+    transaction_shard = transactions["Policy_No"].map(pd.Series(policy_shard.to_numpy(), index=policies["fcertificate"]))
+
+    policies = policies[SHARD_POLICY_COLUMNS]
+    transactions = transactions[SHARD_TRANSACTION_COLUMNS]
+    transactions_by_shard = transactions.groupby(transaction_shard, sort=False).indices
+    shards = []
+    for shard, rows in policies.groupby(policy_shard, sort=True).indices.items():
+        shard_transactions = transactions.iloc[transactions_by_shard.get(shard, [])]
+        shards.append((policies.iloc[rows], shard_transactions))
+    return shards
+
+
+def evaluate_shard(shard, today_date, with_ledger=False):
+    """Sub-policy statuses (and period ledger) of one shard (see shard_portfolio); runs in a worker process."""
+    policies, transactions = shard
+    sub_statuses, _, ledger = evaluate_sub_policies(policies, transactions, today_date, with_ledger=with_ledger)
+    return sub_statuses, ledger
+
+
+def evaluate_main_policies(policies, transactions, main_policy_nos, today_date, workers=1,
+                           shard_size=DEFAULT_SHARD_SIZE, with_ledger=False):
+    """
+    Work out the combined status of each main policy from the portfolio loaded by load_active_portfolio.
+
+    Args:
+        workers (int): number of processes to spread the shards over (1 works everything out in
+                       this process; None uses all CPU cores)
+        shard_size (int): number of main policies in each shard sent to a worker
+        with_ledger (bool): also return the period ledger of the sub-policies (see period_ledger;
+                            with several workers its rows are grouped by main policy)
+
+    Returns:
+        DataFrame: one row per main policy (index TransactionNo, in main_policy_nos order) with the
+                   combined STATUS_FIELDS columns and Valid Until (the first as-of date the status
+                   could change on). Main policies without any sub-policy are left out.
+                   With with_ledger, a (DataFrame, ledger) tuple.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(policies):
+        shards = shard_portfolio(policies, transactions, shard_size)
+        print(f"Evaluating {len(shards)} shards of up to {shard_size} main policies with "
+              f"{min(workers, len(shards))} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # map returns the results in shard order, so the result is the same as a serial run
+            results = list(pool.map(evaluate_shard, shards, [today_date] * len(shards),
+                                    [with_ledger] * len(shards)))
+        sub_statuses = pd.concat([statuses for statuses, _ in results], ignore_index=True)
+        ledger = pd.concat([shard_ledger for _, shard_ledger in results], ignore_index=True) if with_ledger else None
+    else:
+        sub_statuses, _, ledger = evaluate_sub_policies(policies, transactions, today_date, with_ledger=with_ledger)
+    combined = combine_by_main_policy(sub_statuses)
+    # A main policy's status holds until the status of one of its sub-policies could change
+    combined["Valid Until"] = sub_statuses.groupby("TransactionNo", sort=False)["Valid Until"].min()
+
+    found = []
+    for mainPolicyNo in main_policy_nos:
+        if mainPolicyNo in combined.index:
+            found.append(mainPolicyNo)
+        else:
+            print(f"Warning: main policy {mainPolicyNo} has no sub-policies - skipped")
+    if with_ledger:
+        return combined.loc[found], ledger
+    return combined.loc[found]
+
+
+# Columns of the long-format table of evaluate_as_of_dates
+AS_OF_COLUMNS = ["TransactionNo", "As Of Date"] + STATUS_FIELDS
+
+
+def evaluate_as_of_dates(policies, transactions, main_policy_nos, as_of_dates):
+    """
+    Work out the combined status of each main policy as of several dates, in one pass over the
+    portfolio loaded by load_active_portfolio. The collections are sorted and added up once for
+    all the dates (see period_calendar.SortedTransactions), and policies that start on the same
+    day share their calendars (see period_calendar.PeriodCalendarCache).
+
+    Args:
+        main_policy_nos (list): main policies to include, in the order wanted
+        as_of_dates (list): dates to work the statuses out for (anything pd.Timestamp accepts)
+
+    Returns:
+        DataFrame: long format, one row per (TransactionNo, As Of Date) with the combined
+                   STATUS_FIELDS columns, ordered by as-of date and then as main_policy_nos.
+                   Main policies without any sub-policy are left out.
+    """
+    found = set(policies["TransactionNo"])
+    for mainPolicyNo in main_policy_nos:
+        if mainPolicyNo not in found:
+            print(f"Warning: main policy {mainPolicyNo} has no sub-policies - skipped")
+    main_policy_nos = [mainPolicyNo for mainPolicyNo in main_policy_nos if mainPolicyNo in found]
+    if not main_policy_nos or len(as_of_dates) == 0:
+        return pd.DataFrame(columns=AS_OF_COLUMNS)
+
+    # fcertificate is the key of the Policies table, so each transaction belongs to one row
+    transaction_policy = pd.Index(policies["fcertificate"]).get_indexer(transactions["Policy_No"])
+    sorted_transactions = SortedTransactions(transaction_policy, transactions["Transaction_Date"],
+                                             transactions["Premium"])
+    records = policies.to_dict("records")
+
+    frames = []
+    for as_of_date in as_of_dates:
+        as_of_date = pd.Timestamp(as_of_date)
+        periods, _ = portfolio_periods(policies, transactions, as_of_date, sorted_transactions=sorted_transactions)
+        statuses = [compute_sub_policy_status(policy, periods[row])[1] for row, policy in enumerate(records)]
+        combined = combine_by_main_policy(sub_status_frame(statuses)).loc[main_policy_nos]
+        combined.insert(0, "As Of Date", as_of_date)
+        frames.append(combined.reset_index())
+    return pd.concat(frames, ignore_index=True)[AS_OF_COLUMNS]
@@ -0,0 +1,369 @@
+"""
+Small local HTTP service that answers payment-status questions about one customer, for the call
+centre: the status of a main policy (TransactionNo) or sub-policy (fcertificate) and its payment
+period history, without running the report.
+
+Steps:
+1. On start-up, loads the active policies and their collections from policies.db and works out
+   the status and payment periods of every one of them with the same rules as
+   report_active_policies.py (status_engine.evaluate_sub_policies and combine_by_main_policy).
+   The results are kept in memory, indexed by TransactionNo and by fcertificate.
+2. Answers HTTP requests from that index (a dictionary lookup, well under 10 ms):
+   - GET /status/<TransactionNo or fcertificate>: combined status, status of each sub-policy
+     and the contact details
+   - GET /periods/<TransactionNo or fcertificate>: premium paid in every payment period (only
+     the sub-policy's periods when an fcertificate is given)
+   - GET /health: number of policies in memory, as-of date, last change loaded
+   Adding ?as_of=YYYY-MM-DD works the answer out for another date (from the data in memory).
+3. Every few seconds checks the change log of policies.db (see change_log.py) and only works out
+   again the main policies an ingest changed. When the date changes everything is worked out
+   again for the new date (the last period of every policy ends on the as-of date).
+
+Usage:
+    python3 status_service.py
+    python3 status_service.py --port 8765 --as-of 2025-05-30
+    then e.g. http://127.0.0.1:8765/status/HOLLARDWA2316
+
+Dependencies:
+- asyncio, json, sqlite3 (built into Python); database.py opens policies.db in WAL mode, so the
+  service can keep running while ingests write to it
+- pandas and numpy
+
+Notes:
+- Answers are JSON. Only active policies are known to the service; other policy numbers get a
+  404 answer.
+- The service only listens on this computer (127.0.0.1) unless --host is given.
+- Loading and refreshing run in a separate thread, so requests are answered meanwhile (from the
+  data loaded before).
+"""
+
+import argparse
+import asyncio
+import json
+from datetime import date
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+from change_log import changes_since, latest_change_id
+from database import DEFAULT_DB_PATH, begin_read_snapshot, connect
+from policies_ingest import KEY_LOOKUP_CHUNK
+from status_engine import (
+    ACTIVE_STATUSES, PERIOD_COLUMNS, STATUS_FIELDS, combine_by_main_policy, contact_rows_by_main_policy,
+    evaluate_sub_policies, load_active_portfolio
+)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# How often (in seconds) the change log of policies.db is checked
+DEFAULT_REFRESH_SECONDS = 5
+
+# Contact details included in a status answer
+CONTACT_COLUMNS = ["Client_Name", "CellPhone", "PayAtReference", "PreferredCollectionDay"]
+
+
+def json_value(value):
+    """A status value as JSON: dates as YYYY-MM-DD (with the time if there is one), missing values as null."""
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.date().isoformat() if value == value.normalize() else str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _status_dict(row):
+    return {label: json_value(row[label]) for label in STATUS_FIELDS}
+
+
+def policy_entries(policies, transactions, as_of_date):
+    """
+    Status answer and period history of every main policy of a portfolio loaded by
+    load_active_portfolio, worked out as the report does.
+
+    Returns:
+        dict: TransactionNo -> {"status", "sub_policies", "periods", "contact"}
+    """
+    sub_statuses, period_rows, _ = evaluate_sub_policies(policies, transactions, as_of_date, with_periods=True)
+    if sub_statuses.empty:
+        return {}
+    combined = combine_by_main_policy(sub_statuses)
+    contacts = contact_rows_by_main_policy(policies)
+
+    entries = {}
+    for transaction_no, row in combined.iterrows():
+        contact = contacts[transaction_no]
+        entries[transaction_no] = {
+            "status": _status_dict(row),
+            "sub_policies": [],
+            "periods": [],
+            "contact": {column: json_value(contact[column]) for column in CONTACT_COLUMNS},
+        }
+    for row in sub_statuses.to_dict("records"):
+        entries[row["TransactionNo"]]["sub_policies"].append({"fcertificate": row["fcertificate"], **_status_dict(row)})
+    for row in period_rows.itertuples(index=False, name=None):
+        period = dict(zip(PERIOD_COLUMNS, row))
+        entries[period["TransactionNo"]]["periods"].append({
+            "fcertificate": period["fcertificate"],
+            "Period Start": json_value(period["Period Start"]),
+            "Period End": json_value(period["Period End"]),
+            "Total Premium Paid": json_value(period["Total Premium Paid"]),
+        })
+    return entries
+
+
+def active_main_policies(conn, transaction_nos=None):
+    """The active main policies, or the active ones among transaction_nos (KEY_LOOKUP_CHUNK at a time)."""
+    statuses = ', '.join(repr(status) for status in ACTIVE_STATUSES)
+    if transaction_nos is None:
+        return {row[0] for row in conn.execute(
+            f"SELECT DISTINCT TransactionNo FROM Policies WHERE Status_Name IN ({statuses})")}
+    transaction_nos = list(transaction_nos)
+    active = set()
+    for i in range(0, len(transaction_nos), KEY_LOOKUP_CHUNK):
+        chunk = transaction_nos[i:i + KEY_LOOKUP_CHUNK]
+        active.update(row[0] for row in conn.execute(f"""
+            SELECT DISTINCT TransactionNo FROM Policies
+            WHERE Status_Name IN ({statuses}) AND TransactionNo IN ({', '.join(['?' for _ in chunk])})
+        """, chunk))
+    return active
+
+
+class PolicyStatusIndex:
+    """
+    The in-memory index the service answers from: the status answer and period history of every
+    active main policy for one as-of date, the sub-policies and collections of each main policy
+    (for answers about other dates), and where each fcertificate belongs.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, as_of_date=None):
+        self.db_path = db_path
+        # None follows the date of today
+        self.fixed_as_of_date = None if as_of_date is None else pd.Timestamp(as_of_date).normalize()
+        self.as_of_date = None
+        self.change_id = 0
+        self.entries = {}
+        self.portfolios = {}
+        self.main_policy_of = {}
+
+    def current_as_of_date(self):
+        return self.fixed_as_of_date if self.fixed_as_of_date is not None else pd.Timestamp.today().normalize()
+
+    def load_update(self):
+        """
+        Work out what changed since the last load, reading policies.db with a connection of its
+        own (runs in a worker thread). Returns the update for apply_update, or None if nothing changed.
+        """
+        conn = connect(self.db_path)
+        try:
+            begin_read_snapshot(conn)
+            as_of_date = self.current_as_of_date()
+            change_id = latest_change_id(conn)
+            full = as_of_date != self.as_of_date
+            if not full:
+                if change_id == self.change_id:
+                    return None
+                changed = changes_since(conn, self.change_id, change_id)
+                full = changed is None
+
+            if full:
+                reload = None
+                policies, transactions = load_active_portfolio(conn)
+            else:
+                reload = changed
+                policies, transactions = load_active_portfolio(conn, active_main_policies(conn, changed))
+        finally:
+            conn.close()
+
+        portfolios = {}
+        transactions_by_policy = transactions.groupby("Policy_No", sort=False).indices
+        for transaction_no, rows in policies.groupby("TransactionNo", sort=False).indices.items():
+            main_policies = policies.iloc[rows]
+            transaction_rows = [row for sub in main_policies["fcertificate"] for row in transactions_by_policy.get(sub, [])]
+            portfolios[transaction_no] = (main_policies, transactions.iloc[np.sort(np.array(transaction_rows, dtype=np.int64))])
+        return {
+            "reload": reload,
+            "as_of_date": as_of_date,
+            "change_id": change_id,
+            "entries": policy_entries(policies, transactions, as_of_date),
+            "portfolios": portfolios,
+        }
+
+    def apply_update(self, update):
+        """Swap the worked-out policies into the index (runs in the service's own thread)."""
+        if update["reload"] is None:
+            self.entries, self.portfolios, self.main_policy_of = {}, {}, {}
+        else:
+            # Main policies changed by an ingest: the old version goes, whether or not it is still active
+            for transaction_no in update["reload"]:
+                self.entries.pop(transaction_no, None)
+                old = self.portfolios.pop(transaction_no, None)
+                if old is not None:
+                    for sub in old[0]["fcertificate"]:
+                        if self.main_policy_of.get(sub) == transaction_no:
+                            del self.main_policy_of[sub]
+        self.entries.update(update["entries"])
+        self.portfolios.update(update["portfolios"])
+        for transaction_no, (main_policies, _) in update["portfolios"].items():
+            for sub in main_policies["fcertificate"]:
+                self.main_policy_of[sub] = transaction_no
+        self.as_of_date = update["as_of_date"]
+        self.change_id = update["change_id"]
+
+    def find(self, policy_no):
+        """(TransactionNo, fcertificate or None) of a main or sub-policy number, or None if unknown."""
+        if policy_no in self.entries:
+            return policy_no, None
+        if policy_no in self.main_policy_of:
+            return self.main_policy_of[policy_no], policy_no
+        return None
+
+    def entry(self, transaction_no, as_of_date=None):
+        """Status answer and period history of a main policy, for the loaded or another as-of date."""
+        if as_of_date is None or as_of_date == self.as_of_date:
+            return self.entries[transaction_no]
+        policies, transactions = self.portfolios[transaction_no]
+        return policy_entries(policies, transactions, as_of_date)[transaction_no]
+
+
+class StatusService:
+    """The HTTP side: reads requests, answers them from a PolicyStatusIndex and keeps the index up to date."""
+
+    def __init__(self, index, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        self.index = index
+        self.refresh_seconds = refresh_seconds
+
+    async def refresh(self):
+        """Bring the index up to date with policies.db (the work is done in a worker thread)."""
+        update = await asyncio.to_thread(self.index.load_update)
+        if update is not None:
+            self.index.apply_update(update)
+            what = "all" if update["reload"] is None else f"{len(update['reload'])} changed"
+            print(f"Loaded {what} main policies as of {self.index.as_of_date.date()} "
+                  f"({len(self.index.entries)} active main policies in memory)")
+
+    async def keep_refreshing(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as error:
+                # Keep answering from the data already loaded; try again next time
+                print(f"Refresh failed: {error}")
+
+    def answer(self, method, target):
+        """(HTTP status code, JSON-able answer) of one request."""
+        if method != "GET":
+            return 405, {"error": "only GET requests are supported"}
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        query = parse_qs(url.query)
+
+        if parts == ["health"]:
+            return 200, {
+                "main_policies": len(self.index.entries),
+                "sub_policies": len(self.index.main_policy_of),
+                "as_of_date": json_value(self.index.as_of_date),
+                "last_change_id": self.index.change_id,
+            }
+        if len(parts) != 2 or parts[0] not in ("status", "periods"):
+            return 404, {"error": "use /status/<policy>, /periods/<policy> or /health"}
+
+        found = self.index.find(parts[1])
+        if found is None:
+            return 404, {"error": f"{parts[1]} is not an active main policy (TransactionNo) or sub-policy (fcertificate)"}
+        transaction_no, fcertificate = found
+
+        as_of_date = None
+        if "as_of" in query:
+            try:
+                as_of_date = pd.Timestamp(query["as_of"][0]).normalize()
+            except ValueError:
+                return 400, {"error": f"as_of must be a date like 2025-05-30, not '{query['as_of'][0]}'"}
+        try:
+            entry = self.index.entry(transaction_no, as_of_date)
+        except ValueError as error:
+            # The status rules couldn't work this policy out (e.g. a missing date)
+            return 422, {"error": str(error)}
+
+        answer = {"TransactionNo": transaction_no, "as_of_date": json_value(as_of_date or self.index.as_of_date)}
+        if parts[0] == "status":
+            answer.update(entry["status"])
+            answer["contact"] = entry["contact"]
+            answer["sub_policies"] = entry["sub_policies"]
+        else:
+            answer["periods"] = [period for period in entry["periods"]
+                                 if fcertificate is None or period["fcertificate"] == fcertificate]
+        if fcertificate is not None:
+            answer["fcertificate"] = fcertificate
+        return 200, answer
+
+    async def handle_connection(self, reader, writer):
+        """Answer the requests of one connection (kept open between requests unless the client closes it)."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                request = request_line.decode("latin-1").split()
+                if len(request) != 3:
+                    code, answer, version = 400, {"error": "bad request"}, "HTTP/1.0"
+                else:
+                    method, target, version = request
+                    code, answer = self.answer(method, target)
+
+                body = json.dumps(answer).encode("utf-8")
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {code} {'OK' if code == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        await self.refresh()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Policy status service listening on http://{host}:{port}")
+        refresher = asyncio.create_task(self.keep_refreshing())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            refresher.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP service answering policy status questions.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite database to read")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="address to listen on (default: this computer only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--as-of", default=None, help="work the statuses out for this date (default: today)")
+    parser.add_argument("--refresh-seconds", type=float, default=DEFAULT_REFRESH_SECONDS,
+                        help="how often to check policies.db for changes")
+    args = parser.parse_args()
+
+    service = StatusService(PolicyStatusIndex(args.db, args.as_of), args.refresh_seconds)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Stopped")
@@ -0,0 +1,305 @@
+"""
+Payment status of the active policies kept in policy_status_summary.db, for lookups and
+dashboards, and so that report_active_policies.py only has to work out again the main policies
+whose data changed since the last run.
+
+Tables:
+- MainPolicyStatus: the combined status of every active main policy (Up to Date, Amount due,
+  Next Payment Due, Next Collection Already Paid, Payment Method), the as-of date it holds for,
+  and Valid_Until, the first as-of date on which it could change even without new data (a new
+  period starting, a period becoming a full month, ...; see period_calendar.next_status_change).
+- PeriodLedger: one row per payment period of every sub-policy, with the premium paid and the
+  premium expected (see status_engine.period_ledger). Indexed on TransactionNo and fcertificate.
+- StatusStoreInfo: the as-of date of the stored statuses and the number of the last change in
+  the change log of policies.db (see change_log.py) they include.
+
+A run then only works out again:
+- the main policies touched by an ingest since the last run (from the change log),
+- the main policies whose Valid_Until date has been reached,
+- active main policies that are not in the store yet.
+Everything is worked out again if a table was rebuilt, the as-of date went backwards, or
+policies.db was replaced (its change log is behind the store).
+
+Dependencies:
+- sqlite3 (built into Python)
+- pandas and numpy
+
+Notes:
+- The value columns of MainPolicyStatus have no declared type, so SQLite keeps whole amounts as
+  integers and the others as floats; the report's CSV comes out the same as when everything is
+  worked out again.
+- Dates are stored as ISO text ('YYYY-MM-DD', with ' HH:MM:SS' only if there is a time), like
+  the date columns of policies.db.
+"""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from change_log import changes_since, latest_change_id
+from policies_ingest import KEY_LOOKUP_CHUNK
+from status_engine import (
+    DEFAULT_SHARD_SIZE, LEDGER_COLUMNS, STATUS_FIELDS, evaluate_main_policies, load_active_portfolio
+)
+
+STATUS_TABLE = "MainPolicyStatus"
+LEDGER_TABLE = "PeriodLedger"
+INFO_TABLE = "StatusStoreInfo"
+
+# Column of the status table for each status field
+STATUS_COLUMNS = {label: label.replace(" ", "_") for label in STATUS_FIELDS}
+
+# Column of the ledger table for each ledger column
+LEDGER_TABLE_COLUMNS = {label: label.replace(" ", "_") for label in LEDGER_COLUMNS}
+
+
+def ensure_status_store(out_conn):
+    """Create the MainPolicyStatus, PeriodLedger and StatusStoreInfo tables if they don't exist yet."""
+    value_columns = ', '.join(STATUS_COLUMNS.values())
+    out_conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATUS_TABLE} (
+            TransactionNo TEXT PRIMARY KEY,
+            {value_columns},
+            Valid_Until TEXT,
+            As_Of_Date TEXT
+        )
+    """)
+    # Stores written before the as-of date was kept per main policy
+    existing = [row[1] for row in out_conn.execute(f"PRAGMA table_info({STATUS_TABLE})")]
+    if "As_Of_Date" not in existing:
+        out_conn.execute(f"ALTER TABLE {STATUS_TABLE} ADD COLUMN As_Of_Date TEXT")
+
+    out_conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+            TransactionNo TEXT,
+            fcertificate TEXT,
+            Period_Start TEXT,
+            Period_End TEXT,
+            Premium_Paid REAL,
+            Premium_Expected REAL
+        )
+    """)
+    out_conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{LEDGER_TABLE}_main ON {LEDGER_TABLE} (TransactionNo, Period_Start)")
+    out_conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{LEDGER_TABLE}_sub ON {LEDGER_TABLE} (fcertificate, Period_Start)")
+    out_conn.execute(f"CREATE TABLE IF NOT EXISTS {INFO_TABLE} (as_of_date TEXT, last_change_id INTEGER)")
+
+
+def _iso_dates(dates):
+    """ISO text of each date: 'YYYY-MM-DD', with the time only if there is one (None for NaT)."""
+    dates = pd.Series(pd.to_datetime(dates))
+    iso = pd.Series(np.datetime_as_string(dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")),
+                    index=dates.index, dtype=object)
+    has_time = dates.notna() & (dates != dates.dt.normalize())
+    if has_time.any():
+        iso[has_time] = dates[has_time].dt.strftime("%Y-%m-%d %H:%M:%S")
+    iso[dates.isna()] = None
+    return iso.tolist()
+
+
+def _value_to_sql(label, value):
+    if label in ["Up to Date", "Next Collection Already Paid"]:
+        return int(bool(value))
+    if label == "Next Payment Due" and value is not pd.NaT and not isinstance(value, str):
+        # Dates are stored as 'YYYY-MM-DD', Timestamps with their time, so they come back the same
+        return value.isoformat() if isinstance(value, date) and not isinstance(value, pd.Timestamp) else str(value)
+    if value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _value_from_sql(label, value):
+    if label in ["Up to Date", "Next Collection Already Paid"]:
+        return bool(value)
+    if label == "Amount due":
+        if value is None:
+            return np.float64("nan")
+        return np.int64(value) if isinstance(value, int) else np.float64(value)
+    if label == "Next Payment Due":
+        if value is None:
+            return pd.NaT
+        if value == "Mixed":
+            return value
+        return date.fromisoformat(value) if len(value) == 10 else pd.Timestamp(value)
+    return value
+
+
+def load_status_store(out_conn):
+    """
+    Read the stored statuses.
+
+    Returns:
+        tuple: (as-of date, last change number, DataFrame indexed by TransactionNo with the
+        STATUS_FIELDS columns and Valid Until), or None if nothing has been stored yet
+    """
+    ensure_status_store(out_conn)
+    info = out_conn.execute(f"SELECT as_of_date, last_change_id FROM {INFO_TABLE}").fetchone()
+    if info is None:
+        return None
+
+    columns = ["TransactionNo"] + list(STATUS_COLUMNS.values()) + ["Valid_Until"]
+    rows = out_conn.execute(f"SELECT {', '.join(columns)} FROM {STATUS_TABLE}").fetchall()
+    statuses = pd.DataFrame(
+        [[_value_from_sql(label, value) for label, value in zip(STATUS_FIELDS, row[1:-1])] for row in rows],
+        index=pd.Index([row[0] for row in rows], name="TransactionNo"),
+        columns=STATUS_FIELDS,
+        dtype=object
+    )
+    statuses["Up to Date"] = statuses["Up to Date"].astype(bool)
+    statuses["Next Collection Already Paid"] = statuses["Next Collection Already Paid"].astype(bool)
+    statuses["Valid Until"] = pd.to_datetime(pd.Series([row[-1] for row in rows], index=statuses.index, dtype=object))
+    return pd.Timestamp(info[0]), info[1], statuses
+
+
+def _delete_main_policies(out_conn, table, transaction_nos):
+    for i in range(0, len(transaction_nos), KEY_LOOKUP_CHUNK):
+        chunk = transaction_nos[i:i + KEY_LOOKUP_CHUNK]
+        out_conn.execute(f"DELETE FROM {table} WHERE TransactionNo IN ({', '.join(['?' for _ in chunk])})", chunk)
+
+
+def save_status_store(out_conn, statuses, ledger, as_of, change_id, removed=(), replace_all=False):
+    """
+    Store newly worked-out statuses and period ledger rows, in one transaction. The ledger rows of
+    the main policies in statuses replace the ones stored before, and every stored status is
+    marked as holding for as_of.
+
+    Args:
+        statuses (DataFrame): indexed by TransactionNo, as returned by evaluate_main_policies
+        ledger (DataFrame): period ledger of the sub-policies of those main policies
+        as_of (Timestamp): date the statuses were worked out for
+        change_id (int): last change of the change log they include
+        removed (list): main policies to drop from the store (no longer active, or without sub-policies)
+        replace_all (bool): drop everything that was stored before
+    """
+    ensure_status_store(out_conn)
+    columns = ["TransactionNo"] + list(STATUS_COLUMNS.values()) + ["Valid_Until"]
+    valid_until = _iso_dates(pd.to_datetime(statuses["Valid Until"]).dt.normalize())
+    rows = []
+    for (transaction_no, status), status_valid_until in zip(statuses.iterrows(), valid_until):
+        rows.append(
+            [transaction_no] + [_value_to_sql(label, status[label]) for label in STATUS_FIELDS] + [status_valid_until]
+        )
+
+    ledger_rows = zip(
+        ledger["TransactionNo"], ledger["fcertificate"], _iso_dates(ledger["Period Start"]),
+        _iso_dates(ledger["Period End"]), ledger["Premium Paid"].astype(object).where(ledger["Premium Paid"].notna(), None),
+        ledger["Premium Expected"].astype(object).where(ledger["Premium Expected"].notna(), None)
+    )
+
+    with out_conn:
+        if replace_all:
+            out_conn.execute(f"DELETE FROM {STATUS_TABLE}")
+            out_conn.execute(f"DELETE FROM {LEDGER_TABLE}")
+        _delete_main_policies(out_conn, STATUS_TABLE, list(removed))
+        _delete_main_policies(out_conn, LEDGER_TABLE, list(removed) + ([] if replace_all else list(statuses.index)))
+        out_conn.executemany(
+            f"INSERT OR REPLACE INTO {STATUS_TABLE} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in columns])})",
+            rows
+        )
+        out_conn.executemany(
+            f"INSERT INTO {LEDGER_TABLE} ({', '.join(LEDGER_TABLE_COLUMNS.values())}) "
+            f"VALUES ({', '.join(['?' for _ in LEDGER_COLUMNS])})",
+            ledger_rows
+        )
+        # The statuses that weren't worked out again still hold on the new as-of date
+        out_conn.execute(f"UPDATE {STATUS_TABLE} SET As_Of_Date = ?", (_iso_dates([as_of])[0],))
+        out_conn.execute(f"DELETE FROM {INFO_TABLE}")
+        out_conn.execute(f"INSERT INTO {INFO_TABLE} VALUES (?, ?)", (pd.Timestamp(as_of).isoformat(), change_id))
+
+
+def main_policies_to_recompute(conn, stored, main_policy_nos, today_date, change_id):
+    """
+    Work out which main policies need their status worked out again (see the notes at the top).
+
+    Returns:
+        list: main policies in main_policy_nos order, or None if all of them need it
+    """
+    if stored is None:
+        return None
+    as_of, last_change_id, statuses = stored
+    if as_of > pd.Timestamp(today_date) or last_change_id > change_id:
+        return None
+    changed = changes_since(conn, last_change_id, change_id)
+    if changed is None:
+        return None
+
+    valid_until = statuses["Valid Until"]
+    expired = set(statuses.index[valid_until.notna() & (valid_until <= pd.Timestamp(today_date))])
+    return [
+        transaction_no for transaction_no in main_policy_nos
+        if transaction_no in changed or transaction_no in expired or transaction_no not in statuses.index
+    ]
+
+
+def update_status_store(conn, out_conn, main_policy_nos, today_date, workers=1, shard_size=DEFAULT_SHARD_SIZE,
+                        incremental=True):
+    """
+    Combined status of each active main policy, stored in policy_status_summary.db with the period
+    ledger. With incremental set, the stored statuses of the main policies that haven't changed
+    are reused and only the others are worked out again.
+
+    Args:
+        conn: sqlite3 connection to policies.db (read from one snapshot, see database.begin_read_snapshot)
+        out_conn: sqlite3 connection to policy_status_summary.db
+        main_policy_nos (list): active main policies
+        today_date (Timestamp): date the status is worked out for
+        workers, shard_size: see status_engine.evaluate_main_policies
+        incremental (bool): reuse the stored statuses where possible (False works everything out)
+
+    Returns:
+        DataFrame: as returned by evaluate_main_policies for all of main_policy_nos
+    """
+    stored = load_status_store(out_conn)
+    change_id = latest_change_id(conn)
+    recompute = main_policies_to_recompute(conn, stored, main_policy_nos, today_date, change_id) if incremental else None
+
+    if recompute is None:
+        print(f"Working out the status of all {len(main_policy_nos)} active main policies")
+        policies, transactions = load_active_portfolio(conn)
+        combined, ledger = evaluate_main_policies(policies, transactions, main_policy_nos, today_date, workers,
+                                                  shard_size, with_ledger=True)
+        save_status_store(out_conn, combined, ledger, today_date, change_id, replace_all=True)
+        return combined
+
+    _, _, statuses = stored
+    print(f"Reusing {len(main_policy_nos) - len(recompute)} stored main policy statuses, "
+          f"working out {len(recompute)} again")
+    policies, transactions = load_active_portfolio(conn, recompute)
+    fresh, ledger = evaluate_main_policies(policies, transactions, recompute, today_date, workers, shard_size,
+                                           with_ledger=True)
+
+    # Stored statuses of main policies that are no longer active (or lost their sub-policies) go
+    active = set(main_policy_nos)
+    removed = [transaction_no for transaction_no in statuses.index if transaction_no not in active]
+    removed += [transaction_no for transaction_no in recompute if transaction_no not in fresh.index]
+    save_status_store(out_conn, fresh, ledger, today_date, change_id, removed=removed)
+
+    recomputed = set(recompute)
+    reused = statuses.loc[[
+        transaction_no for transaction_no in main_policy_nos
+        if transaction_no not in recomputed and transaction_no in statuses.index
+    ]]
+    # Same column types as when everything is worked out at once
+    combined = pd.concat([reused, fresh]).infer_objects()
+    return combined.loc[[transaction_no for transaction_no in main_policy_nos if transaction_no in combined.index]]
+
+
+def iter_period_ledger(out_conn, chunk_size=KEY_LOOKUP_CHUNK):
+    """
+    The stored period ledger, chunk_size rows at a time, ordered by main policy and period start
+    (the order of the TransactionNo index, so SQLite doesn't have to sort).
+
+    Yields:
+        list: dicts with the LEDGER_COLUMNS labels; dates as stored (ISO text)
+    """
+    ensure_status_store(out_conn)
+    cursor = out_conn.execute(f"""
+        SELECT {', '.join(LEDGER_TABLE_COLUMNS.values())} FROM {LEDGER_TABLE}
+        ORDER BY TransactionNo, Period_Start
+    """)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield [dict(zip(LEDGER_COLUMNS, row)) for row in rows]
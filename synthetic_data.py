@@ -0,0 +1,298 @@
+"""
+This script writes a synthetic but realistic set of Sales and collections (CPS) CSV files, so that
+the ingest scripts and the report can be tried out and timed without real client data (see
+benchmark.py).
+
+Steps:
+1. Makes up the given number of sub-policies (fcertificate), grouped into main policies
+   (TransactionNo) of 1 to 3 sub-policies: PayAt and Direct Debit, several premiums, Active /
+   Active Policy / Cancelled / Lapsed, inception dates from 2019 on.
+2. Makes up their collections: one payment a month from the first collection on, with some
+   months missed (every policy has its own chance of paying), failed debit orders ('Default'
+   rows a few days after the payment) and no payments after a cancellation.
+3. Writes the files under the names the scripts read (see the csv_file line at the top of each):
+   - 'March 2025 Sales File.csv': every main policy that started before April 2025
+   - 'Sales File 5th May.csv': main policies that started since, and a few earlier
+     sub-policies again with a new status
+   - 'CPS_Jan_2024tillMarch_2025.csv': collections up to the end of March 2025
+   - 'April to 3 May CPS.csv': collections from April 2025 on
+   The collections are made and written a chunk of sub-policies at a time, so even millions of
+   policies don't need much memory.
+
+The files have the quirks of the real exports: spaces around some column headings, headings
+that differ between files ('Payment Method' / 'Payment_Method', 'Transaction Type' /
+'Transaction_type'), extra columns, dates as YYYY/MM/DD, empty FirstCollectionDates (only
+where the report doesn't use them), the sign of Premium sometimes the wrong way round, and a
+few rows with an unknown Transaction_type (these end up in the quarantine CSV).
+
+Usage:
+    python3 synthetic_data.py --policies 10000 --out-dir synthetic_10k
+    then run the scripts in that folder (benchmark.py does this and times them)
+
+Dependencies:
+- numpy, pandas
+
+Notes:
+- The same --seed always gives the same files.
+- The data ends on 3 May 2025 and report_active_policies.py works the statuses out for
+  30 May 2025, the date set at its top.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# File names read by create_policies_table.py, add_new_sales.py, create_collections_table.py and
+# add_new_collections.py
+SALES_FILE = "March 2025 Sales File.csv"
+NEW_SALES_FILE = "Sales File 5th May.csv"
+CPS_FILE = "CPS_Jan_2024tillMarch_2025.csv"
+NEW_CPS_FILE = "April to 3 May CPS.csv"
+
+# Policies that start from this date on are in the new sales file, collections from this date
+# on in the new CPS file
+NEW_FILES_FROM = np.datetime64("2025-04-01")
+
+# Last day with data, and first possible inception date
+DATA_END = np.datetime64("2025-05-03")
+FIRST_INCEPTION = np.datetime64("2019-01-01")
+
+# Headings of the files, as the exports write them (spaces included)
+SALES_HEADER = [" fcertificate", "FirstCollectionDate ", "Premium", "Payment Method", "PreferredCollectionDay",
+                "InceptionDate", "TransactionNo", "Status Name", "CellPhone", "Client_Name", "PayAtReference",
+                "Other Col"]
+CPS_HEADER = ["Transaction_Date", " Premium ", "Transaction_type", "Payment_Method", "Policy_No", "Junk"]
+NEW_CPS_HEADER = ["Transaction Date", " Premium ", "Transaction Type", "Payment Method", "Policy No", "Junk"]
+
+# Make-up of the portfolio
+SUB_POLICY_COUNTS = ([1, 2, 3], [0.7, 0.2, 0.1])
+PAYMENT_METHODS = (["PayAt", "Direct Debit"], [0.55, 0.45])
+STATUSES = (["Active", "Active Policy", "Cancelled", "Lapsed"], [0.65, 0.15, 0.12, 0.08])
+PREMIUMS = np.array([99.0, 120.0, 150.0, 199.0, 210.5, 250.0, 350.0, 999.0])
+# Direct Debit collection days (the 1st, 15th, 25th and month-end are the most common)
+COLLECTION_DAYS = np.arange(1, 32)
+COLLECTION_DAY_WEIGHTS = np.where(np.isin(COLLECTION_DAYS, [1, 15, 25, 31]), 8.0, 1.0)
+COLLECTION_DAY_WEIGHTS /= COLLECTION_DAY_WEIGHTS.sum()
+
+# Share of Direct Debit payments that fail ('Default' row a few days later), of rows written
+# with the sign of Premium the wrong way round, and of rows with an unknown Transaction_type
+DEFAULT_RATE = 0.08
+WRONG_SIGN_RATE = 0.01
+UNKNOWN_TYPE_RATE = 0.003
+
+# Number of sub-policies whose collections are made and written at a time
+DEFAULT_CHUNK_POLICIES = 50000
+
+
+def _slash_dates(dates):
+    """'YYYY/MM/DD' text of datetime64[D] dates ('' for NaT)."""
+    text = np.char.replace(np.datetime_as_string(dates, unit="D"), "-", "/")
+    return np.where(np.isnat(dates), "", text)
+
+
+def _add_months(dates, months, day):
+    """Day 'day' of the month 'months' after each date, or the month's last day if it is shorter."""
+    month = dates.astype("datetime64[M]") + months
+    month_days = ((month + 1).astype("datetime64[D]") - month.astype("datetime64[D]")).astype(np.int64)
+    return month.astype("datetime64[D]") + (np.minimum(day, month_days) - 1)
+
+
+def generate_policies(n_policies, rng):
+    """
+    Make up n_policies sub-policies.
+
+    Returns:
+        DataFrame: one row per sub-policy with the Sales file columns (clean names, dates as
+        datetime64) plus Cancel_Date (NaT if still running), Pay_Chance and First_Payment
+    """
+    counts, weights = SUB_POLICY_COUNTS
+    sub_counts = rng.choice(counts, size=n_policies, p=weights)
+    sub_counts = sub_counts[:np.searchsorted(np.cumsum(sub_counts), n_policies) + 1]
+    sub_counts[-1] -= sub_counts.sum() - n_policies
+    n_main = len(sub_counts)
+    main = np.repeat(np.arange(n_main), sub_counts)
+    sub_number = np.arange(n_policies) - np.repeat(np.cumsum(sub_counts) - sub_counts, sub_counts)
+
+    # Main policy values, shared by its sub-policies
+    span = int((DATA_END - FIRST_INCEPTION).astype(np.int64))
+    main_inception = FIRST_INCEPTION + rng.integers(0, span, n_main).astype("timedelta64[D]")
+    main_method = rng.choice(PAYMENT_METHODS[0], size=n_main, p=PAYMENT_METHODS[1])
+    main_status = rng.choice(STATUSES[0], size=n_main, p=STATUSES[1])
+    main_day = rng.choice(COLLECTION_DAYS, size=n_main, p=COLLECTION_DAY_WEIGHTS)
+    main_ids = np.char.add("TX", np.char.zfill(np.arange(n_main).astype(str), 7))
+
+    method = main_method[main]
+    direct_debit = method == "Direct Debit"
+    # Later sub-policies are sometimes added a while after the first one
+    added_later = (sub_number > 0) & (rng.random(n_policies) < 0.3)
+    inception = main_inception[main] + np.where(added_later, rng.integers(0, 400, n_policies), 0).astype("timedelta64[D]")
+    inception = np.minimum(inception, DATA_END)
+
+    # First collection: PayAt pays within a month of inception, Direct Debit on its collection day
+    collection_day = np.where(direct_debit, main_day[main], 0)
+    next_debit = _add_months(inception, 0, collection_day)
+    next_debit = np.where(next_debit > inception, next_debit, _add_months(inception, 1, collection_day))
+    first_collection = np.where(direct_debit, next_debit,
+                                inception + rng.integers(0, 31, n_policies).astype("timedelta64[D]"))
+    # Some exports leave FirstCollectionDate empty; only where the report doesn't need it
+    not_needed = direct_debit | (inception >= np.datetime64("2022-01-01"))
+    first_collection_text = np.where(not_needed & (rng.random(n_policies) < 0.05),
+                                     np.datetime64("NaT"), first_collection).astype("datetime64[D]")
+
+    status = main_status[main]
+    stopped = np.isin(status, ["Cancelled", "Lapsed"])
+    running_days = np.maximum((DATA_END - first_collection).astype(np.int64), 1)
+    cancel_date = np.where(stopped, first_collection + (rng.random(n_policies) * running_days).astype("timedelta64[D]"),
+                           np.datetime64("NaT"))
+    # Chance of paying in any given month: most policies pay nearly always, some often miss
+    pay_chance = np.where(rng.random(n_policies) < 0.75, rng.uniform(0.9, 1.0, n_policies),
+                          rng.uniform(0.4, 0.9, n_policies))
+
+    phone = np.char.add("0", rng.integers(600000000, 899999999, n_policies).astype(str))
+    has_reference = rng.random(n_policies) < 0.6
+    reference = np.where(has_reference, rng.integers(1000000000, 9999999999, n_policies).astype(str), "")
+    return pd.DataFrame({
+        "fcertificate": np.char.add(np.char.add(main_ids[main], "-"), np.char.add(sub_number.astype(str), "F")),
+        "FirstCollectionDate": first_collection_text,
+        "Premium": rng.choice(PREMIUMS, size=n_policies),
+        "Payment_Method": method,
+        "PreferredCollectionDay": collection_day,
+        "InceptionDate": inception,
+        "TransactionNo": main_ids[main],
+        "Status_Name": status,
+        "CellPhone": phone,
+        "Client_Name": np.char.add("Client ", main.astype(str)),
+        "PayAtReference": reference,
+        "Cancel_Date": cancel_date.astype("datetime64[D]"),
+        "Pay_Chance": pay_chance,
+        "First_Payment": first_collection.astype("datetime64[D]"),
+    })
+
+
+def generate_collections(policies, rng):
+    """
+    Make up the collections of some sub-policies (from generate_policies).
+
+    Returns:
+        DataFrame: Transaction_Date (datetime64[D]), Premium, Transaction_type, Payment_Method,
+        Policy_No, in policy and date order
+    """
+    first = policies["First_Payment"].to_numpy()
+    last = np.where(np.isnat(policies["Cancel_Date"].to_numpy()), DATA_END, policies["Cancel_Date"].to_numpy())
+    months = np.maximum((last.astype("datetime64[M]") - first.astype("datetime64[M]")).astype(np.int64) + 1, 0)
+
+    policy = np.repeat(np.arange(len(policies)), months)
+    step = np.arange(len(policy)) - np.repeat(np.cumsum(months) - months, months)
+    first_day = (first - first.astype("datetime64[M]").astype("datetime64[D]")).astype(np.int64) + 1
+    direct_debit = (policies["Payment_Method"].to_numpy() == "Direct Debit")[policy]
+    dates = _add_months(first[policy], step, first_day[policy])
+    # PayAt customers pay a few days either side of their date, debit orders run on the day
+    dates = dates + np.where(direct_debit, 0, rng.integers(0, 6, len(policy))).astype("timedelta64[D]")
+    paid = (rng.random(len(policy)) < policies["Pay_Chance"].to_numpy()[policy]) & (dates <= last[policy])
+    policy, dates, direct_debit = policy[paid], dates[paid], direct_debit[paid]
+
+    # Failed debit orders: the payment is reversed by a 'Default' row a few days later
+    failed = direct_debit & (rng.random(len(policy)) < DEFAULT_RATE)
+    failed &= dates + 3 <= DATA_END
+    policy = np.concatenate([policy, policy[failed]])
+    dates = np.concatenate([dates, dates[failed] + 3])
+    transaction_type = np.concatenate([np.full(paid.sum(), "Accepted"), np.full(failed.sum(), "Default")]).astype(object)
+
+    premium = policies["Premium"].to_numpy()[policy]
+    premium = np.where(transaction_type == "Default", -premium, premium)
+    premium = np.where(rng.random(len(policy)) < WRONG_SIGN_RATE, -premium, premium)
+    transaction_type[rng.random(len(policy)) < UNKNOWN_TYPE_RATE] = "Reversal"
+
+    order = np.lexsort((dates, policy))
+    return pd.DataFrame({
+        "Transaction_Date": dates[order],
+        "Premium": premium[order],
+        "Transaction_type": transaction_type[order],
+        "Payment_Method": policies["Payment_Method"].to_numpy()[policy][order],
+        "Policy_No": policies["fcertificate"].to_numpy()[policy][order],
+    })
+
+
+def _sales_rows(policies):
+    return pd.DataFrame({
+        SALES_HEADER[0]: policies["fcertificate"],
+        SALES_HEADER[1]: _slash_dates(policies["FirstCollectionDate"].to_numpy()),
+        SALES_HEADER[2]: policies["Premium"],
+        SALES_HEADER[3]: policies["Payment_Method"],
+        SALES_HEADER[4]: policies["PreferredCollectionDay"],
+        SALES_HEADER[5]: _slash_dates(policies["InceptionDate"].to_numpy()),
+        SALES_HEADER[6]: policies["TransactionNo"],
+        SALES_HEADER[7]: policies["Status_Name"],
+        SALES_HEADER[8]: policies["CellPhone"],
+        SALES_HEADER[9]: policies["Client_Name"],
+        SALES_HEADER[10]: policies["PayAtReference"],
+        SALES_HEADER[11]: "x",
+    })
+
+
+def _cps_rows(collections, header):
+    return pd.DataFrame({
+        header[0]: _slash_dates(collections["Transaction_Date"].to_numpy()),
+        header[1]: collections["Premium"],
+        header[2]: collections["Transaction_type"],
+        header[3]: collections["Payment_Method"],
+        header[4]: collections["Policy_No"],
+        header[5]: "j",
+    })
+
+
+def generate_portfolio(n_policies, out_dir=".", seed=0, chunk_policies=DEFAULT_CHUNK_POLICIES):
+    """
+    Write the four CSV files for n_policies sub-policies to out_dir.
+
+    Returns:
+        dict: number of rows written to each file
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    policies = generate_policies(n_policies, rng)
+
+    # Main policies that started before April go in the first sales file, the rest in the new one
+    main_start = policies.groupby("TransactionNo", sort=False)["InceptionDate"].transform("min").to_numpy()
+    new_sale = main_start >= NEW_FILES_FROM
+    # A few earlier sub-policies come again in the new file, with a new status
+    resent = ~new_sale & (rng.random(len(policies)) < 0.02)
+    updated = policies[resent].copy()
+    updated["Status_Name"] = np.where(updated["Status_Name"].str.startswith("Active"), "Cancelled", "Active")
+
+    rows = {}
+    _sales_rows(policies[~new_sale]).to_csv(os.path.join(out_dir, SALES_FILE), index=False)
+    _sales_rows(pd.concat([policies[new_sale], updated])).to_csv(os.path.join(out_dir, NEW_SALES_FILE), index=False)
+    rows[SALES_FILE] = int((~new_sale).sum())
+    rows[NEW_SALES_FILE] = int(new_sale.sum() + resent.sum())
+
+    # Collections, a chunk of sub-policies at a time, split by date over the two CPS files
+    rows[CPS_FILE] = rows[NEW_CPS_FILE] = 0
+    for start in range(0, len(policies), chunk_policies):
+        collections = generate_collections(policies.iloc[start:start + chunk_policies], rng)
+        new = collections["Transaction_Date"].to_numpy() >= NEW_FILES_FROM
+        for csv_file, header, part in [(CPS_FILE, CPS_HEADER, collections[~new]),
+                                       (NEW_CPS_FILE, NEW_CPS_HEADER, collections[new])]:
+            _cps_rows(part, header).to_csv(os.path.join(out_dir, csv_file), index=False,
+                                           mode="w" if start == 0 else "a", header=start == 0)
+            rows[csv_file] += len(part)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic Sales and CPS CSV files.")
+    parser.add_argument("--policies", type=int, default=10000, help="number of sub-policies (fcertificate)")
+    parser.add_argument("--out-dir", default=".", help="folder to write the files to")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (the same seed gives the same files)")
+    parser.add_argument("--json", action="store_true", help="print the number of rows of each file as JSON")
+    args = parser.parse_args()
+
+    rows = generate_portfolio(args.policies, args.out_dir, args.seed)
+    if args.json:
+        print(json.dumps(rows))
+    else:
+        for csv_file, count in rows.items():
+            print(f"{csv_file}: {count} rows")